@@ -0,0 +1,157 @@
+"""
+Materialized quarterly hiring aggregates.
+
+hiring_summary holds the number of hires per (year, quarter, department_id,
+job_id). insert_batch_data keeps it current by adding the counts of the
+rows it actually inserted (rows skipped by ON CONFLICT are not counted),
+and moving the rows it updated from their old key to their new one, in
+the same transaction as the write. Keys left without hires are deleted,
+so every row of the summary counts at least one hire. The metrics
+endpoints read from it, so their latency does not depend on the size of
+hired_employees.
+
+Migration 0005 backfills it from the rows already in hired_employees.
+Repair it with:
+python -m aggregates rebuild
+"""
+
+import sys
+from collections import Counter
+import sqlalchemy
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.dialects.postgresql import insert
+from config import hiring_summary
+
+
+def year_quarter(value):
+    """
+    Returns the (year, quarter) of a datetime or an ISO datetime string.
+    """
+    if isinstance(value, str):
+        year, month = value.split("-")[:2]
+        year, month = int(year), int(month)
+    else:
+        year, month = value.year, value.month
+    return year, (month - 1) // 3 + 1
+
+
+def summary_deltas(rows):
+    """
+    Counts hires per (year, quarter, department_id, job_id).
+
+    Parameters:
+    - rows: Iterable of (datetime, department_id, job_id) tuples.
+
+    Returns:
+    - Counter: The number of hires per key.
+    """
+    deltas = Counter()
+    for value, department_id, job_id in rows:
+        deltas[(*year_quarter(value), department_id, job_id)] += 1
+    return deltas
+
+
+_summary_upsert = insert(hiring_summary)
+_summary_upsert = _summary_upsert.on_conflict_do_update(
+    index_elements=["year", "quarter", "department_id", "job_id"],
+    set_={"hires": hiring_summary.c.hires + _summary_upsert.excluded.hires},
+)
+
+_summary_delete_empty = hiring_summary.delete().where(
+    hiring_summary.c.year == bindparam("key_year"),
+    hiring_summary.c.quarter == bindparam("key_quarter"),
+    hiring_summary.c.department_id == bindparam("key_department_id"),
+    hiring_summary.c.job_id == bindparam("key_job_id"),
+    hiring_summary.c.hires <= 0,
+)
+
+# Deletes the keys whose hires dropped to zero after the COPY path moved
+# updated rows away from them
+DELETE_EMPTY_SUMMARY = "DELETE FROM hiring_summary WHERE hires <= 0"
+
+
+def apply_summary_deltas(connection, deltas):
+    """
+    Adds hire counts to hiring_summary on an open connection.
+    Counts may be negative, to remove rows that were updated; keys left
+    without hires are deleted.
+
+    Keys are written in sorted order, so concurrent batches touching the
+    same keys lock them in the same order and cannot deadlock.
+    """
+    deltas = {key: hires for key, hires in sorted(deltas.items()) if hires}
+    if not deltas:
+        return
+    connection.execute(
+        _summary_upsert,
+        [
+            {
+                "year": year,
+                "quarter": quarter,
+                "department_id": department_id,
+                "job_id": job_id,
+                "hires": hires,
+            }
+            for (year, quarter, department_id, job_id), hires in deltas.items()
+        ],
+    )
+    emptied = [key for key, hires in deltas.items() if hires < 0]
+    if emptied:
+        connection.execute(
+            _summary_delete_empty,
+            [
+                {
+                    "key_year": year,
+                    "key_quarter": quarter,
+                    "key_department_id": department_id,
+                    "key_job_id": job_id,
+                }
+                for year, quarter, department_id, job_id in emptied
+            ],
+        )
+
+
+# Used by the COPY path to update hiring_summary from the rows
+# returned by INSERT ... RETURNING in a single statement. hires is
+# COUNT(*) to count the rows of source, or SUM(hires) if source has
+# a signed hires column (e.g. -1 for the old values of updated rows).
+# Keys are upserted in order, like in apply_summary_deltas
+SUMMARY_UPSERT_FROM = """
+    INSERT INTO hiring_summary (year, quarter, department_id, job_id, hires)
+    SELECT
+        EXTRACT(YEAR FROM datetime AT TIME ZONE 'UTC')::INTEGER,
+        EXTRACT(QUARTER FROM datetime AT TIME ZONE 'UTC')::INTEGER,
+        department_id,
+        job_id,
+        {hires}
+    FROM {source}
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (year, quarter, department_id, job_id)
+    DO UPDATE SET hires = hiring_summary.hires + EXCLUDED.hires
+"""
+
+
+def rebuild_hiring_summary(engine):
+    """
+    Recomputes hiring_summary from hired_employees.
+
+    Writers to hired_employees are blocked while the summary is rebuilt,
+    so no insert is counted twice or missed.
+    """
+    hiring_summary.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text("LOCK TABLE hired_employees IN SHARE MODE"))
+        connection.execute(sqlalchemy.text("DELETE FROM hiring_summary"))
+        connection.execute(
+            sqlalchemy.text(SUMMARY_UPSERT_FROM.format(source="hired_employees", hires="COUNT(*)"))
+        )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        raise SystemExit("Usage: python -m aggregates rebuild")
+    from utils import get_engine
+
+    rebuild_hiring_summary(get_engine())
+    print("hiring_summary rebuilt successfully!")
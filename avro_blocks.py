@@ -0,0 +1,155 @@
+"""
+Block-level reading of Avro container files.
+
+An Avro file is a header followed by blocks of records, each compressed
+on its own. Splitting a stream into raw blocks lets compressed blocks be
+decompressed and decoded in parallel across a process pool, while the
+stream itself is read only once and in order.
+
+This module only depends on fastavro so that pool workers start quickly.
+"""
+
+import multiprocessing, threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import fastavro
+
+MAGIC = b"Obj\x01"
+SYNC_SIZE = 16
+
+
+class RecordingReader:
+    """Reads from a binary stream and keeps a copy of the bytes read."""
+
+    def __init__(self, fo):
+        self.fo = fo
+        self.recorded = bytearray()
+
+    def read(self, size):
+        data = self.fo.read(size)
+        self.recorded += data
+        return data
+
+
+def _read_exactly(fo, size):
+    data = b""
+    while len(data) < size:
+        chunk = fo.read(size - len(data))
+        if not chunk:
+            raise EOFError("Unexpected end of Avro file")
+        data += chunk
+    return data
+
+
+def read_long(fo):
+    """
+    Reads a zig-zag varint encoded long.
+
+    Returns:
+    - int: The value, or None at the end of the stream.
+    """
+    shift = 0
+    result = 0
+    while True:
+        byte = fo.read(1)
+        if not byte:
+            if shift == 0:
+                return None
+            raise EOFError("Unexpected end of Avro file")
+        b = byte[0]
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return (result >> 1) ^ -(result & 1)
+        shift += 7
+
+
+def encode_long(value):
+    """Encodes a long as a zig-zag varint."""
+    value = (value << 1) ^ (value >> 63)
+    out = bytearray()
+    while value & ~0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_header(fo):
+    """
+    Reads the header of an Avro file.
+
+    Returns:
+    - tuple: (header_bytes, metadata, sync_marker)
+    """
+    reader = RecordingReader(fo)
+    if _read_exactly(reader, 4) != MAGIC:
+        raise ValueError("Not an Avro file")
+    metadata = {}
+    while True:
+        count = read_long(reader)
+        if count == 0:
+            break
+        if count < 0:
+            count = -count
+            read_long(reader)  # block size in bytes
+        for _ in range(count):
+            key = _read_exactly(reader, read_long(reader)).decode()
+            metadata[key] = _read_exactly(reader, read_long(reader))
+    sync_marker = _read_exactly(reader, SYNC_SIZE)
+    return bytes(reader.recorded), metadata, sync_marker
+
+
+def iter_raw_blocks(fo, sync_marker):
+    """
+    Yields the raw (still compressed) blocks of an Avro file
+    positioned right after its header.
+
+    Yields:
+    - tuple: (record_count, block_bytes) where block_bytes is the block
+      exactly as stored in the file, sync marker included.
+    """
+    while True:
+        count = read_long(fo)
+        if count is None:
+            return
+        size = read_long(fo)
+        data = _read_exactly(fo, size)
+        if _read_exactly(fo, SYNC_SIZE) != sync_marker:
+            raise ValueError("Invalid sync marker in Avro file")
+        yield count, encode_long(count) + encode_long(size) + data + sync_marker
+
+
+def decode_block(header_bytes, block_bytes):
+    """
+    Decompresses and decodes one raw block.
+
+    Returns:
+    - list: The records in the block.
+    """
+    return list(fastavro.reader(BytesIO(header_bytes + block_bytes)))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_decode_pool(workers):
+    """
+    Returns the process pool used to decode compressed blocks,
+    creating it on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+    return _pool
+
+
+def shutdown_decode_pool():
+    """Stops the decode pool's worker processes, if any."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
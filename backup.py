@@ -0,0 +1,726 @@
+"""
+Streaming backup of tables to Avro files in GCS.
+
+Rows are read with a server-side cursor and fed straight to the Avro
+writer, which writes to a resumable upload. Peak memory is bounded by
+the batch size instead of the size of the table.
+
+Avro files are encoded with fastavro, with a selectable block codec
+(BACKUP_CODEC) and sync interval (BACKUP_SYNC_INTERVAL). Files written
+without a codec by earlier versions are still read as before.
+
+Restores stream the file from GCS in ranges and decode it block by block,
+in parallel across a process pool when the blocks are compressed,
+inserting the records in bounded chunks.
+
+A table can also be backed up in partitions (by primary-key range, or by
+month of the datetime column for hired_employees) written concurrently.
+Every backup writes its parts under its own prefix,
+backup/{table_name}/{backup_id}/, and then a manifest,
+backup/{table_name}_manifest.json, with the range, row count and SHA-256
+checksum of each part, so restores can read the parts in parallel as
+well. Writing the manifest switches restores to the new backup, so a
+backup that fails halfway leaves the previous one intact; the files of
+the previous one are deleted afterwards.
+
+{
+    "table": "hired_employees",
+    "backup_id": "20240301T120000000000",
+    "created_at": "2024-03-01T12:00:00+00:00",
+    "partition_by": "id",
+    "codec": "deflate",
+    "parts": [
+        {"file": "backup/hired_employees/20240301T120000000000/part-00000.avro",
+         "lower": 1, "upper": 1000, "rows": 1000, "bytes": 18034, "sha256": "..."}
+    ],
+    "watermark": {"id": 1000, "datetime": "2021-12-31T23:59:59+00:00", "revision": 1042},
+    "deltas": []
+}
+
+Incremental backups export only the rows inserted or updated since the
+last backup, those with a revision (see config.tables) above the
+watermark's, to backup/{table_name}/deltas/{backup_id}.avro and append
+them to "deltas". Ids are sent by clients and can be below the highest
+one backed up, so they cannot key deltas. Restores replay the deltas from
+the latest one back and then the base parts, skipping the ids already
+restored, so the latest version of every row wins.
+"""
+
+import json, logging, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+import fastavro
+import sqlalchemy
+from avro_blocks import decode_block, get_decode_pool, iter_raw_blocks, read_header
+from config import *
+from gcs import *
+from instrumentation import span, timed_iter, with_profile
+from reference_index import referenced_tables
+from utils import get_engine, insert_batch_data, iter_table_batches, record_commit
+
+logger = logging.getLogger(__name__)
+
+# "zstd" is accepted as an alias of fastavro's "zstandard"
+codecs = {
+    "null": "null",
+    "deflate": "deflate",
+    "snappy": "snappy",
+    "zstd": "zstandard",
+    "zstandard": "zstandard",
+}
+
+
+def backup_file_name(table_name):
+    return f"backup/{table_name}_backup.avro"
+
+
+def part_file_name(table_name, backup_id, index):
+    return f"backup/{table_name}/{backup_id}/part-{index:05d}.avro"
+
+
+def manifest_file_name(table_name):
+    return f"backup/{table_name}_manifest.json"
+
+
+def delta_file_name(table_name, backup_id):
+    return f"backup/{table_name}/deltas/{backup_id}.avro"
+
+
+def new_backup_id():
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+
+
+@lru_cache(maxsize=None)
+def load_schema(table_name):
+    """
+    Parses schemas/{table_name}.avsc once per process.
+
+    Returns:
+    - dict: The parsed Avro schema.
+    """
+    with open(f"schemas/{table_name}.avsc") as f:
+        return fastavro.parse_schema(json.load(f))
+
+
+def get_codec(codec):
+    """
+    Returns fastavro's name for the codec.
+
+    Raises:
+    - ValueError: If the codec is not supported.
+    """
+    if codec not in codecs:
+        raise ValueError(
+            f"Invalid codec {codec}. Please use one of {list(codecs)}"
+        )
+    return codecs[codec]
+
+
+def write_part(
+    table_name,
+    file_name,
+    where=None,
+    batch_size=BACKUP_BATCH_SIZE,
+    codec=BACKUP_CODEC,
+    sync_interval=BACKUP_SYNC_INTERVAL,
+    progress=None,
+):
+    """
+    Streams the rows of a table matching where into one Avro file in GCS.
+
+    progress, if given, is called after every batch with the number of
+    rows read and bytes written since the previous call.
+
+    Returns:
+    - dict: The file name, rows and bytes written, SHA-256 of the file,
+      and the watermark (highest id and datetime) of the rows written.
+    """
+    stream = CountingWriter(open_blob_writer(file_name))
+    counter = {"rows": 0}
+    watermark = {"id": None, "datetime": None}
+    has_datetime = "datetime" in tables[table_name].c
+    bytes_reported = 0
+
+    def records():
+        nonlocal bytes_reported
+        batches = iter_table_batches(table_name, batch_size, where=where)
+        for batch in timed_iter("backup_read", batches):
+            if progress is not None:
+                # Bytes written so far belong to the previous batches
+                progress(len(batch), stream.bytes_written - bytes_reported)
+                bytes_reported = stream.bytes_written
+            counter["rows"] += len(batch)
+            # Batches come ordered by id
+            watermark["id"] = batch[-1]["id"]
+            if has_datetime:
+                latest = _json_value(max(row["datetime"] for row in batch))
+                watermark["datetime"] = max(watermark["datetime"] or latest, latest)
+            yield from batch
+
+    with span("backup_part"):
+        try:
+            fastavro.writer(
+                stream,
+                load_schema(table_name),
+                records(),
+                codec=get_codec(codec),
+                sync_interval=sync_interval,
+            )
+        except Exception:
+            stream.discard()
+            raise
+        stream.close()
+    if progress is not None:
+        progress(0, stream.bytes_written - bytes_reported)
+    return {
+        "file": file_name,
+        "rows": counter["rows"],
+        "bytes": stream.bytes_written,
+        "sha256": stream.sha256.hexdigest(),
+        "watermark": watermark,
+    }
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def merge_watermarks(*watermarks):
+    """
+    Combines watermarks into the highest id, datetime and revision among them.
+    """
+    merged = {"id": None, "datetime": None, "revision": None}
+    for watermark in watermarks:
+        for key in merged:
+            value = watermark.get(key)
+            if value is not None and (merged[key] is None or value > merged[key]):
+                merged[key] = value
+    return merged
+
+
+def _month_bounds(start, end):
+    """
+    First day of every month between two datetimes (ISO strings or datetime
+    objects), plus the first day of the month after the last one, as ISO
+    strings (read as UTC, see use_utc_sessions).
+    """
+    if isinstance(start, str):
+        year, month = int(start[:4]), int(start[5:7])
+    else:
+        year, month = start.year, start.month
+    if isinstance(end, str):
+        last = (int(end[:4]), int(end[5:7]))
+    else:
+        last = (end.year, end.month)
+    bounds = []
+    while (year, month) <= last:
+        bounds.append(f"{year:04d}-{month:02d}-01T00:00:00")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    bounds.append(f"{year:04d}-{month:02d}-01T00:00:00")
+    return bounds
+
+
+def partition_ranges(table_name, partitions, partition_by="id"):
+    """
+    Splits a table into ranges that can be backed up independently.
+
+    Parameters:
+    - table_name (str): The name of the table to split.
+    - partitions (int): Number of primary-key ranges (partition_by="id").
+    - partition_by (str): "id" for equal primary-key ranges, or "month"
+      for one range per calendar month of the datetime column.
+
+    Returns:
+    - list: (lower, upper) tuples. Id ranges are inclusive,
+      month ranges include lower and exclude upper.
+    """
+    table = tables[table_name]
+    if partition_by == "id":
+        column = table.c.id
+    elif partition_by == "month" and "datetime" in table.c:
+        column = table.c.datetime
+    else:
+        raise ValueError(
+            f"Invalid partitioning {partition_by} for {table_name}. "
+            "Please use 'id', or 'month' for hired_employees"
+        )
+    with get_engine().connect() as connection:
+        low, high = connection.execute(
+            sqlalchemy.select(sqlalchemy.func.min(column), sqlalchemy.func.max(column))
+        ).one()
+    if low is None:
+        return []
+    if partition_by == "month":
+        bounds = _month_bounds(low, high)
+        return list(zip(bounds[:-1], bounds[1:]))
+    step = -(-(high - low + 1) // max(partitions, 1))
+    return [
+        (lower, min(lower + step - 1, high)) for lower in range(low, high + 1, step)
+    ]
+
+
+def _partition_condition(table_name, partition_by, lower, upper):
+    table = tables[table_name]
+    if partition_by == "month":
+        return (table.c.datetime >= lower) & (table.c.datetime < upper)
+    return table.c.id.between(lower, upper)
+
+
+def latest_revision(table_name):
+    """
+    Returns the highest revision of a table's rows, or None if it is empty.
+
+    Revisions are taken from the sequence before a writer commits, so on
+    Postgres the writers in progress are waited for (and new ones held
+    back) with a SHARE lock while it is read: every row up to the revision
+    returned is committed, and rows written later get higher ones.
+    """
+    with get_engine().begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(sqlalchemy.text(f"LOCK TABLE {table_name} IN SHARE MODE"))
+        return connection.execute(
+            sqlalchemy.select(sqlalchemy.func.max(tables[table_name].c.revision))
+        ).scalar()
+
+
+def _delete_superseded(table_name, previous):
+    """
+    Deletes the parts and deltas of the backup a new manifest replaced, or
+    the single file of a backup written before manifests existed. The new
+    backup is complete by then, so files that cannot be deleted are only
+    logged.
+    """
+    if previous is None:
+        files = [backup_file_name(table_name)]
+    else:
+        files = [part["file"] for part in previous["parts"] + previous.get("deltas", [])]
+    for file_name in files:
+        try:
+            if blob_exists(file_name):
+                delete_blob(file_name)
+        except Exception:
+            logger.warning("Could not delete superseded backup file %s", file_name, exc_info=True)
+
+
+def write_manifest(table_name, manifest):
+    writer = open_blob_writer(manifest_file_name(table_name), "application/json")
+    writer.write(json.dumps(manifest, indent=2).encode())
+    writer.close()
+
+
+def read_manifest(table_name):
+    """
+    Returns the manifest of the table's latest backup,
+    or None for backups written before manifests existed.
+    """
+    file_name = manifest_file_name(table_name)
+    if not blob_exists(file_name):
+        return None
+    with open_blob_reader(file_name) as f:
+        return json.loads(f.read())
+
+
+def _progress_reporter(progress, label=None):
+    """
+    Returns a thread-safe callback that adds up (rows, bytes) increments
+    from concurrent parts and calls progress with the running totals.
+    """
+    lock = threading.Lock()
+    status = {"rows": 0, "bytes": 0}
+
+    def report(rows, bytes_count):
+        with lock:
+            status["rows"] += rows
+            status["bytes"] += bytes_count
+            current = dict(status)
+        if label is not None:
+            logger.info("%s: %s", label, current)
+        if progress is not None:
+            progress(current)
+
+    return report
+
+
+# Backups of a table run one at a time, whether they were started by
+# /backup/{table_name}/ or by a job: both rewrite the table's manifest.
+# Reentrant, as an incremental backup falls back to a full one.
+_backup_locks = {table_name: threading.RLock() for table_name in tables}
+
+
+def _one_per_table(func):
+    @wraps(func)
+    def wrapper(table_name, *args, **kwargs):
+        # Unknown tables are rejected by func
+        with _backup_locks.get(table_name, nullcontext()):
+            return func(table_name, *args, **kwargs)
+
+    return wrapper
+
+
+@_one_per_table
+def stream_backup(
+    table_name,
+    batch_size=BACKUP_BATCH_SIZE,
+    codec=BACKUP_CODEC,
+    sync_interval=BACKUP_SYNC_INTERVAL,
+    partitions=1,
+    partition_by=None,
+    workers=BACKUP_WORKERS,
+    progress=None,
+):
+    """
+    Backs up a table to Avro files in GCS and writes its manifest.
+
+    Each partition (or the whole table, without partitioning) goes to
+    backup/{table_name}/{backup_id}/part-NNNNN.avro, and the partitions are
+    written concurrently by worker threads. The manifest is written once
+    every part is, and the files of the previous backup are deleted then.
+    A backup started while another one of the table runs waits for it.
+
+    Parameters:
+    - table_name (str): The name of the table to back up.
+    - batch_size (int): Number of rows held in memory at a time per worker.
+    - codec (str): Avro block codec: 'null', 'deflate', 'snappy' or 'zstd'.
+    - sync_interval (int): Approximate size in bytes of each Avro block.
+    - partitions (int): Number of primary-key ranges when partition_by is "id".
+    - partition_by (str, optional): "id" or "month" to back up in partitions.
+    - workers (int): Number of partitions written at the same time.
+    - progress (callable, optional): Called after every batch with a dict
+      of the rows read and bytes written so far.
+
+    Returns:
+    - dict: The manifest file name, rows and bytes written, the number of
+      parts and elapsed seconds.
+
+    Raises:
+    - ValueError: If the specified table, codec or partitioning does not exist.
+    """
+    if table_name not in tables.keys():
+        raise ValueError(f"Table {table_name} does not exist")
+    get_codec(codec)
+    start = time.perf_counter()
+    # Taken before the rows are read, so the next incremental backup
+    # exports every row written after it (and maybe some backed up here)
+    revision = latest_revision(table_name)
+    options = {
+        "batch_size": batch_size,
+        "codec": codec,
+        "sync_interval": sync_interval,
+        "progress": _progress_reporter(progress),
+    }
+
+    # The parts of each backup get their own prefix, so the previous backup
+    # stays intact until the new manifest replaces it
+    backup_id = new_backup_id()
+
+    if partition_by is None and partitions <= 1:
+        parts = [
+            dict(
+                write_part(table_name, part_file_name(table_name, backup_id, 0), **options),
+                lower=None,
+                upper=None,
+            )
+        ]
+    else:
+        partition_by = partition_by or "id"
+        ranges = partition_ranges(table_name, partitions, partition_by)
+
+        def backup_partition(index):
+            lower, upper = ranges[index]
+            where = _partition_condition(table_name, partition_by, lower, upper)
+            file_name = part_file_name(table_name, backup_id, index)
+            part = write_part(table_name, file_name, where, **options)
+            return dict(part, lower=lower, upper=upper)
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            parts = list(executor.map(with_profile(backup_partition), range(len(ranges))))
+
+    watermark = merge_watermarks(
+        *(part.pop("watermark") for part in parts), {"revision": revision}
+    )
+    manifest = {
+        "table": table_name,
+        "backup_id": backup_id,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "partition_by": partition_by,
+        "codec": codec,
+        "parts": parts,
+        "watermark": watermark,
+        "deltas": [],
+    }
+    previous = read_manifest(table_name)
+    write_manifest(table_name, manifest)
+    _delete_superseded(table_name, previous)
+    return {
+        "file_name": manifest_file_name(table_name),
+        "parts": len(parts),
+        "rows": sum(part["rows"] for part in parts),
+        "bytes": sum(part["bytes"] for part in parts),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+@_one_per_table
+def stream_incremental_backup(
+    table_name,
+    batch_size=BACKUP_BATCH_SIZE,
+    codec=BACKUP_CODEC,
+    sync_interval=BACKUP_SYNC_INTERVAL,
+    progress=None,
+):
+    """
+    Backs up only the rows inserted or updated since the table's last backup.
+
+    Rows with a revision above the manifest's watermark are written to
+    backup/{table_name}/deltas/{backup_id}.avro, which is appended to the
+    manifest's deltas, and the watermark is moved forward. Without a
+    previous manifest, or with one written before rows had revisions, a
+    full backup is taken instead. Like full backups, it waits for any
+    other backup of the table to finish.
+
+    Parameters:
+    - table_name (str): The name of the table to back up.
+    - batch_size (int): Number of rows held in memory at a time.
+    - codec (str): Avro block codec: 'null', 'deflate', 'snappy' or 'zstd'.
+    - sync_interval (int): Approximate size in bytes of each Avro block.
+    - progress (callable, optional): Called after every batch with a dict
+      of the rows read and bytes written so far.
+
+    Returns:
+    - dict: The manifest file name, rows and bytes written, the number of
+      files written and elapsed seconds.
+
+    Raises:
+    - ValueError: If the specified table or codec does not exist.
+    """
+    if table_name not in tables.keys():
+        raise ValueError(f"Table {table_name} does not exist")
+    manifest = read_manifest(table_name)
+    if manifest is None or "revision" not in (manifest.get("watermark") or {}):
+        return stream_backup(
+            table_name,
+            batch_size=batch_size,
+            codec=codec,
+            sync_interval=sync_interval,
+            progress=progress,
+        )
+    get_codec(codec)
+    start = time.perf_counter()
+    watermark = manifest["watermark"]
+    lower, upper = watermark["revision"], latest_revision(table_name)
+    if upper is None or (lower is not None and upper <= lower):
+        return {
+            "file_name": manifest_file_name(table_name),
+            "parts": 0,
+            "rows": 0,
+            "bytes": 0,
+            "seconds": time.perf_counter() - start,
+        }
+    revision = tables[table_name].c.revision
+    where = revision <= upper
+    if lower is not None:
+        where = where & (revision > lower)
+
+    file_name = delta_file_name(table_name, new_backup_id())
+    delta = write_part(
+        table_name,
+        file_name,
+        where,
+        batch_size=batch_size,
+        codec=codec,
+        sync_interval=sync_interval,
+        progress=_progress_reporter(progress),
+    )
+    manifest["watermark"] = merge_watermarks(
+        watermark, delta.pop("watermark"), {"revision": upper}
+    )
+    manifest["deltas"].append(
+        dict(
+            delta,
+            lower=lower,
+            upper=upper,
+            created_at=datetime.now(timezone.utc).isoformat(),
+        )
+    )
+    write_manifest(table_name, manifest)
+    return {
+        "file_name": manifest_file_name(table_name),
+        "parts": 1,
+        "rows": delta["rows"],
+        "bytes": delta["bytes"],
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def iter_backup_records(fo, workers=RESTORE_WORKERS):
+    """
+    Decodes an Avro file block by block as it is read.
+
+    Compressed blocks are decoded across a process pool, with at most
+    2 * workers blocks in flight, and yielded in file order.
+
+    Parameters:
+    - fo: A readable binary stream positioned at the start of the file.
+    - workers (int): Number of decoding processes, 1 to decode inline.
+
+    Yields:
+    - list: The records of one block.
+    """
+    header_bytes, metadata, sync_marker = read_header(fo)
+    codec = metadata.get("avro.codec", b"null").decode()
+    if codec == "null" or workers <= 1:
+        for _, block in iter_raw_blocks(fo, sync_marker):
+            yield decode_block(header_bytes, block)
+        return
+
+    pool = get_decode_pool(workers)
+    pending = deque()
+    for _, block in iter_raw_blocks(fo, sync_marker):
+        pending.append(pool.submit(decode_block, header_bytes, block))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def restore_part(
+    table_name, file_name, chunk_size=RESTORE_CHUNK_SIZE, progress=None, sha256=None
+):
+    """
+    Restores one Avro file, inserting its records chunk by chunk and
+    skipping the ids that already exist.
+
+    The file is streamed and decoded block by block. With a checksum, it
+    is hashed as it is read and its chunks are inserted in one transaction,
+    committed only once the whole file matched, so none of the records
+    of a corrupt file is restored.
+
+    Parameters:
+    - table_name (str): The name of the table to restore into.
+    - file_name (str): The Avro file in GCS.
+    - chunk_size (int): Number of records inserted at a time (and
+      committed at a time, without a checksum).
+    - progress (callable, optional): Called after every chunk with the
+      number of records and bytes it added.
+    - sha256 (str, optional): The expected SHA-256 of the file.
+
+    Returns:
+    - dict: The rows restored, bytes read and SHA-256 of the file.
+
+    Raises:
+    - ValueError: If the file does not match the checksum.
+    """
+    stream = CountingReader(open_blob_reader(file_name))
+    rows = 0
+    bytes_reported = 0
+    counts = {"inserted": 0, "updated": 0}
+    # The rows of a referenced table, recorded once committed
+    written = []
+
+    def flush(connection, records):
+        nonlocal rows, bytes_reported
+        chunk_counts = insert_batch_data(
+            table_name, records, on_conflict="skip", connection=connection
+        )
+        rows += len(records)
+        if connection is not None:
+            counts["inserted"] += chunk_counts["inserted"]
+            counts["updated"] += chunk_counts["updated"]
+            if table_name in referenced_tables:
+                written.extend(records)
+        if progress is not None:
+            progress(len(records), stream.bytes_read - bytes_reported)
+        bytes_reported = stream.bytes_read
+
+    def verify(error=None):
+        # The rest of the file, e.g. after a block that failed to decode
+        while stream.read(GCS_CHUNK_SIZE):
+            pass
+        if stream.sha256.hexdigest() != sha256:
+            raise ValueError(f"Checksum mismatch for {file_name}") from error
+
+    def restore(connection=None):
+        chunk = []
+        for records in timed_iter("restore_decode", iter_backup_records(stream)):
+            chunk.extend(records)
+            while len(chunk) >= chunk_size:
+                flush(connection, chunk[:chunk_size])
+                chunk = chunk[chunk_size:]
+        if chunk:
+            flush(connection, chunk)
+
+    try:
+        with span("restore_part"):
+            if sha256 is None:
+                restore()
+            else:
+                with get_engine().begin() as connection:
+                    try:
+                        restore(connection)
+                    except Exception as e:
+                        verify(e)
+                        raise
+                    verify()
+                record_commit(table_name, counts, written)
+    finally:
+        stream.close()
+    return {"rows": rows, "bytes": stream.bytes_read, "sha256": stream.sha256.hexdigest()}
+
+
+def stream_restore(
+    table_name, chunk_size=RESTORE_CHUNK_SIZE, progress=None, workers=BACKUP_WORKERS
+):
+    """
+    Restores a table from its latest backup in GCS.
+
+    The incremental deltas are replayed from the latest one back, then the
+    parts listed in the manifest are restored concurrently; rows whose id
+    was already restored (or exists) are skipped, so every row is restored
+    as of its latest backup. Every file is checked against its checksum.
+    Backups written before manifests existed are read from
+    backup/{table_name}_backup.avro.
+
+    Parameters:
+    - table_name (str): The name of the table to restore.
+    - chunk_size (int): Number of records inserted and committed at a time.
+    - progress (callable, optional): Called after every chunk with a dict
+      of the rows restored and bytes read so far.
+    - workers (int): Number of parts restored at the same time.
+
+    Returns:
+    - dict: The rows restored, bytes read, the number of parts
+      and elapsed seconds.
+
+    Raises:
+    - ValueError: If the specified table does not exist or a part does not
+      match its checksum.
+    """
+    if table_name not in tables.keys():
+        raise ValueError(f"Table {table_name} does not exist")
+    start = time.perf_counter()
+    manifest = read_manifest(table_name)
+    if manifest is None:
+        parts = [{"file": backup_file_name(table_name)}]
+        deltas = []
+    else:
+        parts = manifest["parts"]
+        deltas = manifest.get("deltas", [])
+
+    report = _progress_reporter(progress, f"Restoring {table_name}")
+
+    def restore(part):
+        return restore_part(table_name, part["file"], chunk_size, report, part.get("sha256"))
+
+    # The latest version of each row comes first
+    restored = [restore(delta) for delta in reversed(deltas)]
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(parts)), 1)) as executor:
+        restored += list(executor.map(with_profile(restore), parts))
+    return {
+        "rows": sum(part["rows"] for part in restored),
+        "bytes": sum(part["bytes"] for part in restored),
+        "parts": len(parts) + len(deltas),
+        "seconds": time.perf_counter() - start,
+    }
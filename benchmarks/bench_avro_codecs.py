@@ -0,0 +1,81 @@
+"""
+Compares Avro encode/decode throughput and file size per codec,
+with the pure-Python avro package as a baseline. No database is needed:
+
+python -m benchmarks.bench_avro_codecs --rows 100000
+"""
+
+import argparse, time
+from datetime import datetime, timezone
+from io import BytesIO
+import fastavro
+from avro import schema
+from avro.datafile import DataFileReader, DataFileWriter
+from avro.io import DatumReader, DatumWriter
+from backup import get_codec, load_schema
+from benchmarks.bench_bulk_load import generate_employees
+
+
+def bench_avro_package(records):
+    avro_schema = schema.parse(open("schemas/hired_employees.avsc").read())
+    start = time.perf_counter()
+    buffer = BytesIO()
+    writer = DataFileWriter(buffer, DatumWriter(), avro_schema)
+    for record in records:
+        writer.append(record)
+    writer.flush()
+    data = buffer.getvalue()
+    encode = time.perf_counter() - start
+    start = time.perf_counter()
+    reader = DataFileReader(BytesIO(data), DatumReader())
+    for _ in reader:
+        pass
+    decode = time.perf_counter() - start
+    return len(data), encode, decode
+
+
+def bench_fastavro(records, codec, sync_interval):
+    start = time.perf_counter()
+    buffer = BytesIO()
+    fastavro.writer(
+        buffer,
+        load_schema("hired_employees"),
+        records,
+        codec=get_codec(codec),
+        sync_interval=sync_interval,
+    )
+    data = buffer.getvalue()
+    encode = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in fastavro.reader(BytesIO(data)):
+        pass
+    decode = time.perf_counter() - start
+    return len(data), encode, decode
+
+
+def report(name, rows, size, encode, decode):
+    print(
+        f"{name:<20} {size / 1e6:8.2f} MB  "
+        f"encode {rows / encode:12,.0f} rows/s  decode {rows / decode:12,.0f} rows/s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--sync-interval", type=int, default=1024 * 1024)
+    parser.add_argument("--skip-baseline", action="store_true")
+    args = parser.parse_args()
+    # Rows as read from the database, with a TIMESTAMPTZ datetime
+    records = [
+        dict(x, datetime=datetime.fromisoformat(x["datetime"]).replace(tzinfo=timezone.utc))
+        for x in generate_employees(args.rows)
+    ]
+    if not args.skip_baseline:
+        report("avro (null)", args.rows, *bench_avro_package(records))
+    for codec in ["null", "deflate", "snappy", "zstd"]:
+        report(
+            f"fastavro ({codec})",
+            args.rows,
+            *bench_fastavro(records, codec, args.sync_interval),
+        )
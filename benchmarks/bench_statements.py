@@ -0,0 +1,95 @@
+"""
+Measures the per-call overhead of building statements, before and after
+the statement registry (table_statements.py):
+
+- insert: an executemany of a small batch, with the statement rebuilt
+  for each batch (before) or taken from the registry (after).
+- select: a read of a table reflected from the database on each call
+  (before) or with the registry's select (after).
+
+The batches conflict with rows that already exist, so the time measured
+is the statement overhead rather than the writes. It runs against an
+in-memory SQLite database, or another one with --database-url (the rows
+it inserts are left in the tables):
+
+python -m benchmarks.bench_statements --calls 2000 --rows 1 10 100
+"""
+
+import argparse, time
+import sqlalchemy
+from sqlalchemy import MetaData, Table
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.dialects.postgresql import insert
+from config import data_columns, tables
+from benchmarks.bench_bulk_load import generate_employees
+from table_statements import execute_statement, get_table_statements
+
+TABLE = "hired_employees"
+
+
+def insert_before(connection, batch):
+    table = tables[TABLE]
+    parameter_dict = {}
+    for column in [x.name for x in data_columns(table)]:
+        parameter_dict[column] = bindparam(column)
+    statement = insert(table).values(parameter_dict)
+    statement = statement.on_conflict_do_nothing(index_elements=["id"])
+    statement = statement.returning(table.c.datetime, table.c.department_id, table.c.job_id)
+    connection.execute(statement, batch).all()
+
+
+def insert_after(connection, batch):
+    execute_statement(connection, get_table_statements(TABLE).insert, batch).all()
+
+
+def select_before(connection, batch):
+    table = Table(TABLE, MetaData(), autoload_with=connection)
+    connection.execute(table.select().where(table.c.id == 0)).fetchall()
+
+
+def select_after(connection, batch):
+    table = tables[TABLE]
+    statement = get_table_statements(TABLE).select.where(table.c.id == 0)
+    execute_statement(connection, statement).fetchall()
+
+
+cases = {
+    "insert": (insert_before, insert_after),
+    "select": (select_before, select_after),
+}
+
+
+def timed(func, connection, batch, calls):
+    func(connection, batch)
+    start = time.perf_counter()
+    for _ in range(calls):
+        func(connection, batch)
+    return (time.perf_counter() - start) / calls
+
+
+def run(engine, calls, rows):
+    tables[TABLE].create(engine, checkfirst=True)
+    results = []
+    with engine.begin() as connection:
+        for n in rows:
+            batch = generate_employees(n)
+            insert_after(connection, batch)
+            for name, (before, after) in cases.items():
+                before_us = timed(before, connection, batch, calls) * 1e6
+                after_us = timed(after, connection, batch, calls) * 1e6
+                results.append((name, n, before_us, after_us))
+                print(
+                    f"{name:<7} {n:>5} rows  before {before_us:9.1f} us/call  "
+                    f"after {after_us:9.1f} us/call  ({before_us / after_us:4.1f}x)"
+                )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--database-url", help="Defaults to an in-memory SQLite database")
+    args = parser.parse_args()
+    engine = sqlalchemy.create_engine(args.database_url or "sqlite://")
+    run(engine, args.calls, args.rows)
@@ -0,0 +1,61 @@
+"""
+Measures rows/sec of both paths that run the rules of validation.py:
+
+- api: validate_batch over a list of dicts, as the batch endpoints do.
+- legacy: clean_chunk over a chunk of a headerless CSV, as clean_data and
+  the historical loader do (parsing the CSV included).
+
+It needs no database:
+
+python -m benchmarks.bench_validation --rows 10000 100000 1000000
+"""
+
+import argparse, io, time
+from collections import Counter
+import pandas as pd
+from benchmarks.bench_bulk_load import generate_employees
+from legacy_data_processing.clean_data import clean_chunk, read_csv
+from validation import validate_batch
+
+
+def legacy_csv(data):
+    """The rows as the historical CSVs store them, with a trailing Z."""
+    frame = pd.DataFrame(data)
+    frame["datetime"] += "Z"
+    return frame.to_csv(index=False, header=False).encode()
+
+
+def run_api(data):
+    accepted, _ = validate_batch("hired_employees", data)
+    return len(accepted)
+
+
+def run_legacy(csv):
+    chunk = read_csv(io.BytesIO(csv), "hired_employees")
+    return len(clean_chunk(chunk, "hired_employees", Counter()))
+
+
+def run(rows, repeat):
+    results = []
+    for n in rows:
+        data = generate_employees(n)
+        inputs = {"api": (run_api, data), "legacy": (run_legacy, legacy_csv(data))}
+        for path, (func, argument) in inputs.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                kept = func(argument)
+                timings.append(time.perf_counter() - start)
+            assert kept == n, f"{path} rejected {n - kept} valid rows"
+            elapsed = min(timings)
+            results.append((n, path, elapsed, n / elapsed))
+            print(f"{n:>9} rows  {path:<7} {elapsed:8.3f} s  {n / elapsed:12,.0f} rows/s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3, help="Best of this many runs")
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
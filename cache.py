@@ -0,0 +1,95 @@
+"""
+In-process result cache with write-driven invalidation.
+
+Each table has a version counter that the insert and restore paths bump.
+Cached results are keyed by the versions of the tables they were computed
+from, so a write makes every dependent entry unreachable without scanning
+the cache, and entries are evicted by LRU order or TTL.
+
+Versions are per process: with several API workers, another worker's
+writes are only seen once the entry's TTL expires.
+
+The cache is pluggable: any object with get(key) and set(key, value)
+can replace the default one with set_result_cache().
+"""
+
+import threading, time
+from collections import OrderedDict
+from config import RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache whose entries also expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+_table_versions = {}
+_versions_lock = threading.Lock()
+_result_cache = ResultCache()
+
+
+def bump_table_version(table_name):
+    """
+    Marks every cached result computed from the table as stale.
+    """
+    with _versions_lock:
+        _table_versions[table_name] = _table_versions.get(table_name, 0) + 1
+
+
+def table_versions(*table_names):
+    """
+    Returns the current versions of the tables, to be used in a cache key.
+    """
+    with _versions_lock:
+        return tuple(_table_versions.get(table_name, 0) for table_name in table_names)
+
+
+def get_result_cache():
+    return _result_cache
+
+
+def set_result_cache(cache):
+    """
+    Replaces the result cache, e.g. with a shared backend.
+
+    Parameters:
+    - cache: An object with get(key) and set(key, value) methods.
+    """
+    global _result_cache
+    _result_cache = cache
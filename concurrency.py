@@ -0,0 +1,84 @@
+"""
+Runs blocking calls off the event loop.
+
+The database driver, the GCS client and pandas are all synchronous, so
+handlers run them in worker threads. Each kind of resource has its own
+bounded limiter, so a burst of one kind of work (e.g. backups) queues
+behind its own limit instead of taking every thread and connection:
+
+- "db": queries and inserts, at most DB_THREADS at a time (by default
+  DB_POOL_SIZE + DB_MAX_OVERFLOW connections).
+- "cpu": validation and encoding, at most CPU_THREADS at a time.
+- "backup": backups and restores, which hold a connection and GCS
+  streams for a long time, at most BACKUP_THREADS at a time.
+
+Backup and restore partition workers, background jobs and reloads of the
+reference index take connections outside the "db" limiter. The pool can
+open DB_BACKGROUND_CONNECTIONS more connections for them (see config.py),
+so with the default sizes no thread waits for a connection to be returned.
+"""
+
+from functools import partial
+import anyio
+from config import BACKUP_THREADS, CPU_THREADS, DB_THREADS
+
+limits = {"db": DB_THREADS, "cpu": CPU_THREADS, "backup": BACKUP_THREADS}
+
+# Created on first use, as limiters need a running event loop
+_limiters = {}
+
+_DONE = object()
+
+
+def get_limiter(resource):
+    """
+    Returns the limiter of a kind of resource.
+
+    Raises:
+    - ValueError: If the resource is unknown.
+    """
+    if resource not in limits:
+        raise ValueError(f"Unknown resource {resource}")
+    if resource not in _limiters:
+        _limiters[resource] = anyio.CapacityLimiter(limits[resource])
+    return _limiters[resource]
+
+
+async def run_blocking(resource, func, *args, **kwargs):
+    """
+    Runs func(*args, **kwargs) in a worker thread, waiting for a free slot
+    of the resource's limiter first.
+
+    Returns:
+    - The return value of func.
+    """
+    return await anyio.to_thread.run_sync(
+        partial(func, *args, **kwargs), limiter=get_limiter(resource)
+    )
+
+
+async def iterate_blocking(resource, iterator):
+    """
+    Consumes a blocking iterator from worker threads, one item at a time.
+
+    Yields:
+    - The items of the iterator.
+    """
+    while True:
+        item = await run_blocking(resource, next, iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+def limiter_stats():
+    """
+    Borrowed and total slots per resource, for monitoring.
+    """
+    return {
+        resource: {
+            "borrowed": limiter.borrowed_tokens,
+            "total": limiter.total_tokens,
+        }
+        for resource, limiter in _limiters.items()
+    }
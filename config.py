@@ -1,7 +1,9 @@
-from sqlalchemy.dialects.postgresql import VARCHAR, INTEGER
-from sqlalchemy import MetaData, Table, Column
+from sqlalchemy.dialects.postgresql import BIGINT, VARCHAR, INTEGER, TIMESTAMP
+from sqlalchemy import DDL, MetaData, Table, Column, TypeDecorator, event
+from sqlalchemy.dialects import sqlite
 from pydantic import BaseModel, field_validator
 from datetime import datetime
+import os
 
 """
 Each Transaction class is a Pydantic model that represents a transaction. 
@@ -14,6 +16,7 @@ Main functionalities
 Store and validate employee transaction data.
 Ensure that all ids are positive integers and not empty.
 Validate that the datetime field is in the ISO datetime format.
+The datetime is stored as a UTC TIMESTAMPTZ (see migrations.py).
 """
 
 class EmployeeTransaction(BaseModel):
@@ -108,27 +111,203 @@ transactions = {
     "jobs": JobTransaction,
 }
 
+class SQLiteTimestamp(TypeDecorator):
+    """
+    TIMESTAMPTZ stand-in for a SQLite DATABASE_URL: accepts ISO strings
+    like Postgres does, stores them as ISO strings (so they compare like
+    timestamps) and returns datetime objects.
+    """
+
+    impl = sqlite.DATETIME(
+        storage_format="%(year)04d-%(month)02d-%(day)02dT%(hour)02d:%(minute)02d:%(second)02d",
+        regexp=r"(\d+)-(\d+)-(\d+)T(\d+):(\d+):(\d+)",
+    )
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return datetime.fromisoformat(value)
+        return value
+
 # Define a dictionary that maps table names to 
-# their corresponding SQLAlchemy table objects
+# their corresponding SQLAlchemy table objects,
+# matching the schema after the migrations in migrations.py.
+# Every row also has a revision, taken from the row_revision sequence
+# whenever it is inserted or updated, which incremental backups are keyed
+# on (see backup.py). It is not part of the rows sent to the API or backed up.
 tables = {"hired_employees": Table(
                                 "hired_employees",
                                 MetaData(),
                                 Column("id", INTEGER, primary_key=True),
                                 Column("name", VARCHAR(255)),
-                                Column("datetime", VARCHAR(255)),
+                                Column(
+                                    "datetime",
+                                    TIMESTAMP(timezone=True).with_variant(SQLiteTimestamp(), "sqlite"),
+                                ),
                                 Column("department_id", INTEGER),
                                 Column("job_id", INTEGER),
+                                Column("revision", BIGINT),
                                 ),
             "departments": Table(
                                 "departments",
                                 MetaData(),
                                 Column("id", INTEGER, primary_key=True),
                                 Column("department", VARCHAR(255)),
+                                Column("revision", BIGINT),
                                 ),
             "jobs": Table(
                                 "jobs",
                                 MetaData(),
                                 Column("id", INTEGER, primary_key=True),
                                 Column("job", VARCHAR(255)),
+                                Column("revision", BIGINT),
                                 ),
             }
+
+
+def data_columns(table):
+    """The columns of a table's rows, without the revision."""
+    return [x for x in table.columns if x.name != "revision"]
+
+
+def _revision_triggers(table):
+    """
+    A SQLite stand-in has no sequences: the row_revision sequence is a
+    one-row table there, which triggers increment to give the rows
+    inserted or updated their revision.
+    """
+    bump = (
+        "UPDATE row_revision SET value = value + 1; "
+        "UPDATE %(table)s SET revision = (SELECT value FROM row_revision) WHERE id = NEW.id;"
+    )
+    data = ", ".join(x.name for x in data_columns(table))
+    for statement in (
+        "CREATE TABLE IF NOT EXISTS row_revision (value INTEGER NOT NULL)",
+        "INSERT INTO row_revision SELECT 0 WHERE NOT EXISTS (SELECT * FROM row_revision)",
+        "CREATE INDEX %(table)s_revision_idx ON %(table)s (revision)",
+        f"CREATE TRIGGER %(table)s_revision_insert AFTER INSERT ON %(table)s BEGIN {bump} END",
+        f"CREATE TRIGGER %(table)s_revision_update AFTER UPDATE OF {data} ON %(table)s "
+        f"BEGIN {bump} END",
+    ):
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+
+for _table in tables.values():
+    _revision_triggers(_table)
+
+# Number of hires per year, quarter, department and job,
+# maintained by insert_batch_data (see aggregates.py)
+hiring_summary = Table(
+                        "hiring_summary",
+                        MetaData(),
+                        Column("year", INTEGER, primary_key=True),
+                        Column("quarter", INTEGER, primary_key=True),
+                        Column("department_id", INTEGER, primary_key=True),
+                        Column("job_id", INTEGER, primary_key=True),
+                        Column("hires", INTEGER, nullable=False),
+                        )
+
+# Database connection pool settings.
+# DATABASE_URL points the API at a local Postgres or SQLite stand-in
+# instead of the Cloud SQL instance.
+DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 2))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+
+# Worker threads that run blocking calls for the async handlers, per kind
+# of resource (see concurrency.py). DB_THREADS defaults to DB_POOL_SIZE +
+# DB_MAX_OVERFLOW, the connections of the pool kept for those threads
+# (see DB_BACKGROUND_CONNECTIONS for the others).
+DB_THREADS = int(os.environ.get("DB_THREADS", DB_POOL_SIZE + DB_MAX_OVERFLOW))
+CPU_THREADS = int(os.environ.get("CPU_THREADS", os.cpu_count() or 1))
+BACKUP_THREADS = int(os.environ.get("BACKUP_THREADS", 2))
+
+# Secret provider settings, see secret_provider.py
+GCP_PROJECT = os.environ.get("GOOGLE_CLOUD_PROJECT", "globant-api")
+SECRETS_BACKEND = os.environ.get("SECRETS_BACKEND", "secretmanager")
+SECRETS_FILE = os.environ.get("SECRETS_FILE", "secrets.json")
+SECRETS_TTL = float(os.environ.get("SECRETS_TTL", 3600))
+
+# Bulk load settings: "auto" uses COPY for batches of at least
+# COPY_MIN_ROWS rows when the driver supports it, "copy" or "executemany"
+# force one path.
+BULK_LOAD_METHOD = os.environ.get("BULK_LOAD_METHOD", "auto")
+COPY_MIN_ROWS = int(os.environ.get("COPY_MIN_ROWS", 1000))
+# What batch inserts do with rows whose id already exists by default:
+# "skip", "update" or "error" (see insert_batch_data)
+ON_CONFLICT = os.environ.get("ON_CONFLICT", "skip")
+
+# Number of NDJSON lines validated and committed at a time
+# by /batch-transactions/stream/{table_name}/
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 10000))
+# Longest NDJSON line accepted, in bytes, so a body without newlines
+# cannot be buffered whole
+STREAM_MAX_LINE_BYTES = int(os.environ.get("STREAM_MAX_LINE_BYTES", 1024 * 1024))
+
+# Minimum seconds between reloads of the department and job ids used to
+# check the references of hired_employees batches (see reference_index.py)
+REFERENCE_REFRESH_INTERVAL = float(os.environ.get("REFERENCE_REFRESH_INTERVAL", 5))
+
+# Responses of requests sent with an Idempotency-Key header: how many
+# are kept (least recently used first out) and for how many seconds
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", 10000))
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 24 * 3600))
+
+# Backup settings. GCS_LOCAL_DIR replaces the bucket with a local
+# directory (a fake GCS for development and benchmarks).
+GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME", "globant-data")
+GCS_LOCAL_DIR = os.environ.get("GCS_LOCAL_DIR")
+GCS_CHUNK_SIZE = int(os.environ.get("GCS_CHUNK_SIZE", 8 * 1024 * 1024))
+BACKUP_BATCH_SIZE = int(os.environ.get("BACKUP_BATCH_SIZE", 10000))
+# Avro block codec ("null", "deflate", "snappy" or "zstd")
+# and approximate block size in bytes
+BACKUP_CODEC = os.environ.get("BACKUP_CODEC", "deflate")
+BACKUP_SYNC_INTERVAL = int(os.environ.get("BACKUP_SYNC_INTERVAL", 1024 * 1024))
+# Partitions backed up or restored at the same time
+BACKUP_WORKERS = int(os.environ.get("BACKUP_WORKERS", 4))
+# Restore settings: records inserted per commit and
+# processes decoding compressed Avro blocks
+RESTORE_CHUNK_SIZE = int(os.environ.get("RESTORE_CHUNK_SIZE", 10000))
+RESTORE_WORKERS = int(os.environ.get("RESTORE_WORKERS", os.cpu_count() or 1))
+
+# Background jobs (see jobs.py): jobs run at the same time, and where their
+# status is kept, "memory" or "sqlite" (a SQLite file at JOB_STORE_PATH)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_STORE = os.environ.get("JOB_STORE", "memory")
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", "jobs.sqlite")
+# Seconds finished jobs are kept, and at most how many of them
+# the "memory" store keeps (oldest first out)
+JOB_TTL = float(os.environ.get("JOB_TTL", 24 * 3600))
+JOB_MAX_FINISHED = int(os.environ.get("JOB_MAX_FINISHED", 1000))
+
+# Connections taken outside the "db" limiter: the partitions of every
+# backup or restore running at once, from the endpoints (BACKUP_THREADS)
+# and from jobs (JOB_WORKERS), and a reload of the reference index. The
+# pool can open this many connections on top of DB_MAX_OVERFLOW.
+DB_BACKGROUND_CONNECTIONS = int(
+    os.environ.get(
+        "DB_BACKGROUND_CONNECTIONS", (BACKUP_THREADS + JOB_WORKERS) * BACKUP_WORKERS + 1
+    )
+)
+
+# Result cache for the metrics endpoints: maximum entries and seconds
+# an entry is served before it expires
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 128))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 300))
+
+# Metrics responses are fetched and streamed METRICS_BATCH_SIZE rows
+# at a time; results of up to METRICS_CACHE_MAX_ROWS rows are cached
+METRICS_BATCH_SIZE = int(os.environ.get("METRICS_BATCH_SIZE", 5000))
+METRICS_CACHE_MAX_ROWS = int(os.environ.get("METRICS_CACHE_MAX_ROWS", 100000))
+
+# Where the metrics endpoints read from: "summary" (the hiring_summary
+# table) or "raw" (aggregating hired_employees on every call)
+METRICS_SOURCE = os.environ.get("METRICS_SOURCE", "summary")
+
+# Instrumentation (see instrumentation.py): stage timings and row and byte
+# counters exposed on /metrics, and the per-request stage breakdown returned
+# to requests sent with an X-Profile header
+INSTRUMENTATION = os.environ.get("INSTRUMENTATION", "true").lower() == "true"
+REQUEST_PROFILING = os.environ.get("REQUEST_PROFILING", "false").lower() == "true"
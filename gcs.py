@@ -0,0 +1,167 @@
+"""
+Streaming access to the backup bucket.
+
+Blobs are written through a resumable upload and read with ranged requests,
+so callers can stream data without a local copy of the whole file.
+
+If the GCS_LOCAL_DIR environment variable is set, blobs are files under
+that directory instead (a local fake GCS for development and benchmarks).
+"""
+
+import hashlib, os
+from config import GCS_BUCKET_NAME, GCS_CHUNK_SIZE, GCS_LOCAL_DIR
+from instrumentation import inc, span
+
+
+def _local_path(blob_name):
+    path = os.path.join(GCS_LOCAL_DIR, GCS_BUCKET_NAME, blob_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+class LocalBlobWriter:
+    """
+    Writes a local blob to a temporary file that is renamed into place
+    on close(), so a failed backup never replaces a complete one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(f"{path}.partial", "wb")
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        os.replace(f"{self.path}.partial", self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(f"{self.path}.partial")
+
+
+def get_bucket():
+    """
+    Returns the backup bucket.
+    """
+    from google.cloud import storage
+
+    return storage.Client().bucket(GCS_BUCKET_NAME)
+
+
+def open_blob_writer(blob_name, content_type="application/octet-stream"):
+    """
+    Opens a binary stream that uploads to the blob as it is written.
+
+    Parameters:
+    - blob_name (str): The name of the blob, e.g. backup/jobs_backup.avro.
+
+    Returns:
+    - A writable binary file-like object. The upload is finalized on close();
+      a writer that is never closed leaves the existing blob untouched.
+    """
+    if GCS_LOCAL_DIR:
+        return LocalBlobWriter(_local_path(blob_name))
+    blob = get_bucket().blob(blob_name, chunk_size=GCS_CHUNK_SIZE)
+    return blob.open("wb", content_type=content_type, ignore_flush=True)
+
+
+def open_blob_reader(blob_name):
+    """
+    Opens a binary stream that downloads the blob in ranges as it is read.
+
+    Parameters:
+    - blob_name (str): The name of the blob, e.g. backup/jobs_backup.avro.
+
+    Returns:
+    - A readable binary file-like object.
+    """
+    if GCS_LOCAL_DIR:
+        return open(_local_path(blob_name), "rb")
+    blob = get_bucket().blob(blob_name, chunk_size=GCS_CHUNK_SIZE)
+    return blob.open("rb")
+
+
+def blob_exists(blob_name):
+    """
+    Whether the blob exists in the bucket.
+    """
+    if GCS_LOCAL_DIR:
+        return os.path.exists(_local_path(blob_name))
+    return get_bucket().blob(blob_name).exists()
+
+
+def delete_blob(blob_name):
+    """
+    Deletes the blob from the bucket.
+    """
+    if GCS_LOCAL_DIR:
+        os.remove(_local_path(blob_name))
+    else:
+        get_bucket().blob(blob_name).delete()
+
+
+class CountingWriter:
+    """
+    Wraps a binary writer and counts (and checksums) the bytes written through it.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.bytes_written = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.sha256.update(data)
+        inc("gcs_uploaded_bytes_total", len(data))
+        with span("gcs_upload"):
+            return self.writer.write(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def seekable(self):
+        return False
+
+    def readable(self):
+        return False
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        # Finalizes the upload, sending the last chunk
+        with span("gcs_upload"):
+            self.writer.close()
+
+    def discard(self):
+        """Abandons the upload without finalizing it."""
+        if hasattr(self.writer, "discard"):
+            self.writer.discard()
+
+
+class CountingReader:
+    """
+    Wraps a binary reader and counts (and checksums) the bytes read through it.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        with span("gcs_download"):
+            data = self.reader.read(size)
+        inc("gcs_downloaded_bytes_total", len(data))
+        self.bytes_read += len(data)
+        self.sha256.update(data)
+        return data
+
+    def close(self):
+        self.reader.close()
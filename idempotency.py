@@ -0,0 +1,94 @@
+"""
+Idempotency keys for batch ingestion.
+
+A client sends an Idempotency-Key header with a write; the first request
+with a key is processed and its response kept for IDEMPOTENCY_TTL
+seconds, so a retry with the same key gets the same response without the
+batch being validated or written again.
+
+Each key is bound to a fingerprint of its request (e.g. a hash of the
+table and rows): reusing a key for a different request is an error, as is
+sending a retry while the first request is still being processed.
+
+Keys are kept per process, like the result cache: with several API
+workers, a retry routed to another worker is processed again (which the
+skip and update conflict modes make harmless).
+"""
+
+import threading, time
+from collections import OrderedDict
+from config import IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL
+
+
+class KeyInProgress(Exception):
+    """A request with the key is still being processed."""
+
+
+class KeyMismatch(Exception):
+    """The key was used for a different request."""
+
+
+class IdempotencyStore:
+    """
+    Thread-safe store of responses by key, evicted by LRU order or TTL.
+    """
+
+    def __init__(self, maxsize=IDEMPOTENCY_MAX_KEYS, ttl=IDEMPOTENCY_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key: [fingerprint, response or None while in progress, expiry]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def begin(self, key, fingerprint):
+        """
+        Claims a key for a request, or returns the response of the
+        request that already used it.
+
+        Returns:
+        - The stored response, or None if the request must be processed
+          (then complete or abort must be called).
+
+        Raises:
+        - KeyInProgress: If a request with the key is being processed.
+        - KeyMismatch: If the key was used with another fingerprint.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._entries[key] = [fingerprint, None, now + self.ttl]
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                return None
+            self._entries.move_to_end(key)
+            if entry[0] != fingerprint:
+                raise KeyMismatch(f"Idempotency key {key} was used for a different request")
+            if entry[1] is None:
+                raise KeyInProgress(f"A request with idempotency key {key} is in progress")
+            return entry[1]
+
+    def complete(self, key, response):
+        """Stores the response of a claimed key."""
+        with self._lock:
+            if key in self._entries:
+                self._entries[key][1] = response
+                self._entries[key][2] = time.monotonic() + self.ttl
+
+    def abort(self, key):
+        """Releases a claimed key, e.g. after a failure, so it can be retried."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is None:
+                del self._entries[key]
+
+
+_store = IdempotencyStore()
+
+
+def get_idempotency_store():
+    """Returns the process-wide idempotency store."""
+    return _store
@@ -0,0 +1,270 @@
+"""
+Timings and counters of the hot paths, exposed on /metrics in the
+Prometheus text format.
+
+Code under a span (or a function decorated with timed) records its
+duration in the stage_duration_seconds histogram, labelled with the
+stage:
+
+- validate: validate_batch.
+- insert: insert_batch_data (batches, streams and restores).
+- db_checkout: waiting for a pooled connection, including opening and
+  pinging it.
+- db_connect: opening a Cloud SQL Connector connection.
+- backup_part, backup_read, gcs_upload: backing up a part, reading its
+  rows from the database and writing its bytes to GCS.
+- restore_part, restore_decode, gcs_download: restoring a part, reading
+  and decoding its Avro blocks and reading its bytes from GCS.
+
+Spans nest (e.g. a restore_part includes its inserts), so the stages of a
+request do not add up to its duration.
+
+When REQUEST_PROFILING is on, a request sent with an X-Profile header gets
+the time spent in each stage while it was processed in a Server-Timing
+response header. Streamed responses only include the stages that ran
+before the response started; the full breakdown is logged.
+
+With INSTRUMENTATION off, spans and counters do nothing.
+"""
+
+import bisect, logging, threading, time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from config import INSTRUMENTATION, REQUEST_PROFILING
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "gcp_data_api_"
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Name: (type, help)
+metric_help = {
+    "stage_duration_seconds": ("histogram", "Seconds spent in each stage."),
+    "rows_accepted_total": ("counter", "Rows that passed validation."),
+    "rows_rejected_total": ("counter", "Rows rejected by validation."),
+    "rows_inserted_total": ("counter", "Rows inserted."),
+    "rows_updated_total": ("counter", "Existing rows updated."),
+    "rows_duplicate_total": ("counter", "Rows skipped or left unchanged as duplicates."),
+    "gcs_uploaded_bytes_total": ("counter", "Bytes written to GCS."),
+    "gcs_downloaded_bytes_total": ("counter", "Bytes read from GCS."),
+}
+
+_lock = threading.Lock()
+# (name, labels): value
+_counters = {}
+# (name, labels): [count of each bucket, sum, count]
+_histograms = {}
+
+# Seconds per stage of the request being profiled, if any
+_profile = ContextVar("profile", default=None)
+
+_NULL_SPAN = nullcontext()
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Adds value to a counter."""
+    if not INSTRUMENTATION:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(stage, seconds):
+    """Records the duration of a stage."""
+    index = bisect.bisect_left(BUCKETS, seconds)
+    key = ("stage_duration_seconds", (("stage", stage),))
+    profile = _profile.get()
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        if index < len(BUCKETS):
+            histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+        if profile is not None:
+            profile[stage] = profile.get(stage, 0.0) + seconds
+
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def span(stage):
+    """
+    Context manager recording the time spent in its block as a stage.
+    """
+    if not INSTRUMENTATION:
+        return _NULL_SPAN
+    return _Span(stage)
+
+
+def timed(stage):
+    """
+    Decorator recording the time spent in every call of a function as a stage.
+    """
+
+    def decorator(func):
+        if not INSTRUMENTATION:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_iter(stage, iterator):
+    """
+    Yields the items of an iterator, recording the time spent getting
+    each of them as a stage.
+    """
+    if not INSTRUMENTATION:
+        yield from iterator
+        return
+    iterator = iter(iterator)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            observe(stage, time.perf_counter() - start)
+        yield item
+
+
+def with_profile(func):
+    """
+    Wraps a function so that, run in another thread (e.g. by a
+    ThreadPoolExecutor), its stages count towards the request that
+    submitted it.
+    """
+    profile = _profile.get()
+    if profile is None:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _profile.set(profile)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _profile.reset(token)
+
+    return wrapper
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def render(gauges=None):
+    """
+    The metrics in the Prometheus text exposition format.
+
+    Parameters:
+    - gauges (dict, optional): Current values to include,
+      {name: (help, {labels tuple: value})}.
+
+    Returns:
+    - str: The metrics.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: [list(x[0]), x[1], x[2]] for key, x in _histograms.items()}
+    lines = []
+    for name, (kind, help_text) in metric_help.items():
+        lines += [f"# HELP {PREFIX}{name} {help_text}", f"# TYPE {PREFIX}{name} {kind}"]
+        if kind == "counter":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+            continue
+        for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                bucket_labels = _format_labels(labels + (("le", bound),))
+                lines.append(f"{PREFIX}{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+    for name, (help_text, samples) in (gauges or {}).items():
+        lines += [f"# HELP {PREFIX}{name} {help_text}", f"# TYPE {PREFIX}{name} gauge"]
+        for labels, value in samples.items():
+            lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware returning the stage breakdown of requests sent with
+    an X-Profile header in a Server-Timing header, in milliseconds.
+    Other requests are passed through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            not REQUEST_PROFILING
+            or not INSTRUMENTATION
+            or scope["type"] != "http"
+            or not any(name == b"x-profile" for name, _ in scope["headers"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        profile = {}
+        token = _profile.set(profile)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                timings = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in profile.items()]
+                timings.append(f"total;dur={(time.perf_counter() - start) * 1000:.2f}")
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", ", ".join(timings).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _profile.reset(token)
+            logger.info(
+                "Profile of %s %s: %s (total %.2f ms)",
+                scope["method"],
+                scope["path"],
+                ", ".join(f"{stage} {seconds * 1000:.2f} ms" for stage, seconds in profile.items()),
+                (time.perf_counter() - start) * 1000,
+            )
@@ -0,0 +1,267 @@
+"""
+Background jobs for long operations (backups, restores and bulk loads).
+
+Submitting a job returns its id at once; a pool of JOB_WORKERS threads
+runs the work and records its status and progress (rows and bytes
+processed so far) in a job store, which GET /jobs/{job_id} reads.
+
+A job can be submitted with a coalesce key: while a queued or running job
+has the same key, submitting again returns that job instead of starting
+a duplicate (e.g. two backups of the same table racing on its manifest).
+
+Job stores:
+- "memory": a dict in the process, the default.
+- "sqlite": a SQLite file at JOB_STORE_PATH, so job status survives
+  restarts. Jobs that were queued or running when the process stopped
+  are marked as failed on startup, as their work is not resumed.
+
+Finished jobs (whose results may hold e.g. every rejected row of a batch)
+are deleted JOB_TTL seconds after they finish; the memory store also
+keeps at most JOB_MAX_FINISHED of them.
+"""
+
+import json, logging, sqlite3, threading, time, uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from config import JOB_MAX_FINISHED, JOB_STORE, JOB_STORE_PATH, JOB_TTL, JOB_WORKERS
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = ("queued", "running")
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class MemoryJobStore:
+    """
+    Keeps jobs in a dictionary. Finished jobs are evicted after ttl
+    seconds, or when more than max_finished have finished.
+    """
+
+    def __init__(self, ttl=JOB_TTL, max_finished=JOB_MAX_FINISHED):
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._jobs = {}
+        # id: expiry of the finished jobs, in the order they finished
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._finished:
+            job_id, expiry = next(iter(self._finished.items()))
+            if expiry >= now and len(self._finished) <= self.max_finished:
+                break
+            del self._finished[job_id]
+            self._jobs.pop(job_id, None)
+
+    def create(self, job):
+        with self._lock:
+            self._evict()
+            self._jobs[job["id"]] = dict(job)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            if job["status"] not in ACTIVE and job_id not in self._finished:
+                self._finished[job_id] = time.monotonic() + self.ttl
+                self._evict()
+
+    def get(self, job_id):
+        with self._lock:
+            self._evict()
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def find_active(self, coalesce_key):
+        with self._lock:
+            for job in self._jobs.values():
+                if job["coalesce_key"] == coalesce_key and job["status"] in ACTIVE:
+                    return dict(job)
+        return None
+
+
+class SQLiteJobStore:
+    """Keeps jobs as JSON documents in a SQLite table."""
+
+    def __init__(self, path=JOB_STORE_PATH, ttl=JOB_TTL):
+        self.ttl = ttl
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs "
+                "(id TEXT PRIMARY KEY, coalesce_key TEXT, status TEXT, data TEXT)"
+            )
+            # Work of a previous process is not resumed
+            for job_id, data in self._connection.execute(
+                "SELECT id, data FROM jobs WHERE status IN (?, ?)", ACTIVE
+            ).fetchall():
+                job = dict(
+                    json.loads(data),
+                    status="failed",
+                    error="Interrupted by a restart",
+                    finished_at=_now(),
+                )
+                self._write(job)
+
+    def _write(self, job):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO jobs (id, coalesce_key, status, data) VALUES (?, ?, ?, ?)",
+            (job["id"], job["coalesce_key"], job["status"], json.dumps(job, default=str)),
+        )
+
+    def create(self, job):
+        # finished_at is an ISO datetime in UTC, so they compare as strings
+        expired = (datetime.now(timezone.utc) - timedelta(seconds=self.ttl)).isoformat()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM jobs WHERE status NOT IN (?, ?) "
+                "AND json_extract(data, '$.finished_at') < ?",
+                (*ACTIVE, expired),
+            )
+            self._write(job)
+
+    def update(self, job_id, **fields):
+        with self._lock, self._connection:
+            (data,) = self._connection.execute(
+                "SELECT data FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            self._write(dict(json.loads(data), **fields))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def find_active(self, coalesce_key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM jobs WHERE coalesce_key = ? AND status IN (?, ?)",
+                (coalesce_key, *ACTIVE),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+
+job_stores = {"memory": MemoryJobStore, "sqlite": SQLiteJobStore}
+
+
+class JobQueue:
+    """
+    Runs submitted jobs on a pool of worker threads.
+
+    Parameters:
+    - store: A job store (MemoryJobStore or SQLiteJobStore).
+    - workers (int): Number of jobs run at the same time.
+    """
+
+    def __init__(self, store, workers=JOB_WORKERS):
+        self.store = store
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(workers, 1), thread_name_prefix="job"
+        )
+        self._submit_lock = threading.Lock()
+
+    def submit(self, kind, func, params=None, coalesce_key=None):
+        """
+        Queues func(progress=callback, **params).
+
+        Parameters:
+        - kind (str): The kind of job, e.g. "backup".
+        - func (callable): The work. It must accept a progress keyword,
+          a callable taking a dict of the rows and bytes processed so far.
+        - params (dict, optional): Keyword arguments for func, also
+          recorded in the job.
+        - coalesce_key (str, optional): Jobs with the same key are not run
+          concurrently; an active job with the key is returned instead.
+
+        Returns:
+        - tuple: (job, coalesced) where job is the job's record and
+          coalesced is True if an existing job was returned.
+        """
+        params = params or {}
+        with self._submit_lock:
+            if coalesce_key is not None:
+                active = self.store.find_active(coalesce_key)
+                if active is not None:
+                    return active, True
+            job = {
+                "id": uuid.uuid4().hex,
+                "kind": kind,
+                "params": params,
+                "coalesce_key": coalesce_key,
+                "status": "queued",
+                "progress": {"rows": 0, "bytes": 0},
+                "result": None,
+                "error": None,
+                "created_at": _now(),
+                "started_at": None,
+                "finished_at": None,
+            }
+            self.store.create(job)
+        self._executor.submit(self._run, job["id"], func, params)
+        return job, False
+
+    def _run(self, job_id, func, params):
+        self.store.update(job_id, status="running", started_at=_now())
+
+        def progress(current):
+            self.store.update(job_id, progress=dict(current))
+
+        try:
+            result = func(progress=progress, **params)
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            self.store.update(job_id, status="failed", error=str(e), finished_at=_now())
+        else:
+            self.store.update(
+                job_id, status="succeeded", result=result, finished_at=_now()
+            )
+
+    def get(self, job_id):
+        """Returns the job's record, or None if it does not exist."""
+        return self.store.get(job_id)
+
+    def shutdown(self):
+        """Cancels queued jobs and waits for the running ones."""
+        self._executor.shutdown(cancel_futures=True)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """
+    Returns the process-wide job queue, creating it on first use
+    with the JOB_STORE backend.
+
+    Raises:
+    - ValueError: If JOB_STORE is not a known backend.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            if JOB_STORE not in job_stores:
+                raise ValueError(
+                    f"Invalid job store {JOB_STORE}. Please use one of {list(job_stores)}"
+                )
+            _queue = JobQueue(job_stores[JOB_STORE]())
+    return _queue
+
+
+def shutdown_job_queue():
+    """Stops the job queue's workers, if it was started."""
+    global _queue
+    with _queue_lock:
+        if _queue is not None:
+            _queue.shutdown()
+            _queue = None
@@ -1,34 +1,182 @@
+"""
+Cleans the legacy csv files before they are loaded.
+
+Files are read in chunks of CLEAN_CHUNK_ROWS rows, so their size is not
+bound by memory, with the column names and types of their table in
+config.tables, and checked with the same compiled rules as the API
+(the "legacy" profile of validation.py). Each file is written to a
+temporary file next to its output, which replaces the output only once
+the whole file was cleaned: the source is never modified, and a crash
+leaves no half-written file.
+
+Independent files are cleaned in parallel in a pool of processes.
+
+Run it from the repository root so the shared modules can be imported:
+python -m legacy_data_processing.clean_data [--output-dir data/clean]
+
+Use --output-dir data to replace the source files once they are cleaned.
+"""
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import argparse, os, time
 import pandas as pd
-def clean_data():
+import sqlalchemy
+from config import data_columns, tables
+from validation import filter_frame
+
+# Rows of a CSV read and cleaned at a time
+CLEAN_CHUNK_ROWS = int(os.environ.get("CLEAN_CHUNK_ROWS", 100000))
+
+
+def id_columns(table_name):
+    """The names of the integer columns of a table."""
+    return [
+        column.name for column in data_columns(tables[table_name])
+        if isinstance(column.type, sqlalchemy.Integer)
+    ]
+
+
+def read_csv(source, table_name, chunk_rows=None):
+    """
+    Reads a headerless csv of a table with every column as a string.
+
+    Returns:
+        DataFrame, or an iterator of DataFrames if chunk_rows is set.
+    """
+    return pd.read_csv(
+        source,
+        header=None,
+        names=[column.name for column in data_columns(tables[table_name])],
+        dtype=str,
+        index_col=False,
+        chunksize=chunk_rows,
+    )
+
+
+def clean_chunk(chunk, table_name, dropped):
+    """
+    Drops the invalid rows of a chunk read as strings and casts the id
+    columns to integers.
+
+    Rows are checked with the legacy rules of validation.py, the ones
+    of the API except that datetimes end in a "Z".
+
+    Parameters:
+        chunk (DataFrame): Rows of a file, with every column as a string.
+        table_name (str): The table the rows belong to.
+        dropped (Counter): Incremented with the rows dropped per reason.
+
+    Returns:
+        DataFrame: The valid rows.
+    """
+    missing = chunk.isna().any(axis=1)
+    dropped["missing value"] += int(missing.sum())
+    chunk = chunk[~missing]
+    ids = id_columns(table_name)
+    chunk = chunk.assign(**{
+        name: pd.to_numeric(chunk[name], errors="coerce") for name in ids
+    })
+    chunk, invalid = filter_frame(table_name, chunk, profile="legacy")
+    dropped.update(invalid)
+    return chunk.astype({name: "int64" for name in ids})
+
+
+def clean_file(filename, input_dir="data", output_dir="data/clean", chunk_rows=CLEAN_CHUNK_ROWS):
+    """
+    Cleans a headerless csv file of a table, chunk by chunk.
+
+    Parameters:
+        filename (str): The name of the file, e.g. jobs.csv.
+        input_dir (str): The directory of the file.
+        output_dir (str): Where the cleaned file is written.
+        chunk_rows (int): Rows read and cleaned at a time.
+
+    Returns:
+        dict: The file name, rows read and kept, rows dropped per reason
+        and the seconds it took.
+    """
+    start = time.perf_counter()
+    table_name = filename.split(".")[0]
+    output = os.path.join(output_dir, filename)
+    temporary = os.path.join(output_dir, f".{filename}.tmp")
+    dropped = Counter()
+    rows = kept = 0
+    try:
+        with open(temporary, "w", newline="") as f:
+            for chunk in read_csv(os.path.join(input_dir, filename), table_name, chunk_rows):
+                rows += len(chunk)
+                chunk = clean_chunk(chunk, table_name, dropped)
+                kept += len(chunk)
+                chunk.to_csv(f, index=False, header=False)
+        os.replace(temporary, output)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return {
+        "file": filename,
+        "rows": rows,
+        "kept": kept,
+        "dropped": {reason: n for reason, n in dropped.items() if n},
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def clean_data(input_dir="data", output_dir="data/clean", workers=None, chunk_rows=CLEAN_CHUNK_ROWS):
     """
         Cleans the data in the legacy csv files.
 
         This performs the following cleaning operations:
         - Drops any rows with missing values
+        - Drops rows that break the rules of their table in
+          validation.py: ids must be positive integers, names not blank
+          and datetimes in the YYYY-MM-DDTHH:MM:SSZ format
         - Converts the id columns to integers
 
-        After cleaning the data, the function saves the 
-        cleaned data back to the respective CSV files.
+        Files of known tables are cleaned in parallel, each one
+        is written to output_dir once it is complete.
+
+        Parameters:
+            input_dir (str): The directory of the csv files.
+            output_dir (str): Where the cleaned files are written.
+            workers (int, optional): Processes cleaning files at the same
+            time, the number of CPUs by default.
+            chunk_rows (int): Rows read and cleaned at a time.
 
-        Note: This function assumes that the CSV files 
-        are located in the 'data' directory.
+        Returns:
+            list: The result of clean_file for each file.
 
         Example usage:
         clean_data()
     """
-    for file in os.listdir("data"):
-        if file.endswith(".csv"):
-            df = pd.read_csv(f"data/{file}")
-            df.dropna(inplace=True)
-            # convert id columns to integers
-            for col in df.columns:
-                if "id" in col:
-                    df[col] = df[col].astype(int)
-            df.to_csv(f"data/{file}", 
-                        index=False,
-                        sep=",", 
-                        header=None)
+    os.makedirs(output_dir, exist_ok=True)
+    files = sorted(
+        file for file in os.listdir(input_dir)
+        if file.endswith(".csv") and file.split(".")[0] in tables
+    )
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            clean_file,
+            files,
+            [input_dir] * len(files),
+            [output_dir] * len(files),
+            [chunk_rows] * len(files),
+        ))
+    for result in results:
+        reasons = ", ".join(f"{n} {reason}" for reason, n in result["dropped"].items())
+        print(
+            f"{result['file']}: kept {result['kept']} of {result['rows']} rows "
+            f"in {result['seconds']:.1f} s" + (f", dropped {reasons}" if reasons else "")
+        )
     print("Data cleaned successfully!")
+    return results
 
 if __name__ == "__main__":
-    clean_data()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--input-dir", default="data")
+    parser.add_argument("--output-dir", default="data/clean")
+    parser.add_argument("--workers", type=int, help="Files cleaned at the same time")
+    parser.add_argument("--chunk-rows", type=int, default=CLEAN_CHUNK_ROWS)
+    args = parser.parse_args()
+    clean_data(args.input_dir, args.output_dir, args.workers, args.chunk_rows)
@@ -1,70 +1,44 @@
 """
 This script is designed to load csv data (from a local source)
 into a GCP PostgresSQL database.
-"""
-
-from google.cloud import storage, secretmanager
-from google.cloud.sql.connector import Connector, IPTypes
-import subprocess, pg8000, sqlalchemy, os
 
+By default each CSV in data/ is streamed straight into Postgres with COPY,
+several files at a time, in chunks that are committed one by one. The
+offset of the last committed chunk of each file is kept in a state file,
+so a failed load resumes where it stopped (rows are inserted with
+ON CONFLICT DO NOTHING, so a chunk replayed after a crash is harmless).
 
-def retrieve_secret(secret_id, version_id="latest"):
-    client = secretmanager.SecretManagerServiceClient()
-    secret_version_name = (
-        f"projects/globant-api/secrets/{secret_id}/versions/{version_id}"
-    )
-    # Access the secret version
-    response = client.access_secret_version(name=secret_version_name)
-    # Return the secret payload
-    return response.payload.data.decode("UTF-8")
+With --method gcloud the files are uploaded to GCS and imported one by
+one with `gcloud sql import csv` instead.
 
+Run it from the repository root so the shared modules can be imported:
+python -m legacy_data_processing.load_historical_data [--workers 3] [--restart]
+"""
 
-def connect_with_connector() -> sqlalchemy.engine.base.Engine:
-    """
-    Initializes a connection pool for a Cloud SQL instance of Postgres.
-
-    Uses the Cloud SQL Python Connector package to connect to the database,
-    and the Secrets Manager to retrieve the database credentials.
-    """
+from google.cloud import storage
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import argparse, json, subprocess, sqlalchemy, os, threading, time
+from aggregates import rebuild_hiring_summary
+from config import tables
+from legacy_data_processing.clean_data import clean_chunk, read_csv
+from migrations import apply_migrations
+from utils import copy_into_table, get_engine
 
-    instance_connection_name = retrieve_secret("instance_connection_name")
-    db_user = retrieve_secret("db_user")
-    db_pass = retrieve_secret("db_pass")
-    db_name = retrieve_secret("db_name")
-
-    ip_type = IPTypes.PRIVATE if os.environ.get("PRIVATE_IP") else IPTypes.PUBLIC
-
-    # initialize Cloud SQL Python Connector object
-    connector = Connector()
-
-    def getconn() -> pg8000.dbapi.Connection:
-        conn: pg8000.dbapi.Connection = connector.connect(
-            instance_connection_name,
-            "pg8000",
-            user=db_user,
-            password=db_pass,
-            db=db_name,
-            ip_type=ip_type,
-        )
-        return conn
-
-    # The Cloud SQL Python Connector can be used with SQLAlchemy
-    # using the 'creator' argument to 'create_engine'
-    pool = sqlalchemy.create_engine(
-        "postgresql+pg8000://",
-        creator=getconn,
-        # ...
-    )
-    return pool
+# Lines of a CSV loaded and committed at a time
+LOAD_CHUNK_ROWS = int(os.environ.get("LOAD_CHUNK_ROWS", 100000))
+LOAD_STATE_FILE = os.environ.get("LOAD_STATE_FILE", "data/.load_state.json")
 
 
 def create_tables():
     """
-    Creates tables in the database.
+    Creates tables in the database by applying the pending migrations.
 
     - hired_employees
     - departments
     - jobs
+    - hiring_summary
 
     Parameters:
         None
@@ -72,36 +46,7 @@ def create_tables():
     Returns:
         None
     """
-    pool = connect_with_connector()
-    with pool.connect() as db_conn:
-        # Create hired employees table
-        db_conn.execute(
-            sqlalchemy.text(
-                "CREATE TABLE IF NOT EXISTS hired_employees"
-                "( id INTEGER, name VARCHAR(255), "
-                "datetime VARCHAR(255) NOT NULL, department_id INTEGER NOT NULL, "
-                "job_id INTEGER NOT NULL,"
-                "PRIMARY KEY (id));"
-            )
-        )
-        # Create departments table
-        db_conn.execute(
-            sqlalchemy.text(
-                "CREATE TABLE IF NOT EXISTS departments"
-                "( id INTEGER, department VARCHAR(255), "
-                "PRIMARY KEY (id));"
-            )
-        )
-        # Create jobs table
-        db_conn.execute(
-            sqlalchemy.text(
-                "CREATE TABLE IF NOT EXISTS jobs"
-                "( id INTEGER, job VARCHAR(255), "
-                "PRIMARY KEY (id));"
-            )
-        )
-        db_conn.commit()
-        results = db_conn.execute(sqlalchemy.text("SELECT * FROM departments")).fetchall()
+    apply_migrations(get_engine())
 
 
 def cloud_sql_import(filename):
@@ -143,12 +88,128 @@ def load_data_to_storage(filename):
     blob = bucket.blob(filename)
     blob.upload_from_filename(f'data/{filename}')
 
+class LoadState:
+    """
+    Progress of each file, saved to a JSON file after every chunk.
+
+    A file's entry is only reused while the file keeps its size and
+    modification time, otherwise it is loaded again from the start.
+    """
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.files = {}
+        self._lock = threading.Lock()
+        if not restart and os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f)
+
+    def get(self, filename, stat):
+        entry = self.files.get(filename)
+        if entry is None or (entry["size"], entry["mtime"]) != (stat.st_size, stat.st_mtime):
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime, "offset": 0,
+                     "rows": 0, "inserted": 0, "dropped": {}, "done": False}
+        return dict(entry)
+
+    def save(self, filename, entry):
+        with self._lock:
+            self.files[filename] = dict(entry)
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(self.files, f, indent=2)
+            os.replace(f"{self.path}.tmp", self.path)
+
+
+def iter_chunks(f, chunk_rows):
+    """
+    Reads a binary file chunk_rows lines at a time.
+
+    Yields:
+    - tuple: (chunk bytes, file offset after the chunk)
+    """
+    while True:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) == chunk_rows:
+                break
+        if not lines:
+            return
+        yield b"".join(lines), f.tell()
+
+
+def copy_file(filename, state, chunk_rows=LOAD_CHUNK_ROWS):
+    """
+    Loads a headerless CSV from data/ into the table named after it
+    with COPY, chunk by chunk, resuming from the state's offset.
+
+    Each chunk is checked with clean_chunk, the rules of validation.py
+    shared with the API, and the rows that break them are skipped.
+
+    Parameters:
+        filename (str): The name of the CSV file, e.g. jobs.csv.
+        state (LoadState): Where the progress of the file is kept.
+        chunk_rows (int): Lines loaded and committed at a time.
+
+    Returns:
+        dict: The file's progress entry, with the rows copied and
+        inserted, and the seconds this run took.
+    """
+    table_name = filename.split(".")[0]
+    path = f"data/{filename}"
+    entry = state.get(filename, os.stat(path))
+    if entry["done"]:
+        return dict(entry, seconds=0.0, skipped=True)
+    dropped = Counter(entry.get("dropped", {}))
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        for chunk, offset in iter_chunks(f, chunk_rows):
+            frame = clean_chunk(read_csv(BytesIO(chunk), table_name), table_name, dropped)
+            stream = BytesIO(frame.to_csv(index=False, header=False).encode())
+            with get_engine().begin() as conn:
+                counts = copy_into_table(conn, table_name, stream)
+            entry.update(
+                offset=offset,
+                rows=entry["rows"] + counts["copied"],
+                inserted=entry["inserted"] + counts["inserted"],
+                dropped={reason: n for reason, n in dropped.items() if n},
+            )
+            state.save(filename, entry)
+    entry["done"] = True
+    state.save(filename, entry)
+    return dict(entry, seconds=time.perf_counter() - start, skipped=False)
+
+
+def copy_files(files, workers, state, chunk_rows=LOAD_CHUNK_ROWS):
+    """
+    Loads the files concurrently and prints rows/sec for each one.
+    """
+    def load(filename):
+        result = copy_file(filename, state, chunk_rows)
+        if result["skipped"]:
+            print(f"{filename}: already loaded, skipped")
+        else:
+            rate = result["rows"] / result["seconds"] if result["seconds"] else 0
+            reasons = ", ".join(f"{n} {reason}" for reason, n in result["dropped"].items())
+            print(
+                f"{filename}: {result['rows']} rows copied, {result['inserted']} inserted "
+                f"in {result['seconds']:.1f} s ({rate:,.0f} rows/s)"
+                + (f", dropped {reasons}" if reasons else "")
+            )
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return list(executor.map(load, files))
+
+
 """
 This function is the entry point of the script and performs the following tasks:
 1. Creates tables in the database using the 'create_tables' function.
-2. Retrieves a list of files from the 'data' directory.
-3. Loads each file to the Google Cloud Storage using the 'load_data_to_storage' function.
-4. Imports the data from each file into the Google Cloud SQL database using the 'cloud_sql_import' function.
+2. Retrieves the CSV files of known tables from the 'data' directory.
+3. With the copy method, loads the files concurrently using 'copy_files'.
+4. With the gcloud method, loads each file to the Google Cloud Storage using
+   the 'load_data_to_storage' function and imports it into the Google Cloud SQL
+   database using the 'cloud_sql_import' function.
 
 Parameters:
     None
@@ -157,13 +218,29 @@ Returns:
     None
 """
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--method", choices=["copy", "gcloud"], default="copy")
+    parser.add_argument("--workers", type=int, default=3, help="Files loaded at the same time")
+    parser.add_argument("--chunk-rows", type=int, default=LOAD_CHUNK_ROWS)
+    parser.add_argument("--state-file", default=LOAD_STATE_FILE)
+    parser.add_argument("--restart", action="store_true", help="Ignore the saved progress")
+    args = parser.parse_args()
     # Create tables in database
     create_tables()
-    files = os.listdir('data')
+    files = sorted(
+        file for file in os.listdir('data')
+        if file.endswith(".csv") and file.split(".")[0] in tables
+    )
+    if args.method == "copy":
+        state = LoadState(args.state_file, args.restart)
+        copy_files(files, args.workers, state, args.chunk_rows)
+        return
     # Load data to storage and then to database
     for file in files:
         load_data_to_storage(file)
         cloud_sql_import(file)
+    # gcloud imports bypass insert_batch_data, so backfill the summary
+    rebuild_hiring_summary(get_engine())
 
 if __name__ == '__main__':
     main()
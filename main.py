@@ -1,20 +1,155 @@
-from avro import schema, io, datafile
-from avro.datafile import DataFileReader, DataFileWriter
-from avro.io import DatumReader, DatumWriter
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from google.cloud import storage, secretmanager
-from io import BytesIO
-import pandas as pd
+from contextlib import asynccontextmanager
+from functools import partial
+from itertools import chain
+from typing import Optional
 from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.dialects.postgresql import insert
-import sqlalchemy
+import hashlib, json, sqlalchemy
 from config import *
 from utils import *
+from validation import validate_batch
+from backup import get_codec, stream_backup, stream_incremental_backup, stream_restore
+from avro_blocks import shutdown_decode_pool
+from metrics import (
+    DEPARTMENT_METRICS_COLUMNS,
+    EMPLOYEES_METRICS_COLUMNS,
+    department_metrics_query,
+    employees_metrics_query,
+    metrics_years,
+)
+from result_formats import encode_rows, formats, negotiate_format
+from concurrency import iterate_blocking, limiter_stats, run_blocking
+from jobs import get_job_queue, shutdown_job_queue
+from table_statements import compile_statements
+from reference_index import get_reference_index, load_reference_index
+from idempotency import KeyInProgress, KeyMismatch, get_idempotency_store
+from secret_provider import get_secret_provider, secret_stats
+from cache import get_result_cache
+from instrumentation import ProfilingMiddleware, render
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled engine per process, disposed on shutdown
+    get_secret_provider().start()
+    compile_statements(init_engine())
+    load_reference_index(get_engine())
+    yield
+    shutdown_job_queue()
+    shutdown_decode_pool()
+    dispose_engine()
+    get_secret_provider().stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ProfilingMiddleware)
+
+def request_fingerprint(*parts):
+    """
+    Hash of a request's parameters and body, which binds an
+    idempotency key to the request it was first used with.
+    """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class BodyDigest:
+    """
+    SHA-256 of a request body that is read as a stream, computed as the
+    handler consumes it.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.sha256 = hashlib.sha256()
+        self.consumed = False
+
+    async def stream(self):
+        """The body, chunk by chunk (request.stream() can be read once)."""
+        async for chunk in self.request.stream():
+            self.sha256.update(chunk)
+            yield chunk
+        self.consumed = True
+
+    async def hexdigest(self):
+        """The digest of the whole body, reading what is left of it."""
+        if not self.consumed:
+            async for _ in self.stream():
+                pass
+        return self.sha256.hexdigest()
+
+
+async def run_idempotent(key, fingerprint, handler, body=None):
+    """
+    Runs a handler once per Idempotency-Key: a retry with the key gets
+    the stored response, with an Idempotent-Replayed header, instead.
+    Failed requests are not stored, so they can be retried.
+
+    Parameters:
+    - key (str, optional): The Idempotency-Key header. Without it the
+      handler always runs.
+    - fingerprint (str): See request_fingerprint.
+    - handler: Coroutine function returning the response.
+    - body (BodyDigest, optional): For a body streamed by the handler,
+      which the fingerprint cannot include: its digest is stored with the
+      response, and a retry's body must match it.
+
+    Raises:
+    - HTTPException: 409 if a request with the key is in progress,
+      422 if the key was used for a different request.
+    """
+    if key is None:
+        return await handler()
+    store = get_idempotency_store()
+    try:
+        stored = store.begin(key, fingerprint)
+    except KeyInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except KeyMismatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if stored is not None:
+        status_code, content, body_digest = stored
+        if body is not None and await body.hexdigest() != body_digest:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Idempotency key {key} was used for a different request",
+            )
+        return JSONResponse(
+            status_code=status_code,
+            content=content,
+            headers={"Idempotent-Replayed": "true"},
+        )
+    try:
+        response = await handler()
+        body_digest = await body.hexdigest() if body is not None else None
+    except BaseException:
+        store.abort(key)
+        raise
+    if isinstance(response, JSONResponse):
+        store.complete(key, (response.status_code, json.loads(response.body), body_digest))
+    else:
+        store.complete(key, (200, jsonable_encoder(response), body_digest))
+    return response
+
+
+def add_counts(total, counts):
+    for name in ("inserted", "updated", "duplicates"):
+        total[name] = total.get(name, 0) + counts[name]
+    return total
 
-app = FastAPI()
 
 @app.post("/batch-transactions/")
-async def create_batch_transactions(batch_transaction: dict):
+async def create_batch_transactions(
+    batch_transaction: dict,
+    on_conflict: Optional[str] = None,
+    idempotency_key: Optional[str] = Header(None),
+):
     """
     Create batch transactions and insert them into the specified table.
 
@@ -23,13 +158,21 @@ async def create_batch_transactions(batch_transaction: dict):
       - "data" (list): A list of dictionaries representing individual transactions.
       - "table_name" (str): The name of the table to insert data into.
          Options are 'hired_employees', 'departments', or 'jobs'.
+    - on_conflict (str, optional): What to do with rows whose id already
+      exists: 'skip', 'update' or 'error'. Defaults to ON_CONFLICT.
+    - idempotency_key (str, optional): The Idempotency-Key header. A retry
+      with the same key and body returns the first response again.
 
     Returns:
-    - dict: A dictionary with a single key "message" and a value indicating
-            the success of the operation.
+    - dict: A dictionary with a key "message" indicating the success of the
+            operation, the number of rows "inserted", "updated" and the
+            "duplicates" skipped or left unchanged, and a key "rejected"
+            listing each non-conforming transaction with its index, the row
+            and the reasons it was rejected.
 
     Raises:
-    - HTTPException: If an invalid table name is provided.
+    - HTTPException: If an invalid table name or conflict mode is provided
+      (400), or if on_conflict is 'error' and a row already exists (409).
     """
     data = batch_transaction["data"]
     table_name = batch_transaction["table_name"]
@@ -38,161 +181,472 @@ async def create_batch_transactions(batch_transaction: dict):
             status_code=400,
             detail="Invalid table name. Please use 'hired_employees', 'departments', or 'jobs'",
         )
-    insert_data = []
-    not_conforming_transactions = []
-    for transaction in data:
+
+    async def handler():
+        insert_data, rejected = await run_blocking("cpu", validate_batch, table_name, data)
+        not_conforming_transactions = [rejection["row"] for rejection in rejected]
+
+        # Validate and insert batch data into the database
         try:
-            validate = transactions[table_name](**transaction)
-            insert_data.append(transaction)
-        except:
-            not_conforming_transactions.append(transaction)
-            continue
+            # Insert batch data into the database
+            counts = await run_blocking(
+                "db", insert_batch_data, table_name, insert_data, on_conflict=on_conflict
+            )
 
-    # Validate and insert batch data into the database
-    try:
-        # Insert batch data into the database
-        insert_batch_data(table_name, insert_data)
+            return {
+                "message": f"""Batch transactions for {table_name} inserted successfully, 
+                                non-conforming transactions: {not_conforming_transactions}""",
+                **counts,
+                "rejected": rejected,
+            }
+        except ConflictError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    fingerprint = idempotency_key and await run_blocking(
+        "cpu", request_fingerprint, batch_transaction, on_conflict
+    )
+    return await run_idempotent(idempotency_key, fingerprint, handler)
+
+
+@app.post("/batch-transactions/stream/{table_name}/")
+async def create_streamed_batch_transactions(
+    table_name: str,
+    request: Request,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+    on_conflict: Optional[str] = None,
+    idempotency_key: Optional[str] = Header(None),
+):
+    """
+    Stream batch transactions as NDJSON (application/x-ndjson) and insert
+    them into the specified table chunk by chunk.
+
+    The request body is read incrementally: every chunk_size lines are
+    validated, inserted and committed before the next ones are read,
+    so memory use does not depend on the size of the upload.
 
+    Parameters:
+    - table_name (str): The name of the table to insert data into.
+      Options are 'hired_employees', 'departments', or 'jobs'.
+    - chunk_size (int): Number of transactions validated and committed at a time.
+    - on_conflict (str, optional): 'skip', 'update' or 'error', see
+      /batch-transactions/.
+    - idempotency_key (str, optional): The Idempotency-Key header. A retry
+      with the key is not processed again: its body is only hashed, and
+      gets the first response if it is the same body, or 422 otherwise.
+
+    Returns:
+    - dict: The accepted and rejected counts, and the rows inserted,
+      updated and duplicated, per chunk and in total.
+      Lines that are not valid JSON objects count as rejected.
+
+    Raises:
+    - HTTPException: If an invalid table name, chunk size or conflict
+      mode is provided or a line is longer than STREAM_MAX_LINE_BYTES
+      (400), or if on_conflict is 'error' and a row already exists (409).
+      The chunks before the error stay committed.
+    """
+    if table_name not in transactions.keys():
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid table name. Please use 'hired_employees', 'departments', or 'jobs'",
+        )
+    if chunk_size <= 0:
+        raise HTTPException(status_code=400, detail="chunk_size must be a positive integer")
+
+    chunks = []
+    body = BodyDigest(request)
+
+    async def process(lines):
+        data, malformed = await run_blocking("cpu", parse_ndjson_lines, lines)
+        insert_data, rejected = await run_blocking("cpu", validate_batch, table_name, data)
+        counts = await run_blocking(
+            "db", insert_batch_data, table_name, insert_data, on_conflict=on_conflict
+        )
+        chunks.append(
+            {
+                "chunk": len(chunks),
+                "accepted": len(insert_data),
+                "rejected": len(rejected) + malformed,
+                **counts,
+            }
+        )
+
+    async def handler():
+        try:
+            lines = []
+            async for line in iter_ndjson_lines(body.stream(), STREAM_MAX_LINE_BYTES):
+                lines.append(line)
+                if len(lines) == chunk_size:
+                    await process(lines)
+                    lines = []
+            if lines:
+                await process(lines)
+        except ConflictError as e:
+            raise HTTPException(status_code=409, detail=f"Chunk {len(chunks)}: {e}")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        total = {}
+        for chunk in chunks:
+            add_counts(total, chunk)
         return {
-            "message": f"""Batch transactions for {table_name} inserted successfully, 
-                            non-conforming transactions: {not_conforming_transactions}"""
+            "message": f"Streamed transactions for {table_name} inserted in {len(chunks)} chunks",
+            "accepted": sum(chunk["accepted"] for chunk in chunks),
+            "rejected": sum(chunk["rejected"] for chunk in chunks),
+            **total,
+            "chunks": chunks,
         }
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+
+    fingerprint = request_fingerprint(table_name, chunk_size, on_conflict)
+    return await run_idempotent(idempotency_key, fingerprint, handler, body)
 
 
 @app.post("/backup/{table_name}/")
-async def backup_table(table_name: str):
-    try:
-        # Query data from the database
-        data = query_table(table_name)
+async def backup_table(
+    table_name: str,
+    codec: str = BACKUP_CODEC,
+    partitions: int = 1,
+    partition_by: Optional[str] = None,
+    incremental: bool = False,
+):
+    """
+    Back up a table to Avro files in GCS.
+
+    While another backup of the table runs, from this endpoint or from
+    /jobs/backup/, the backup waits for it to finish.
 
-        # Define AVRO schema
-        avro_schema = schema.parse(open(f"schemas/{table_name}.avsc").read())
+    Parameters:
+    - table_name (str): The name of the table to back up.
+    - codec (str): Avro block codec: 'null', 'deflate', 'snappy' or 'zstd'.
+    - partitions (int): Number of primary-key ranges backed up concurrently.
+    - partition_by (str, optional): 'id' to split by primary-key range,
+      or 'month' to split hired_employees by month of its datetime.
+    - incremental (bool): Only back up the rows added since the last backup.
+    """
+    try:
+        # Stream rows from the database into Avro files in GCS
+        if incremental:
+            backup = await run_blocking(
+                "backup", stream_incremental_backup, table_name, codec=codec
+            )
+        else:
+            backup = await run_blocking(
+                "backup",
+                stream_backup,
+                table_name,
+                codec=codec,
+                partitions=partitions,
+                partition_by=partition_by,
+            )
+        file_name = backup["file_name"]
 
-        columns = [x.name for x in avro_schema.fields]
-        data = pd.DataFrame.from_records(data, columns=columns)
-        data = data.to_dict(orient="records")
+        return {
+            "message": f"Backup for {table_name} completed successfully. Manifest uploaded to GCS: {file_name}",
+            "parts": backup["parts"],
+            "rows": backup["rows"],
+            "bytes": backup["bytes"],
+        }
+    except ValueError as e:
+        # An unknown table, codec or partitioning, like /jobs/backup/
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Serialize data to AVRO format
-        file_name = f"backup/{table_name}_backup.avro"
-        serialize_to_avro(data, avro_schema, file_name)
 
-        # Upload AVRO data to Google Cloud Storage
-        upload_to_gcs(file_name)
+@app.post("/restore-avro-data/{table_name}/")
+async def restore_avro_data_endpoint(
+    table_name: str, chunk_size: int = RESTORE_CHUNK_SIZE
+):
+    try:
+        # Stream the Avro file from GCS and insert it chunk by chunk
+        restore = await run_blocking(
+            "backup", stream_restore, table_name, chunk_size=chunk_size
+        )
 
         return {
-            "message": f"Backup for {table_name} completed successfully. File uploaded to GCS: {file_name}"
+            "message": f"Data for {table_name} restored successfully",
+            "rows": restore["rows"],
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/restore-avro-data/{table_name}/")
-async def restore_avro_data_endpoint(table_name: str):
+def load_batch(
+    table_name, data, on_conflict=None, chunk_size=STREAM_CHUNK_SIZE, progress=None
+):
+    """
+    Validates and inserts a batch chunk by chunk, for bulk load jobs.
+
+    Returns:
+    - dict: The number of accepted rows, of rows inserted, updated and
+      duplicated, and the rejected ones.
+    """
+    accepted = size = 0
+    counts = {"inserted": 0, "updated": 0, "duplicates": 0}
+    rejected = []
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        insert_data, chunk_rejected = validate_batch(table_name, chunk)
+        add_counts(counts, insert_batch_data(table_name, insert_data, on_conflict=on_conflict))
+        accepted += len(insert_data)
+        rejected += [dict(x, index=x["index"] + start) for x in chunk_rejected]
+        if progress is not None:
+            # The size of the rows as JSON, close to their share of the request
+            size += len(json.dumps(chunk))
+            progress({"rows": start + len(chunk), "bytes": size})
+    return {"accepted": accepted, **counts, "rejected": rejected}
+
+
+def job_response(job, coalesced):
+    return JSONResponse(
+        status_code=202,
+        content={
+            "job_id": job["id"],
+            "status": job["status"],
+            "coalesced": coalesced,
+            "url": f"/jobs/{job['id']}",
+        },
+    )
+
+
+@app.post("/jobs/backup/{table_name}/")
+async def submit_backup_job(
+    table_name: str,
+    codec: str = BACKUP_CODEC,
+    partitions: int = 1,
+    partition_by: Optional[str] = None,
+    incremental: bool = False,
+):
+    """
+    Queue a backup of a table, with the same options as /backup/{table_name}/.
+
+    While a backup of the table is queued or running, the existing job is
+    returned instead of starting another one.
+
+    Returns:
+    - dict: The job id and status, and whether an existing job was returned.
+    """
+    if table_name not in tables.keys():
+        raise HTTPException(status_code=400, detail=f"Table {table_name} does not exist")
     try:
-        if table_name not in tables.keys():
-            raise ValueError(f"Table {table_name} does not exist")
-        # Fetch Avro data from GCS
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket("globant-data")
-        file_name = f"backup/{table_name}_backup.avro"
-        blob = bucket.blob(file_name)
-        avro_data_bytes = BytesIO(blob.download_as_bytes())
-
-        avro_schema = schema.parse(open(f"schemas/{table_name}.avsc").read())
-
-        # Read avro data
-        reader = DatumReader(avro_schema)
-        avro_file_reader = DataFileReader(avro_data_bytes, reader)
-        avro_data = [record for record in avro_file_reader]
-        avro_file_reader.close()
-        insert_batch_data(table_name, avro_data)
-
-        return {"message": f"Data for {table_name} restored successfully"}
+        get_codec(codec)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if incremental:
+        func = stream_incremental_backup
+        params = {"table_name": table_name, "codec": codec}
+    else:
+        func = stream_backup
+        params = {
+            "table_name": table_name,
+            "codec": codec,
+            "partitions": partitions,
+            "partition_by": partition_by,
+        }
+    job, coalesced = get_job_queue().submit(
+        "backup", func, params, coalesce_key=f"backup:{table_name}"
+    )
+    return job_response(job, coalesced)
+
+
+@app.post("/jobs/restore/{table_name}/")
+async def submit_restore_job(table_name: str, chunk_size: int = RESTORE_CHUNK_SIZE):
+    """
+    Queue a restore of a table from its latest backup.
+    """
+    if table_name not in tables.keys():
+        raise HTTPException(status_code=400, detail=f"Table {table_name} does not exist")
+    job, coalesced = get_job_queue().submit(
+        "restore", stream_restore, {"table_name": table_name, "chunk_size": chunk_size}
+    )
+    return job_response(job, coalesced)
+
+
+@app.post("/jobs/batch-transactions/")
+async def submit_batch_job(
+    batch_transaction: dict,
+    on_conflict: Optional[str] = None,
+    idempotency_key: Optional[str] = Header(None),
+):
+    """
+    Queue a bulk load, with the same body, conflict modes and
+    Idempotency-Key header as /batch-transactions/ (a retry with the
+    key returns the job that was first queued).
+    The job's result lists the accepted, inserted, updated and
+    duplicated counts and the rejected rows.
+    """
+    data = batch_transaction["data"]
+    table_name = batch_transaction["table_name"]
+    if table_name not in transactions.keys():
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid table name. Please use 'hired_employees', 'departments', or 'jobs'",
+        )
+    if (on_conflict or ON_CONFLICT) not in conflict_modes:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid conflict mode {on_conflict}. Please use 'skip', 'update' or 'error'",
+        )
+
+    async def handler():
+        # The rows are passed to the job but not recorded in it
+        job, coalesced = get_job_queue().submit(
+            "batch-transactions",
+            partial(load_batch, data=data),
+            {"table_name": table_name, "on_conflict": on_conflict},
+        )
+        return job_response(job, coalesced)
+
+    fingerprint = idempotency_key and await run_blocking(
+        "cpu", request_fingerprint, batch_transaction, on_conflict
+    )
+    return await run_idempotent(idempotency_key, fingerprint, handler)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Status of a job: queued, running, succeeded or failed, with its
+    progress (rows and bytes processed so far), result or error.
+    """
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} does not exist")
+    return job
+
+
+async def metrics_response(name, query, columns, depends_on, config, format, accept):
+    """
+    Streams the result of a metrics statement for the requested years
+    in the negotiated format.
+
+    With a single year the year column is left out, as it is constant.
+    """
+    try:
+        years = metrics_years(config)
+        format_name = negotiate_format(format, accept)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    results = iter_cached_query_batches(
+        query, (name, tuple(years)), depends_on, (years,)
+    )
+    batches = results
+    if len(years) == 1:
+        columns = columns[1:]
+        batches = ([row[1:] for row in batch] for batch in results)
+    try:
+        # Runs the query (in a "db" slot, like every use of a connection)
+        # before the response starts, so database errors are still
+        # reported with a status code
+        first = await run_blocking("db", next, batches, [])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    media_type, extension = formats[format_name]
+    encoded = encode_rows(format_name, columns, chain([first], batches))
+
+    def close():
+        # Also when the client disconnected before the end of the stream
+        encoded.close()
+        results.close()
+
+    return StreamingResponse(
+        iterate_blocking("cpu", encoded),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}.{extension}"'},
+        background=BackgroundTask(close),
+    )
 
 
 @app.post("/employees_metrics/")
-async def get_employees_metrics(config: dict):
+async def get_employees_metrics(
+    config: dict, request: Request, format: Optional[str] = None
+):
     """
     Number of employees hired for each job and department in "year"
-    divided by quarter, ordered alphabetically by department and job.
-    """
-    file_name = config["file_name"]
-    year = config["year"]
-    query = sqlalchemy.text(
-        f"""
-            SELECT
-                department,
-                job,
-                COUNT(*) FILTER (WHERE DATE_PART('quarter', datetime::TIMESTAMP) = 1) AS Q1,
-                COUNT(*) FILTER (WHERE DATE_PART('quarter', datetime::TIMESTAMP) = 2) AS Q2,
-                COUNT(*) FILTER (WHERE DATE_PART('quarter', datetime::TIMESTAMP) = 3) AS Q3,
-                COUNT(*) FILTER (WHERE DATE_PART('quarter', datetime::TIMESTAMP) = 4) AS Q4
-            FROM
-                hired_employees h
-            JOIN departments d ON h.department_id = d.id
-            JOIN jobs j ON h.job_id = j.id
-            WHERE
-                EXTRACT(YEAR FROM datetime::DATE) = 2021
-            GROUP BY
-                department,
-                job
-            ORDER BY
-                department ASC,
-                job ASC;
-        """
+    (or in each of "years") divided by quarter, ordered alphabetically
+    by department and job.
+
+    The rows are streamed as CSV (default), NDJSON, Arrow IPC or Parquet,
+    chosen with ?format= or the Accept header.
+    """
+    return await metrics_response(
+        "employees_metrics",
+        employees_metrics_query(),
+        EMPLOYEES_METRICS_COLUMNS,
+        ("hired_employees", "departments", "jobs"),
+        config,
+        format,
+        request.headers.get("accept"),
     )
-    data = execute_query(query)
-    pd.DataFrame.from_records(
-        data, columns=["department", "job", "Q1", "Q2", "Q3", "Q4"]
-    ).to_csv(file_name, index=None)
-    return {"message": f"Employees metrics for {year} saved to {file_name}"}
 
 
 @app.post("/department_metrics/")
-async def get_department_metrics(config: dict):
-    year = config["year"]
-    file_name = config["file_name"]
-    query = sqlalchemy.text(
-        f"""
-            WITH department_stats AS (
-                SELECT
-                    d.id,
-                    COUNT(*) AS total_employees
-                FROM
-                    hired_employees h
-                JOIN departments d ON h.department_id = d.id
-                WHERE DATE_PART('year', datetime::TIMESTAMP) = 2021
-                GROUP BY d.id
-            ),
-            mean_stats AS (
-                SELECT
-                    AVG(total_employees) AS mean_employees
-                FROM
-                    department_stats
-            )
-            SELECT
-                d.id,
-                d.department,
-                ds.total_employees
-            FROM
-                department_stats ds
-            JOIN
-                departments d ON ds.id = d.id
-            JOIN
-                mean_stats ms ON 1 = 1
-            WHERE
-                ds.total_employees > ms.mean_employees
-            ORDER BY
-                ds.total_employees DESC;
-        """
+async def get_department_metrics(
+    config: dict, request: Request, format: Optional[str] = None
+):
+    """
+    Departments that hired more employees than the mean in "year"
+    (or in each of "years"), streamed like /employees_metrics/.
+    """
+    return await metrics_response(
+        "department_metrics",
+        department_metrics_query(),
+        DEPARTMENT_METRICS_COLUMNS,
+        ("hired_employees", "departments"),
+        config,
+        format,
+        request.headers.get("accept"),
     )
-    data = execute_query(query)
-    df = pd.DataFrame.from_records(
-        data, columns=["id", "department", "total_employees"]
+
+
+def current_gauges():
+    """
+    Current state of the worker thread limiters, connection pool, result
+    cache, reference index and secret cache, as gauges for /metrics.
+    """
+    limiters = limiter_stats()
+    pool = get_engine().pool
+    gauges = {
+        "limiter_borrowed": (
+            "Worker thread slots in use per resource.",
+            {(("resource", x),): stats["borrowed"] for x, stats in limiters.items()},
+        ),
+        "limiter_total": (
+            "Worker thread slots per resource.",
+            {(("resource", x),): stats["total"] for x, stats in limiters.items()},
+        ),
+        "result_cache": (
+            "Result cache hits, misses and entries.",
+            {(("value", x),): n for x, n in get_result_cache().stats().items()},
+        ),
+        "reference_ids": (
+            "Ids held in the reference index per table.",
+            {(("table", x),): n for x, n in get_reference_index().stats().items()},
+        ),
+    }
+    secrets = secret_stats()
+    if secrets:
+        gauges["secrets"] = (
+            "Secret cache hits, misses, refreshes, refresh errors and entries.",
+            {(("value", x),): n for x, n in secrets.items()},
+        )
+    if hasattr(pool, "checkedout"):
+        gauges["db_pool_checked_out"] = (
+            "Connections checked out of the pool.",
+            {(): pool.checkedout()},
+        )
+        gauges["db_pool_size"] = ("Connections the pool keeps open.", {(): pool.size()})
+    return gauges
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Stage timings, row and byte counters and the current state of the
+    process in the Prometheus text format (see instrumentation.py).
+    """
+    return PlainTextResponse(
+        render(current_gauges()), media_type="text/plain; version=0.0.4"
     )
-    df.to_csv(file_name, index=None)
-    return {"message": f"Department metrics for {year} saved to {file_name}"}
\ No newline at end of file
@@ -0,0 +1,203 @@
+"""
+SQL for the metrics endpoints.
+
+By default the metrics are read from the hiring_summary table
+(see aggregates.py), which is independent of the size of hired_employees.
+With METRICS_SOURCE=raw they aggregate hired_employees on every call.
+
+Every statement takes an array of years ($1) and computes all of them in
+a single pass, one result row per year and group. The raw statements
+select each year with a range on the indexed datetime column instead of
+extracting the year from every row. They are prepared once per database
+connection (see PreparedStatement in utils.py).
+"""
+
+from config import METRICS_SOURCE
+from utils import PreparedStatement
+
+# Rows of hired_employees hired in year y.year (UTC)
+YEAR_RANGE = """
+    h.datetime >= make_timestamptz(y.year, 1, 1, 0, 0, 0, 'UTC')
+    AND h.datetime < make_timestamptz(y.year + 1, 1, 1, 0, 0, 0, 'UTC')
+"""
+
+EMPLOYEES_METRICS_RAW = f"""
+    SELECT
+        y.year,
+        department,
+        job,
+        COUNT(*) FILTER (WHERE EXTRACT(QUARTER FROM h.datetime AT TIME ZONE 'UTC') = 1) AS Q1,
+        COUNT(*) FILTER (WHERE EXTRACT(QUARTER FROM h.datetime AT TIME ZONE 'UTC') = 2) AS Q2,
+        COUNT(*) FILTER (WHERE EXTRACT(QUARTER FROM h.datetime AT TIME ZONE 'UTC') = 3) AS Q3,
+        COUNT(*) FILTER (WHERE EXTRACT(QUARTER FROM h.datetime AT TIME ZONE 'UTC') = 4) AS Q4
+    FROM
+        unnest($1) AS y(year)
+    JOIN hired_employees h ON {YEAR_RANGE}
+    JOIN departments d ON h.department_id = d.id
+    JOIN jobs j ON h.job_id = j.id
+    GROUP BY
+        y.year,
+        department,
+        job
+    ORDER BY
+        y.year ASC,
+        department ASC,
+        job ASC
+"""
+
+EMPLOYEES_METRICS_SUMMARY = """
+    SELECT
+        s.year,
+        department,
+        job,
+        COALESCE(SUM(s.hires) FILTER (WHERE s.quarter = 1), 0) AS Q1,
+        COALESCE(SUM(s.hires) FILTER (WHERE s.quarter = 2), 0) AS Q2,
+        COALESCE(SUM(s.hires) FILTER (WHERE s.quarter = 3), 0) AS Q3,
+        COALESCE(SUM(s.hires) FILTER (WHERE s.quarter = 4), 0) AS Q4
+    FROM
+        hiring_summary s
+    JOIN departments d ON s.department_id = d.id
+    JOIN jobs j ON s.job_id = j.id
+    WHERE
+        s.year = ANY($1)
+    GROUP BY
+        s.year,
+        department,
+        job
+    HAVING
+        SUM(s.hires) > 0
+    ORDER BY
+        s.year ASC,
+        department ASC,
+        job ASC
+"""
+
+# Per-year hires by department, compared with the mean of that year
+DEPARTMENT_METRICS = """
+    WITH department_stats AS (
+        {department_stats}
+    ),
+    mean_stats AS (
+        SELECT
+            year,
+            AVG(total_employees) AS mean_employees
+        FROM
+            department_stats
+        GROUP BY year
+    )
+    SELECT
+        ds.year,
+        d.id,
+        d.department,
+        ds.total_employees
+    FROM
+        department_stats ds
+    JOIN
+        departments d ON ds.id = d.id
+    JOIN
+        mean_stats ms ON ds.year = ms.year
+    WHERE
+        ds.total_employees > ms.mean_employees
+    ORDER BY
+        ds.year ASC,
+        ds.total_employees DESC
+"""
+
+DEPARTMENT_METRICS_RAW = DEPARTMENT_METRICS.format(
+    department_stats=f"""
+        SELECT
+            y.year,
+            d.id,
+            COUNT(*) AS total_employees
+        FROM
+            unnest($1) AS y(year)
+        JOIN hired_employees h ON {YEAR_RANGE}
+        JOIN departments d ON h.department_id = d.id
+        GROUP BY y.year, d.id
+    """
+)
+
+DEPARTMENT_METRICS_SUMMARY = DEPARTMENT_METRICS.format(
+    department_stats="""
+        SELECT
+            s.year,
+            d.id,
+            SUM(s.hires) AS total_employees
+        FROM
+            hiring_summary s
+        JOIN departments d ON s.department_id = d.id
+        WHERE s.year = ANY($1)
+        GROUP BY s.year, d.id
+        HAVING SUM(s.hires) > 0
+    """
+)
+
+# Result columns of each statement, as (name, type) pairs
+EMPLOYEES_METRICS_COLUMNS = [
+    ("year", "int"),
+    ("department", "string"),
+    ("job", "string"),
+    ("Q1", "int"),
+    ("Q2", "int"),
+    ("Q3", "int"),
+    ("Q4", "int"),
+]
+
+DEPARTMENT_METRICS_COLUMNS = [
+    ("year", "int"),
+    ("id", "int"),
+    ("department", "string"),
+    ("total_employees", "int"),
+]
+
+statements = {
+    ("employees_metrics", "raw"): PreparedStatement(
+        "employees_metrics_raw", EMPLOYEES_METRICS_RAW, ["INTEGER[]"]
+    ),
+    ("employees_metrics", "summary"): PreparedStatement(
+        "employees_metrics_summary", EMPLOYEES_METRICS_SUMMARY, ["INTEGER[]"]
+    ),
+    ("department_metrics", "raw"): PreparedStatement(
+        "department_metrics_raw", DEPARTMENT_METRICS_RAW, ["INTEGER[]"]
+    ),
+    ("department_metrics", "summary"): PreparedStatement(
+        "department_metrics_summary", DEPARTMENT_METRICS_SUMMARY, ["INTEGER[]"]
+    ),
+}
+
+
+def metrics_years(config):
+    """
+    Reads the requested years from a metrics request body.
+
+    Parameters:
+    - config (dict): Contains "year" (one year) or "years" (a list of years).
+
+    Returns:
+    - list: The distinct years, sorted.
+
+    Raises:
+    - ValueError: If no year is given, or "years" is not a list of integers.
+    """
+    years = config.get("years", [config["year"]] if "year" in config else [])
+    if not isinstance(years, list) or not all(
+        isinstance(year, int) and not isinstance(year, bool) for year in years
+    ):
+        raise ValueError('"year" must be an integer and "years" a list of integers')
+    if not years:
+        raise ValueError("Please provide a year or a list of years")
+    return sorted(set(years))
+
+
+def employees_metrics_query():
+    """
+    Hires per department and job in each year, divided by quarter.
+    """
+    return statements[("employees_metrics", METRICS_SOURCE)]
+
+
+def department_metrics_query():
+    """
+    Departments that hired more employees than the mean in each year.
+    """
+    return statements[("department_metrics", METRICS_SOURCE)]
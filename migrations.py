@@ -0,0 +1,179 @@
+"""
+Database schema migrations.
+
+Migrations are applied in order, each in its own transaction, and recorded
+in the schema_migrations table so every one runs exactly once. A Postgres
+advisory lock keeps two processes from migrating at the same time.
+
+Apply the pending migrations, or list their status, with:
+python -m migrations upgrade
+python -m migrations status
+"""
+
+import sys
+import sqlalchemy
+from aggregates import SUMMARY_UPSERT_FROM
+
+# Arbitrary key for pg_advisory_xact_lock, shared by every migrating process
+MIGRATIONS_LOCK_ID = 4242
+
+# (version, description, statements)
+migrations = [
+    (
+        "0001",
+        "Create hired_employees, departments and jobs",
+        [
+            "CREATE TABLE IF NOT EXISTS hired_employees"
+            "( id INTEGER, name VARCHAR(255), "
+            "datetime VARCHAR(255) NOT NULL, department_id INTEGER NOT NULL, "
+            "job_id INTEGER NOT NULL,"
+            "PRIMARY KEY (id));",
+            "CREATE TABLE IF NOT EXISTS departments"
+            "( id INTEGER, department VARCHAR(255), "
+            "PRIMARY KEY (id));",
+            "CREATE TABLE IF NOT EXISTS jobs"
+            "( id INTEGER, job VARCHAR(255), "
+            "PRIMARY KEY (id));",
+        ],
+    ),
+    (
+        "0002",
+        "Create hiring_summary",
+        [
+            "CREATE TABLE IF NOT EXISTS hiring_summary"
+            "( year INTEGER, quarter INTEGER, department_id INTEGER, "
+            "job_id INTEGER, hires INTEGER NOT NULL, "
+            "PRIMARY KEY (year, quarter, department_id, job_id));",
+        ],
+    ),
+    (
+        "0003",
+        "Store hired_employees.datetime as TIMESTAMPTZ and index it and the join columns",
+        [
+            # Timestamps without a zone (the API format) and with a trailing Z
+            # (the legacy CSV format) are both UTC
+            "ALTER TABLE hired_employees ALTER COLUMN datetime TYPE TIMESTAMPTZ "
+            "USING (datetime::TIMESTAMP AT TIME ZONE 'UTC');",
+            "CREATE INDEX IF NOT EXISTS hired_employees_datetime_idx "
+            "ON hired_employees (datetime);",
+            "CREATE INDEX IF NOT EXISTS hired_employees_department_id_job_id_idx "
+            "ON hired_employees (department_id, job_id);",
+        ],
+    ),
+    (
+        "0004",
+        "Add a revision to every row, set on insert and update, for incremental backups",
+        [
+            "CREATE SEQUENCE IF NOT EXISTS row_revision;",
+            "CREATE OR REPLACE FUNCTION set_row_revision() RETURNS trigger AS $$ "
+            "BEGIN NEW.revision := nextval('row_revision'); RETURN NEW; END "
+            "$$ LANGUAGE plpgsql;",
+        ]
+        + [
+            statement
+            for table_name in ("hired_employees", "departments", "jobs")
+            for statement in (
+                # Existing rows are numbered as the table is rewritten
+                f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS "
+                "revision BIGINT NOT NULL DEFAULT nextval('row_revision');",
+                f"CREATE INDEX IF NOT EXISTS {table_name}_revision_idx "
+                f"ON {table_name} (revision);",
+                f"DROP TRIGGER IF EXISTS {table_name}_revision ON {table_name};",
+                f"CREATE TRIGGER {table_name}_revision BEFORE UPDATE ON {table_name} "
+                "FOR EACH ROW EXECUTE FUNCTION set_row_revision();",
+            )
+        ],
+    ),
+    (
+        "0005",
+        "Backfill hiring_summary from hired_employees",
+        [
+            # Rows loaded before the summary was maintained on insert are
+            # counted too, with writers held back as in rebuild_hiring_summary
+            "LOCK TABLE hired_employees IN SHARE MODE;",
+            "DELETE FROM hiring_summary;",
+            SUMMARY_UPSERT_FROM.format(source="hired_employees", hires="COUNT(*)"),
+        ],
+    ),
+]
+
+
+def _ensure_migrations_table(connection):
+    connection.execute(
+        sqlalchemy.text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations"
+            "( version VARCHAR(32) PRIMARY KEY, description VARCHAR(255), "
+            "applied_at TIMESTAMPTZ NOT NULL DEFAULT now());"
+        )
+    )
+
+
+def applied_migrations(connection):
+    """
+    Returns the versions already applied to the database.
+    """
+    _ensure_migrations_table(connection)
+    result = connection.execute(sqlalchemy.text("SELECT version FROM schema_migrations"))
+    return {row[0] for row in result}
+
+
+def apply_migrations(engine, target=None):
+    """
+    Applies every pending migration up to target, in order.
+
+    Parameters:
+    - engine (sqlalchemy.engine.base.Engine): The database to migrate.
+    - target (str, optional): The last version to apply. Defaults to all.
+
+    Returns:
+    - list: The versions applied.
+    """
+    applied = []
+    for version, description, statements in migrations:
+        if target is not None and version > target:
+            break
+        with engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.text("SELECT pg_advisory_xact_lock(:lock_id)"),
+                {"lock_id": MIGRATIONS_LOCK_ID},
+            )
+            if version in applied_migrations(connection):
+                continue
+            for statement in statements:
+                connection.execute(sqlalchemy.text(statement))
+            connection.execute(
+                sqlalchemy.text(
+                    "INSERT INTO schema_migrations (version, description) "
+                    "VALUES (:version, :description)"
+                ),
+                {"version": version, "description": description},
+            )
+        applied.append(version)
+    return applied
+
+
+def migration_status(engine):
+    """
+    Returns (version, description, applied) for every migration.
+    """
+    with engine.begin() as connection:
+        done = applied_migrations(connection)
+    return [
+        (version, description, version in done)
+        for version, description, _ in migrations
+    ]
+
+
+if __name__ == "__main__":
+    from utils import get_engine
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    if command == "upgrade":
+        target = sys.argv[2] if len(sys.argv) > 2 else None
+        applied = apply_migrations(get_engine(), target)
+        print(f"Applied migrations: {applied or 'none, database is up to date'}")
+    elif command == "status":
+        for version, description, done in migration_status(get_engine()):
+            print(f"{version} [{'x' if done else ' '}] {description}")
+    else:
+        raise SystemExit("Usage: python -m migrations [upgrade [target] | status]")
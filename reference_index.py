@@ -0,0 +1,130 @@
+"""
+In-process index of the ids of departments and jobs.
+
+hired_employees rows reference a department and a job, but the tables
+have no foreign keys, so a row with an unknown id would be inserted and
+then silently drop out of the metrics joins. validate_batch checks the
+references of a whole batch at once against this index (np.isin over
+sorted id arrays), so those rows are rejected before reaching the
+database.
+
+The index is loaded on startup and kept current by insert_batch_data,
+which adds the ids of every departments or jobs batch it writes
+(restores included). Writes made by other processes are picked up by
+reloading a table's ids when a batch references an unknown one, at most
+once every REFERENCE_REFRESH_INTERVAL seconds.
+
+Until a table's ids are loaded, every reference to it is accepted.
+"""
+
+import logging, threading, time
+import numpy as np
+import sqlalchemy
+from config import REFERENCE_REFRESH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Referencing table: {column: referenced table}
+references = {"hired_employees": {"department_id": "departments", "job_id": "jobs"}}
+
+referenced_tables = sorted({x for columns in references.values() for x in columns.values()})
+
+
+class ReferenceIndex:
+    """
+    Sorted arrays of the ids of each referenced table.
+    """
+
+    def __init__(self, refresh_interval=REFERENCE_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._engine = None
+        self._ids = {}
+        self._attempted_at = {}
+        self._lock = threading.Lock()
+        # One reload at a time, so reloads hold at most one connection
+        self._reload_lock = threading.Lock()
+
+    def load(self, engine, table_names=referenced_tables):
+        """
+        Reads the ids of the tables from the database. The engine is
+        kept to reload them later.
+        """
+        self._engine = engine
+        for table_name in table_names:
+            self._attempted_at[table_name] = time.monotonic()
+        with engine.connect() as connection:
+            for table_name in table_names:
+                ids = connection.execute(sqlalchemy.text(f"SELECT id FROM {table_name}")).scalars()
+                ids = np.unique(np.fromiter(ids, dtype=np.int64))
+                with self._lock:
+                    self._ids[table_name] = ids
+
+    def _refresh(self, table_name):
+        """
+        Reloads the ids of a table, unless that was tried less than
+        refresh_interval seconds ago.
+        """
+        last = self._attempted_at.get(table_name, float("-inf"))
+        if self._engine is None or time.monotonic() - last < self.refresh_interval:
+            return
+        # Batches checked during another reload use the ids loaded before
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self.load(self._engine, [table_name])
+        except sqlalchemy.exc.SQLAlchemyError:
+            logger.exception("Could not load the ids of %s", table_name)
+        finally:
+            self._reload_lock.release()
+
+    def add(self, table_name, ids):
+        """Adds ids written to a table."""
+        with self._lock:
+            if table_name in self._ids:
+                self._ids[table_name] = np.union1d(
+                    self._ids[table_name], np.asarray(ids, dtype=np.int64)
+                )
+
+    def contains(self, table_name, values):
+        """
+        Boolean array of the values that are ids of the table.
+
+        If some are not, and the table's ids were loaded more than
+        refresh_interval seconds ago, they are reloaded and checked again.
+        """
+        values = np.asarray(values, dtype=np.int64)
+        if table_name not in self._ids:
+            self._refresh(table_name)
+        ids = self._ids.get(table_name)
+        if ids is None:
+            return np.ones(len(values), dtype=bool)
+        found = np.isin(values, ids)
+        if not found.all():
+            self._refresh(table_name)
+            found = np.isin(values, self._ids[table_name])
+        return found
+
+    def stats(self):
+        """Number of ids per table, for monitoring."""
+        with self._lock:
+            return {table_name: len(ids) for table_name, ids in self._ids.items()}
+
+
+_index = ReferenceIndex()
+
+
+def get_reference_index():
+    """Returns the process-wide reference index."""
+    return _index
+
+
+def load_reference_index(engine):
+    """
+    Loads the process-wide index, called on application startup.
+    If the tables cannot be read (e.g. they do not exist yet), references
+    are not checked until a later attempt succeeds.
+    """
+    try:
+        _index.load(engine)
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.warning("Could not load the reference index, references are not checked")
@@ -28,3 +28,14 @@ if __name__ == "__main__":
     )
     print(response.status_code)
     print(response.json())
+
+    # Stream the same transactions as NDJSON, committing 1000 lines at a time
+    ndjson = "\n".join(json.dumps(row) for row in batch_transaction["data"])
+    response = requests.post(
+        f"{api_url}/batch-transactions/stream/{batch_transaction['table_name']}/",
+        params={"chunk_size": 1000},
+        data=ndjson.encode(),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    print(response.status_code)
+    print(response.json())
@@ -0,0 +1,197 @@
+"""
+Streaming encoders for query results.
+
+Results are encoded batch by batch as they are fetched, so a response
+never holds more than one encoded batch in memory:
+
+- csv: text/csv with a header row.
+- ndjson: application/x-ndjson, one JSON object per row.
+- arrow: the Arrow IPC streaming format, one record batch per batch.
+- parquet: one row group per batch, the footer is sent last.
+
+Arrow and Parquet need pyarrow, which is only imported when used.
+"""
+
+import csv, io, json
+
+# Format name: (media type, file extension)
+formats = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+# Column types, as names of pyarrow type factories
+arrow_types = {"int": "int64", "string": "string"}
+
+
+def _accepted_media_types(accept):
+    """
+    The media types of an Accept header, most preferred first: sorted by
+    their q-value (1 when missing), in header order on ties. Media types
+    with q=0, or a q-value that is not a number, are left out.
+    """
+    accepted = []
+    for media_range in (accept or "").split(","):
+        media_type, *params = [x.strip() for x in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type and quality > 0:
+            accepted.append((quality, media_type.lower()))
+    # sorted is stable, so ties keep the order of the header
+    return [media_type for _, media_type in sorted(accepted, key=lambda x: -x[0])]
+
+
+def negotiate_format(requested=None, accept=None):
+    """
+    Picks the response format from a ?format= parameter or an Accept header.
+
+    The Accept header's media types are tried by q-value, and the first
+    one that is a known format, or a wildcard, which picks csv, is used.
+
+    Parameters:
+    - requested (str, optional): A format name, which takes precedence.
+    - accept (str, optional): The Accept header of the request.
+
+    Returns:
+    - str: The format name, csv when nothing else matches.
+
+    Raises:
+    - ValueError: If the requested format is unknown or unavailable.
+    """
+    if requested is None:
+        media_formats = {media: name for name, (media, _) in formats.items()}
+        # Any format is acceptable for a wildcard, so the default is used
+        media_formats.update({"*/*": "csv", "text/*": "csv"})
+        requested = next(
+            (media_formats[media_type] for media_type in _accepted_media_types(accept)
+             if media_type in media_formats),
+            "csv",
+        )
+    if requested not in formats:
+        raise ValueError(
+            f"Invalid format {requested}. Please use one of {', '.join(formats)}"
+        )
+    if requested in ("arrow", "parquet"):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ValueError(f"The {requested} format requires pyarrow")
+    return requested
+
+
+class _ChunkSink(io.RawIOBase):
+    """Writable stream that keeps what was written until it is taken."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_csv(columns, batches):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow([name for name, _ in columns])
+    for batch in batches:
+        writer.writerows(batch)
+        yield out.getvalue().encode()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue().encode()
+
+
+def iter_ndjson(columns, batches):
+    names = [name for name, _ in columns]
+    for batch in batches:
+        yield "".join(
+            json.dumps(dict(zip(names, row)), default=str) + "\n" for row in batch
+        ).encode()
+
+
+def _arrow_schema(columns):
+    import pyarrow as pa
+
+    return pa.schema([(name, getattr(pa, arrow_types[kind])()) for name, kind in columns])
+
+
+def _record_batch(schema, batch):
+    import pyarrow as pa
+
+    return pa.record_batch(
+        [[row[i] for row in batch] for i in range(len(schema))], schema=schema
+    )
+
+
+def iter_arrow(columns, batches):
+    import pyarrow as pa
+
+    schema = _arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    for batch in batches:
+        writer.write_batch(_record_batch(schema, batch))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def iter_parquet(columns, batches):
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for batch in batches:
+        writer.write_batch(_record_batch(schema, batch))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+encoders = {
+    "csv": iter_csv,
+    "ndjson": iter_ndjson,
+    "arrow": iter_arrow,
+    "parquet": iter_parquet,
+}
+
+
+def encode_rows(format_name, columns, batches):
+    """
+    Encodes batches of rows in the format, as they are produced.
+
+    Parameters:
+    - format_name (str): One of csv, ndjson, arrow or parquet.
+    - columns (list): (name, type) pairs, with type "int" or "string".
+    - batches: Iterable of lists of row tuples.
+
+    Yields:
+    - bytes: The encoded response, chunk by chunk.
+    """
+    for chunk in encoders[format_name](columns, batches):
+        if chunk:
+            yield chunk
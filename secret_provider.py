@@ -0,0 +1,207 @@
+"""
+Shared secret provider.
+
+Secrets are fetched from a backend (Google Secret Manager, environment
+variables or a local JSON file) and cached in memory with a TTL.
+A background thread refreshes cached values before they expire,
+so requests never pay for a Secret Manager round-trip or client construction.
+
+The backend is selected with the SECRETS_BACKEND environment variable:
+- "secretmanager" (default): Google Secret Manager.
+- "env": environment variables named SECRET_<SECRET_ID>, e.g. SECRET_DB_USER.
+- "file": a JSON object {secret_id: value} read from SECRETS_FILE.
+"""
+
+import json, os, threading, time
+from config import GCP_PROJECT, SECRETS_BACKEND, SECRETS_FILE, SECRETS_TTL
+
+
+class SecretManagerBackend:
+    """Reads secrets from Google Secret Manager with a single shared client."""
+
+    def __init__(self, project=GCP_PROJECT):
+        self.project = project
+        self._client = None
+
+    def fetch(self, secret_id, version_id="latest"):
+        if self._client is None:
+            from google.cloud import secretmanager
+
+            self._client = secretmanager.SecretManagerServiceClient()
+        secret_version_name = (
+            f"projects/{self.project}/secrets/{secret_id}/versions/{version_id}"
+        )
+        # Access the secret version
+        response = self._client.access_secret_version(name=secret_version_name)
+        # Return the secret payload
+        return response.payload.data.decode("UTF-8")
+
+
+class EnvBackend:
+    """Reads secrets from environment variables, e.g. SECRET_DB_USER."""
+
+    def __init__(self, prefix="SECRET_"):
+        self.prefix = prefix
+
+    def fetch(self, secret_id, version_id="latest"):
+        name = f"{self.prefix}{secret_id.upper()}"
+        if name not in os.environ:
+            raise KeyError(f"Secret {secret_id} not found in environment ({name})")
+        return os.environ[name]
+
+
+class FileBackend:
+    """Reads secrets from a local JSON file mapping secret ids to values."""
+
+    def __init__(self, path=SECRETS_FILE):
+        self.path = path
+
+    def fetch(self, secret_id, version_id="latest"):
+        with open(self.path) as f:
+            secrets = json.load(f)
+        if secret_id not in secrets:
+            raise KeyError(f"Secret {secret_id} not found in {self.path}")
+        return secrets[secret_id]
+
+
+backends = {
+    "secretmanager": SecretManagerBackend,
+    "env": EnvBackend,
+    "file": FileBackend,
+}
+
+
+class SecretProvider:
+    """
+    In-memory TTL cache in front of a secret backend.
+
+    Parameters:
+    - backend: An object with a fetch(secret_id, version_id) method.
+    - ttl (float): Seconds a cached value is served before it expires.
+    - refresh_margin (float): Cached values are refreshed in the background
+        this many seconds before they expire.
+    """
+
+    def __init__(self, backend, ttl=SECRETS_TTL, refresh_margin=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh_margin = ttl / 5 if refresh_margin is None else refresh_margin
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, secret_id, version_id="latest"):
+        """
+        Returns the secret value, fetching it from the backend on a miss.
+        """
+        key = (secret_id, version_id)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and time.monotonic() < entry[1]:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        return self._fetch(key)
+
+    def _fetch(self, key):
+        value = self.backend.fetch(*key)
+        with self._lock:
+            self._cache[key] = (value, time.monotonic() + self.ttl)
+        return value
+
+    def refresh_expiring(self):
+        """
+        Re-fetches every cached secret that expires within refresh_margin.
+        A failed refresh keeps serving the old value until it expires.
+        """
+        deadline = time.monotonic() + self.refresh_margin
+        with self._lock:
+            expiring = [key for key, (_, expires) in self._cache.items() if expires <= deadline]
+        for key in expiring:
+            try:
+                self._fetch(key)
+                self.refreshes += 1
+            except Exception:
+                self.refresh_errors += 1
+
+    def start(self):
+        """Starts the background refresh thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            interval = max(self.refresh_margin / 2, 1)
+            while not self._stop.wait(interval):
+                self.refresh_expiring()
+
+        self._thread = threading.Thread(target=run, name="secret-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background refresh thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Returns the cache counters."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+                "cached": len(self._cache),
+            }
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_secret_provider() -> SecretProvider:
+    """
+    Returns the process-wide secret provider, configured from SECRETS_BACKEND.
+    """
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            if SECRETS_BACKEND not in backends:
+                raise ValueError(
+                    f"Invalid secrets backend {SECRETS_BACKEND}. "
+                    f"Please use one of {list(backends)}"
+                )
+            _provider = SecretProvider(backends[SECRETS_BACKEND]())
+    return _provider
+
+
+def secret_stats():
+    """
+    Returns the process-wide provider's cache counters, or an empty dict
+    when no secret was needed yet (e.g. with DATABASE_URL set).
+    """
+    with _provider_lock:
+        provider = _provider
+    return provider.stats() if provider is not None else {}
+
+
+def retrieve_secret(secret_id, version_id="latest"):
+    """
+    Retrieves a secret through the shared, cached secret provider.
+
+    Parameters:
+    - secret_id (str): The ID of the secret to retrieve.
+    - version_id (str, optional): The version of the secret to retrieve.
+        Defaults to "latest".
+
+    Returns:
+    - str: The secret payload data decoded as UTF-8.
+    """
+    return get_secret_provider().get(secret_id, version_id)
@@ -0,0 +1,217 @@
+"""
+Registry of the statements run against each table.
+
+The select, insert and upsert statements of every table in config.tables
+(and the SQL of the COPY path, for each conflict mode) are built once, when the module is
+imported, instead of on every batch or backup. compile_statements compiles
+them for the engine's dialect at startup, so a broken statement fails the
+startup rather than a request.
+
+Execute them with execute_statement: the compiled forms of the selects are
+kept in a dedicated compiled cache, which queries of other shapes cannot
+evict, from their first execution on. SQLAlchemy never caches the compiled
+form of a PostgreSQL INSERT ... ON CONFLICT (its postgresql.Insert opts out
+of the cache), so the inserts and upserts are compiled on every execution,
+but not rebuilt.
+"""
+
+from sqlalchemy import ARRAY, INTEGER, any_, literal_column, select, tuple_
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.dialects.postgresql import insert
+from config import data_columns, tables
+from aggregates import SUMMARY_UPSERT_FROM
+
+
+# How rows whose id already exists are handled
+conflict_modes = ("skip", "update", "error")
+
+
+class TableStatements:
+    """
+    The statements of a table.
+
+    Attributes:
+    - select: Every row, ordered by id.
+    - insert: INSERT ... ON CONFLICT (id) DO NOTHING, with a bound
+      parameter per column, for executemany.
+    - insert_strict: INSERT without ON CONFLICT, which fails on an
+      existing id.
+    - upsert: INSERT ... ON CONFLICT (id) DO UPDATE of the rows whose
+      values differ, also returning whether each row was inserted.
+    - select_existing: The returning columns of the rows with the given
+      ids, locked for update.
+    - lock_staged (str): Locks the rows whose ids are in the staging
+      table, in id order, before an update moves their summary counts.
+    - has_summary (bool): Whether writes must update hiring_summary.
+      The inserts return the id, then the (datetime, department_id,
+      job_id) of each row written if so.
+    - column_list (str): The columns, comma separated, for raw SQL.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = [x.name for x in data_columns(table)]
+        self.column_list = ", ".join(self.columns)
+        self.has_summary = "datetime" in table.c
+        returning = [table.c.id]
+        if self.has_summary:
+            returning += [table.c.datetime, table.c.department_id, table.c.job_id]
+        values_columns = [x for x in self.columns if x != "id"]
+        self.select = table.select().order_by(table.c.id)
+        values = insert(table).values({x: bindparam(x) for x in self.columns})
+        self.insert = values.on_conflict_do_nothing(index_elements=["id"]).returning(*returning)
+        self.insert_strict = values.returning(*returning)
+        self.upsert = values.on_conflict_do_update(
+            index_elements=["id"],
+            set_={x: values.excluded[x] for x in values_columns},
+            where=tuple_(*[table.c[x] for x in values_columns]).is_distinct_from(
+                tuple_(*[values.excluded[x] for x in values_columns])
+            ),
+        ).returning(*returning, literal_column("xmax = 0").label("inserted"))
+        self.select_existing = (
+            select(*returning)
+            .where(table.c.id == any_(bindparam("ids", type_=ARRAY(INTEGER))))
+            .with_for_update()
+        )
+        self.staging = f"staging_{table.name}"
+        # CREATE TABLE AS copies no constraints: rows that break the
+        # table's (e.g. a NULL datetime) are COPYed, and fail the
+        # INSERT ... SELECT into the table with the whole batch
+        self.create_staging = (
+            f"CREATE TEMP TABLE {self.staging} ON COMMIT DROP AS "
+            f"SELECT {self.column_list} FROM {table.name} WITH NO DATA"
+        )
+        self.drop_staging = f"DROP TABLE {self.staging}"
+        self.lock_staged = (
+            f"SELECT id FROM {table.name} WHERE id IN (SELECT id FROM {self.staging}) "
+            "ORDER BY id FOR UPDATE"
+        )
+        self._copy = {}
+        self.move = {mode: self._move(mode) for mode in conflict_modes}
+
+    def copy(self, null="\\N"):
+        """The COPY of CSV rows into the staging table."""
+        if null not in self._copy:
+            self._copy[null] = (
+                f"COPY {self.staging} ({self.column_list}) "
+                f"FROM STDIN WITH (FORMAT csv, NULL '{null}')"
+            )
+        return self._copy[null]
+
+    def _move(self, mode):
+        """
+        The INSERT ... SELECT of the staged rows, returning the number
+        of rows inserted and updated (and updating hiring_summary with
+        them for hired_employees) in a single statement.
+        """
+        name = self.table.name
+        summary = ", datetime, department_id, job_id" if self.has_summary else ""
+        statement = (
+            f"INSERT INTO {name} ({self.column_list}) "
+            f"SELECT {self.column_list} FROM {self.staging} "
+        )
+        if mode == "update":
+            values_columns = [x for x in self.columns if x != "id"]
+            # The last staged row of each id wins, as in the executemany path
+            statement = (
+                f"INSERT INTO {name} ({self.column_list}) "
+                f"SELECT DISTINCT ON (id) {self.column_list} FROM {self.staging} "
+                "ORDER BY id, ctid DESC "
+                "ON CONFLICT (id) DO UPDATE SET "
+                + ", ".join(f"{x} = EXCLUDED.{x}" for x in values_columns)
+                + f" WHERE ({', '.join(f'{name}.{x}' for x in values_columns)}) "
+                f"IS DISTINCT FROM ({', '.join(f'EXCLUDED.{x}' for x in values_columns)}) "
+                f"RETURNING id{summary}, xmax = 0 AS inserted"
+            )
+        elif mode == "skip":
+            statement += f"ON CONFLICT (id) DO NOTHING RETURNING id{summary}, TRUE AS inserted"
+        else:
+            statement += f"RETURNING id{summary}, TRUE AS inserted"
+        ctes = [f"written AS ({statement})"]
+        if self.has_summary and mode == "update":
+            # Every CTE sees the table as it was before the statement,
+            # so old holds the values the updated rows had. They are not
+            # locked here: written may update them before old is read, and
+            # FOR UPDATE skips the rows the statement itself updated.
+            # copy_into_table runs lock_staged first instead
+            ctes.insert(
+                0,
+                f"old AS (SELECT id{summary} FROM {name} "
+                f"WHERE id IN (SELECT id FROM {self.staging}))",
+            )
+            ctes += [
+                "changes AS ("
+                "SELECT datetime, department_id, job_id, 1 AS hires FROM written "
+                "UNION ALL "
+                "SELECT o.datetime, o.department_id, o.job_id, -1 FROM old o "
+                "JOIN written w ON w.id = o.id WHERE NOT w.inserted)",
+                f"summary AS ({SUMMARY_UPSERT_FROM.format(source='changes', hires='SUM(hires)')})",
+            ]
+        elif self.has_summary:
+            # Only the rows actually inserted are counted in hiring_summary
+            ctes.append(
+                f"summary AS ({SUMMARY_UPSERT_FROM.format(source='written', hires='COUNT(*)')})"
+            )
+        return (
+            f"WITH {', '.join(ctes)} "
+            "SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) "
+            "FROM written"
+        )
+
+    def statements(self):
+        """The SQLAlchemy statements, by name."""
+        return {
+            "select": self.select,
+            "insert": self.insert,
+            "insert_strict": self.insert_strict,
+            "upsert": self.upsert,
+            "select_existing": self.select_existing,
+        }
+
+
+registry = {table_name: TableStatements(table) for table_name, table in tables.items()}
+
+# Compiled forms of the registry's selects, one per statement, dialect
+# and parameter shape, so it stays small
+compiled_cache = {}
+
+
+def get_table_statements(table_name):
+    """
+    Returns the TableStatements of a table.
+
+    Raises:
+    - ValueError: If the specified table does not exist.
+    """
+    if table_name not in registry:
+        raise ValueError(f"Table {table_name} does not exist")
+    return registry[table_name]
+
+
+def execute_statement(connection, statement, parameters=None):
+    """
+    Executes a registry statement with the registry's compiled cache.
+
+    Returns:
+    - sqlalchemy.engine.CursorResult: The result of the statement.
+    """
+    return connection.execute(
+        statement, parameters, execution_options={"compiled_cache": compiled_cache}
+    )
+
+
+def compile_statements(engine):
+    """
+    Compiles every statement of the registry for the engine's dialect,
+    so one that cannot be compiled fails the startup. Called on
+    application startup. The compiled forms are not kept, execute_statement
+    caches those it can when they are first executed.
+
+    Returns:
+    - dict: The SQL of each statement, by (table name, statement name).
+    """
+    return {
+        (table_name, name): str(statement.compile(dialect=engine.dialect))
+        for table_name, statements in registry.items()
+        for name, statement in statements.statements().items()
+    }
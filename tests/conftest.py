@@ -0,0 +1,102 @@
+import os, shutil, sys, tempfile, time
+import pytest
+
+# The modules of the API are top-level modules of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The tests run against an in-memory SQLite database and a local fake GCS,
+# unless DATABASE_URL and GCS_LOCAL_DIR point to others (e.g. a local
+# Postgres). Their tables and files are deleted by every test.
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("GCS_LOCAL_DIR", tempfile.mkdtemp(prefix="fake-gcs-"))
+if os.environ["DATABASE_URL"] == "sqlite://":
+    # The in-memory database is a single connection, which cannot hold
+    # the transactions of parts restored at the same time
+    os.environ.setdefault("BACKUP_WORKERS", "1")
+
+DEPARTMENTS = [{"id": i, "department": f"Department {i}"} for i in range(1, 5)]
+JOBS = [{"id": i, "job": f"Job {i}"} for i in range(1, 5)]
+
+
+def employees(ids, **values):
+    """hired_employees rows with the given ids, valid unless overridden."""
+    return [
+        {
+            "id": i,
+            "name": f"Employee {i}",
+            "datetime": f"2021-{i % 12 + 1:02d}-01T00:00:00",
+            "department_id": i % 4 + 1,
+            "job_id": i % 4 + 1,
+            **values,
+        }
+        for i in ids
+    ]
+
+
+def count_rows(table_name):
+    import sqlalchemy
+    from utils import get_engine
+
+    with get_engine().connect() as connection:
+        return connection.execute(sqlalchemy.text(f"SELECT COUNT(*) FROM {table_name}")).scalar()
+
+
+def clear_tables(*table_names):
+    import sqlalchemy
+    from utils import get_engine
+
+    with get_engine().begin() as connection:
+        for table_name in table_names:
+            connection.execute(sqlalchemy.text(f"DELETE FROM {table_name}"))
+
+
+def wait_for_job(client, job_id, timeout=30):
+    """Polls a job until it finishes, and returns it."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        assert time.monotonic() < deadline, f"Job {job_id} did not finish"
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def client():
+    """
+    A client of the application, with its startup and shutdown, empty
+    tables and an empty bucket.
+    """
+    from fastapi.testclient import TestClient
+    import main
+    from cache import get_result_cache
+    from config import GCS_LOCAL_DIR, hiring_summary, tables
+    from migrations import apply_migrations
+    from reference_index import load_reference_index
+    from utils import get_engine
+
+    with TestClient(main.app) as client:
+        engine = get_engine()
+        if engine.dialect.name == "postgresql":
+            # The revision sequence and triggers only exist in the migrations
+            apply_migrations(engine)
+        else:
+            for table in [*tables.values(), hiring_summary]:
+                table.create(engine, checkfirst=True)
+        clear_tables(*tables, hiring_summary.name)
+        load_reference_index(engine)
+        get_result_cache().clear()
+        shutil.rmtree(GCS_LOCAL_DIR, ignore_errors=True)
+        os.makedirs(GCS_LOCAL_DIR)
+        yield client
+
+
+@pytest.fixture
+def seeded(client):
+    """The client, with departments and jobs 1 to 4."""
+    for table_name, data in (("departments", DEPARTMENTS), ("jobs", JOBS)):
+        response = client.post(
+            "/batch-transactions/", json={"table_name": table_name, "data": data}
+        )
+        assert response.status_code == 200
+    return client
@@ -0,0 +1,77 @@
+"""
+hiring_summary counts the hires of hired_employees per quarter, department
+and job, on every insert path, and can be rebuilt from scratch.
+"""
+
+from datetime import datetime, timezone
+import pytest
+import sqlalchemy
+from conftest import employees
+from aggregates import apply_summary_deltas, rebuild_hiring_summary, summary_deltas, year_quarter
+from utils import get_engine, insert_batch_data, supports_copy
+
+
+def summary():
+    with get_engine().connect() as connection:
+        return {
+            tuple(row[:4]): row[4]
+            for row in connection.execute(
+                sqlalchemy.text(
+                    "SELECT year, quarter, department_id, job_id, hires FROM hiring_summary"
+                )
+            )
+        }
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("2021-01-01T00:00:00", (2021, 1)),
+        ("2021-03-31T23:59:59Z", (2021, 1)),
+        ("2021-04-01T00:00:00", (2021, 2)),
+        (datetime(2021, 12, 31, tzinfo=timezone.utc), (2021, 4)),
+    ],
+)
+def test_year_quarter(value, expected):
+    assert year_quarter(value) == expected
+
+
+def test_summary_deltas():
+    deltas = summary_deltas(
+        [("2021-01-05T00:00:00", 1, 2), ("2021-02-05T00:00:00", 1, 2), ("2021-05-05T00:00:00", 1, 2)]
+    )
+    assert deltas == {(2021, 1, 1, 2): 2, (2021, 2, 1, 2): 1}
+
+
+def test_keys_left_without_hires_are_deleted(client):
+    with get_engine().begin() as connection:
+        apply_summary_deltas(connection, {(2021, 1, 1, 1): 2, (2021, 2, 1, 1): 1})
+        apply_summary_deltas(connection, {(2021, 1, 1, 1): -1, (2021, 2, 1, 1): -1})
+
+    assert summary() == {(2021, 1, 1, 1): 1}
+
+
+@pytest.mark.parametrize("method", ["executemany", "copy"])
+def test_only_inserted_rows_are_counted(seeded, method):
+    if method == "copy" and not supports_copy(get_engine()):
+        pytest.skip("COPY needs Postgres")
+    insert_batch_data("hired_employees", employees(range(1, 13)), method=method)
+    insert_batch_data("hired_employees", employees(range(7, 19)), method=method)
+
+    hires = summary()
+    assert sum(hires.values()) == 18
+    # Employees 3 and 15 are hired in April by department and job 4
+    assert hires[(2021, 2, 4, 4)] == 2
+
+
+def test_rebuild_matches_the_maintained_summary(seeded):
+    if get_engine().dialect.name != "postgresql":
+        pytest.skip("The rebuild SQL needs Postgres")
+    insert_batch_data("hired_employees", employees(range(1, 31)))
+    maintained = summary()
+    with get_engine().begin() as connection:
+        connection.execute(sqlalchemy.text("UPDATE hiring_summary SET hires = 99"))
+
+    rebuild_hiring_summary(get_engine())
+
+    assert summary() == maintained
@@ -0,0 +1,253 @@
+"""
+/backup/ and /restore-avro-data/ round trips through the local fake GCS,
+whole, partitioned by id or month, and incremental.
+"""
+
+import json, os
+import pytest
+import sqlalchemy
+from conftest import clear_tables, count_rows, employees
+from config import GCS_BUCKET_NAME, GCS_LOCAL_DIR, data_columns, hiring_summary, tables
+from utils import get_engine
+
+
+def post_batch(client, data):
+    response = client.post(
+        "/batch-transactions/", json={"table_name": "hired_employees", "data": data}
+    )
+    assert response.json()["inserted"] == len(data)
+
+
+def table_rows(table_name):
+    """The rows of a table, without their revisions, which restores renew."""
+    table = tables.get(table_name, hiring_summary)
+    with get_engine().connect() as connection:
+        return sorted(
+            tuple(row)
+            for row in connection.execute(sqlalchemy.select(*data_columns(table)))
+        )
+
+
+def manifest(table_name):
+    path = os.path.join(GCS_LOCAL_DIR, GCS_BUCKET_NAME, f"backup/{table_name}_manifest.json")
+    with open(path) as f:
+        return json.load(f)
+
+
+def restore(client, table_name, **params):
+    clear_tables(table_name, "hiring_summary")
+    return client.post(f"/restore-avro-data/{table_name}/", params=params)
+
+
+@pytest.mark.parametrize(
+    "params, parts",
+    [
+        ({}, 1),
+        ({"codec": "null"}, 1),
+        ({"partitions": 3}, 3),
+        # Employees are hired in each of the 12 months of 2021
+        ({"partition_by": "month"}, 12),
+    ],
+)
+def test_round_trip(seeded, params, parts):
+    post_batch(seeded, employees(range(1, 101)))
+    rows = table_rows("hired_employees")
+    hires = table_rows("hiring_summary")
+
+    response = seeded.post("/backup/hired_employees/", params=params)
+
+    assert response.status_code == 200
+    assert response.json()["rows"] == 100
+    assert response.json()["parts"] == parts
+    assert sum(part["rows"] for part in manifest("hired_employees")["parts"]) == 100
+
+    response = restore(seeded, "hired_employees", chunk_size=7)
+
+    assert response.status_code == 200
+    assert response.json()["rows"] == 100
+    assert table_rows("hired_employees") == rows
+    assert table_rows("hiring_summary") == hires
+
+
+def test_round_trip_of_reference_tables(seeded):
+    rows = table_rows("departments")
+    assert seeded.post("/backup/departments/", params={"partitions": 2}).status_code == 200
+
+    assert restore(seeded, "departments").status_code == 200
+    assert table_rows("departments") == rows
+
+
+def test_incremental_backups_are_replayed_after_the_full_one(seeded):
+    post_batch(seeded, employees(range(1, 41)))
+    seeded.post("/backup/hired_employees/", params={"partitions": 2})
+    post_batch(seeded, employees(range(41, 61)))
+    first = seeded.post("/backup/hired_employees/", params={"incremental": True})
+    post_batch(seeded, employees(range(61, 71)))
+    second = seeded.post("/backup/hired_employees/", params={"incremental": True})
+    # Nothing was added since the last one
+    third = seeded.post("/backup/hired_employees/", params={"incremental": True})
+    rows = table_rows("hired_employees")
+
+    assert [r.json()["rows"] for r in (first, second, third)] == [20, 10, 0]
+    assert len(manifest("hired_employees")["deltas"]) == 2
+    assert manifest("hired_employees")["watermark"]["id"] == 70
+
+    response = restore(seeded, "hired_employees")
+
+    assert response.json()["rows"] == 70
+    assert table_rows("hired_employees") == rows
+
+
+def test_incremental_backups_capture_ids_below_the_highest_one(seeded):
+    # The legacy ids have gaps, which later rows can fill
+    post_batch(seeded, employees([*range(1, 11), 20]))
+    seeded.post("/backup/hired_employees/")
+    post_batch(seeded, employees([15]))
+
+    response = seeded.post("/backup/hired_employees/", params={"incremental": True})
+
+    assert response.json()["rows"] == 1
+    rows = table_rows("hired_employees")
+    assert restore(seeded, "hired_employees").status_code == 200
+    assert len(rows) == 12
+    assert table_rows("hired_employees") == rows
+
+
+def test_incremental_backups_capture_updates(seeded):
+    post_batch(seeded, employees(range(1, 11)))
+    seeded.post("/backup/hired_employees/", params={"partitions": 2})
+    with get_engine().begin() as connection:
+        connection.execute(
+            sqlalchemy.text("UPDATE hired_employees SET name = 'Renamed' WHERE id IN (3, 8)")
+        )
+    post_batch(seeded, employees([11]))
+    seeded.post("/backup/hired_employees/", params={"incremental": True})
+    with get_engine().begin() as connection:
+        connection.execute(
+            sqlalchemy.text("UPDATE hired_employees SET name = 'Renamed again' WHERE id = 3")
+        )
+
+    response = seeded.post("/backup/hired_employees/", params={"incremental": True})
+
+    assert response.json()["rows"] == 1
+    rows = table_rows("hired_employees")
+    assert restore(seeded, "hired_employees").status_code == 200
+    assert table_rows("hired_employees") == rows
+    names = {row[0]: row[1] for row in rows}
+    assert (names[3], names[8]) == ("Renamed again", "Renamed")
+
+
+def test_incremental_backups_capture_batch_updates(seeded):
+    if get_engine().dialect.name != "postgresql":
+        pytest.skip("on_conflict=update needs Postgres")
+    post_batch(seeded, employees(range(1, 11)))
+    seeded.post("/backup/hired_employees/")
+    seeded.post(
+        "/batch-transactions/",
+        json={"table_name": "hired_employees", "data": employees([4], name="Renamed")},
+        params={"on_conflict": "update"},
+    )
+
+    response = seeded.post("/backup/hired_employees/", params={"incremental": True})
+
+    assert response.json()["rows"] == 1
+    rows = table_rows("hired_employees")
+    hires = table_rows("hiring_summary")
+    assert restore(seeded, "hired_employees").status_code == 200
+    assert table_rows("hired_employees") == rows
+    assert table_rows("hiring_summary") == hires
+
+
+def backup_files(table_name):
+    root = os.path.join(GCS_LOCAL_DIR, GCS_BUCKET_NAME)
+    return sorted(
+        os.path.relpath(os.path.join(path, name), root)
+        for path, _, names in os.walk(os.path.join(root, "backup", table_name))
+        for name in names
+    )
+
+
+def test_full_backups_delete_the_files_they_supersede(seeded):
+    post_batch(seeded, employees(range(1, 21)))
+    seeded.post("/backup/hired_employees/", params={"partitions": 2})
+    post_batch(seeded, employees(range(21, 31)))
+    seeded.post("/backup/hired_employees/", params={"incremental": True})
+
+    seeded.post("/backup/hired_employees/")
+
+    latest = manifest("hired_employees")
+    assert backup_files("hired_employees") == [part["file"] for part in latest["parts"]]
+    assert latest["parts"][0]["file"].startswith(f"backup/hired_employees/{latest['backup_id']}/")
+    assert restore(seeded, "hired_employees").json()["rows"] == 30
+
+
+def test_failed_backups_leave_the_previous_one_intact(seeded, monkeypatch):
+    import backup
+
+    post_batch(seeded, employees(range(1, 21)))
+    seeded.post("/backup/hired_employees/", params={"partitions": 2})
+    previous = manifest("hired_employees")
+    rows = table_rows("hired_employees")
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("Connection lost")
+        yield
+
+    monkeypatch.setattr(backup, "iter_table_batches", fail)
+    assert seeded.post("/backup/hired_employees/").status_code == 500
+    monkeypatch.undo()
+
+    assert manifest("hired_employees") == previous
+    assert restore(seeded, "hired_employees").status_code == 200
+    assert table_rows("hired_employees") == rows
+
+
+def test_incremental_backup_without_a_previous_one_is_full(seeded):
+    post_batch(seeded, employees(range(1, 11)))
+
+    response = seeded.post("/backup/hired_employees/", params={"incremental": True})
+
+    assert response.json()["rows"] == 10
+    assert manifest("hired_employees")["watermark"]["id"] == 10
+
+
+@pytest.mark.parametrize(
+    "table_name, params",
+    [
+        ("hired_employees", {"codec": "lz4"}),
+        ("departments", {"partition_by": "month"}),
+        ("hired_employees", {"partition_by": "day"}),
+        ("employees", {}),
+    ],
+)
+def test_invalid_backup_options(seeded, table_name, params):
+    response = seeded.post(f"/backup/{table_name}/", params=params)
+    assert response.status_code == 400
+
+
+# A byte of the data, and of the header, which fails decoding
+@pytest.mark.parametrize("offset", [-20, 0])
+def test_corrupted_parts_are_not_restored(seeded, offset):
+    post_batch(seeded, employees(range(1, 31)))
+    seeded.post("/backup/hired_employees/", params={"partitions": 3})
+    corrupted = manifest("hired_employees")["parts"][1]
+    path = os.path.join(GCS_LOCAL_DIR, GCS_BUCKET_NAME, corrupted["file"])
+    whence = os.SEEK_END if offset < 0 else os.SEEK_SET
+    with open(path, "r+b") as f:
+        f.seek(offset, whence)
+        byte = f.read(1)
+        f.seek(offset, whence)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    response = restore(seeded, "hired_employees", chunk_size=2)
+
+    assert response.status_code == 500
+    assert "Checksum mismatch" in response.json()["detail"]
+    restored = [row[0] for row in table_rows("hired_employees")]
+    assert restored
+    assert not [i for i in restored if corrupted["lower"] <= i <= corrupted["upper"]]
+
+
+def test_restore_without_a_backup_fails(client):
+    assert client.post("/restore-avro-data/jobs/").status_code == 500
+    assert count_rows("jobs") == 0
@@ -0,0 +1,86 @@
+"""
+The COPY and executemany paths of insert_batch_data write the same rows
+and counts; COPY needs Postgres.
+"""
+
+import csv
+from io import StringIO
+import pytest
+import sqlalchemy
+import utils
+from conftest import count_rows, employees
+from config import tables
+from utils import RowStream, get_engine, insert_batch_data, supports_copy
+
+
+@pytest.fixture
+def postgres(seeded):
+    if not supports_copy(get_engine()):
+        pytest.skip("COPY needs Postgres")
+    return seeded
+
+
+def test_row_stream_renders_csv_in_any_read_size():
+    rows = employees(range(1, 8), name=None)
+    rows[0]["department_id"] = "3"
+    expected = RowStream(rows, tables["hired_employees"]).read()
+
+    stream = RowStream(rows, tables["hired_employees"], rows_per_chunk=2)
+    pieces = []
+    while piece := stream.read(5):
+        pieces.append(piece)
+
+    assert "".join(pieces) == expected
+    assert stream.rows_written == 7
+    first = next(csv.reader(StringIO(expected)))
+    assert first == ["1", "\\N", "2021-02-01T00:00:00", "3", "2"]
+
+
+def test_auto_uses_executemany_without_copy(seeded, monkeypatch):
+    monkeypatch.setattr(utils, "COPY_MIN_ROWS", 1)
+    calls = []
+    monkeypatch.setattr(utils, "copy_batch_data", lambda *args: calls.append(args))
+
+    counts = insert_batch_data("hired_employees", employees(range(1, 6)), method="auto")
+
+    assert calls == []
+    assert counts == {"inserted": 5, "updated": 0, "duplicates": 0}
+
+
+def test_invalid_method(seeded):
+    with pytest.raises(ValueError):
+        insert_batch_data("hired_employees", employees([1]), method="bulk")
+
+
+@pytest.mark.parametrize("on_conflict", ["skip", "update"])
+def test_copy_matches_executemany(postgres, on_conflict):
+    insert_batch_data("hired_employees", employees(range(1, 6)), method="copy")
+    batch = employees(range(3, 9)) + employees([4], name="Renamed")
+
+    copied = insert_batch_data("hired_employees", batch, "copy", on_conflict)
+    with get_engine().connect() as connection:
+        rows = connection.execute(sqlalchemy.text("SELECT * FROM hired_employees")).all()
+        hires = connection.execute(sqlalchemy.text("SELECT * FROM hiring_summary")).all()
+    with get_engine().begin() as connection:
+        connection.execute(sqlalchemy.text("DELETE FROM hired_employees"))
+        connection.execute(sqlalchemy.text("DELETE FROM hiring_summary"))
+    insert_batch_data("hired_employees", employees(range(1, 6)), method="executemany")
+    expected = insert_batch_data("hired_employees", batch, "executemany", on_conflict)
+
+    assert copied == expected
+    with get_engine().connect() as connection:
+        assert sorted(
+            row[:5] for row in connection.execute(sqlalchemy.text("SELECT * FROM hired_employees"))
+        ) == sorted(row[:5] for row in rows)
+        assert sorted(
+            connection.execute(sqlalchemy.text("SELECT * FROM hiring_summary")).all()
+        ) == sorted(hires)
+
+
+def test_copy_error_mode_writes_nothing(postgres):
+    insert_batch_data("hired_employees", employees(range(1, 6)), method="copy")
+
+    with pytest.raises(utils.ConflictError):
+        insert_batch_data("hired_employees", employees(range(4, 9)), "copy", "error")
+
+    assert count_rows("hired_employees") == 5
@@ -0,0 +1,80 @@
+"""
+The result cache evicts by LRU order and TTL, and writes through
+insert_batch_data make the cached results of the table unreachable.
+"""
+
+import sqlalchemy
+from cache import ResultCache, bump_table_version, get_result_cache, table_versions
+from utils import get_engine, insert_batch_data, iter_cached_query_batches
+
+QUERY = sqlalchemy.text("SELECT id FROM departments ORDER BY id")
+
+
+def cached_ids(**options):
+    batches = iter_cached_query_batches(QUERY, ("departments",), ("departments",), **options)
+    return [row[0] for batch in batches for row in batch]
+
+
+def insert_directly(department_id):
+    # Without insert_batch_data, so the table's version does not change
+    with get_engine().begin() as connection:
+        connection.execute(
+            sqlalchemy.text("INSERT INTO departments (id, department) VALUES (:id, 'Other')"),
+            {"id": department_id},
+        )
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResultCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2}
+
+
+def test_entries_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+    cache = ResultCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+
+    now[0] += 61
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_versions_change_on_bump():
+    before = table_versions("departments", "jobs")
+    bump_table_version("departments")
+    after = table_versions("departments", "jobs")
+    assert after[0] == before[0] + 1
+    assert after[1] == before[1]
+
+
+def test_results_are_served_until_the_table_is_written(seeded):
+    assert cached_ids() == [1, 2, 3, 4]
+    insert_directly(5)
+    assert cached_ids() == [1, 2, 3, 4]
+
+    insert_batch_data("departments", [{"id": 6, "department": "Department 6"}])
+
+    assert cached_ids() == [1, 2, 3, 4, 5, 6]
+
+
+def test_large_results_are_not_cached(seeded):
+    assert cached_ids(batch_size=2, max_rows=3) == [1, 2, 3, 4]
+    insert_directly(5)
+    assert cached_ids(batch_size=2, max_rows=3) == [1, 2, 3, 4, 5]
+    assert get_result_cache().stats()["size"] == 0
+
+
+def test_duplicate_batches_keep_the_cached_results(seeded):
+    cached_ids()
+    insert_directly(5)
+
+    insert_batch_data("departments", [{"id": 1, "department": "Department 1"}])
+
+    assert cached_ids() == [1, 2, 3, 4]
@@ -0,0 +1,78 @@
+"""
+clean_data keeps the same rows whatever the chunk size, and never leaves
+a half-written output.
+"""
+
+import os
+import pandas as pd
+import pytest
+from legacy_data_processing import clean_data as clean_data_module
+from legacy_data_processing.clean_data import clean_data, clean_file
+
+HIRED_EMPLOYEES = (
+    "1,Harold Vogt,2021-11-07T02:48:42Z,2,96\n"
+    "2,,2021-09-01T23:27:38Z,5,52\n"
+    "3,Lyman Hadye,2021-09-01T23:27:38,5,52\n"
+    "4,Lotti Crowthe,2021-10-01T13:04:21Z,12,71\n"
+    "-5,Gretna Lording,2021-10-10T22:52:42Z,6,80\n"
+    "6,Marlie Scutt,2021-02-30T00:00:00Z,6,80\n"
+    "7,Grissel Tapp,2021-01-01T00:00:00Z,x,3\n"
+    "8,Dorian Blum,2021-12-31T23:59:59Z,1,1\n"
+)
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    path = tmp_path / "data"
+    path.mkdir()
+    (path / "hired_employees.csv").write_text(HIRED_EMPLOYEES)
+    (path / "jobs.csv").write_text("1,Job 1\n2, \n3,Job 3\n")
+    (path / "notes.csv").write_text("not,a,table\n")
+    return path
+
+
+def read_output(path):
+    return pd.read_csv(path, header=None, dtype=str).values.tolist()
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 3, 100])
+def test_invalid_rows_are_dropped_in_any_chunk_size(input_dir, tmp_path, chunk_rows):
+    result = clean_file("hired_employees.csv", input_dir, tmp_path, chunk_rows)
+
+    assert (result["rows"], result["kept"]) == (8, 4)
+    assert result["dropped"] == {
+        "missing value": 1,
+        "invalid id": 1,
+        "invalid datetime": 1,
+        "invalid department_id": 1,
+    }
+    # Datetimes without the trailing Z are accepted too
+    assert [row[0] for row in read_output(tmp_path / "hired_employees.csv")] == [
+        "1", "3", "4", "8"
+    ]
+    # The source is left as it was
+    assert (input_dir / "hired_employees.csv").read_text() == HIRED_EMPLOYEES
+
+
+def test_failed_files_leave_no_output(input_dir, tmp_path, monkeypatch):
+    (tmp_path / "hired_employees.csv").write_text("previous\n")
+
+    def fail(chunk, table_name, dropped):
+        raise RuntimeError("Out of memory")
+
+    monkeypatch.setattr(clean_data_module, "clean_chunk", fail)
+    with pytest.raises(RuntimeError):
+        clean_file("hired_employees.csv", input_dir, tmp_path)
+
+    assert (tmp_path / "hired_employees.csv").read_text() == "previous\n"
+    assert not (tmp_path / ".hired_employees.csv.tmp").exists()
+
+
+def test_clean_data_cleans_the_files_of_known_tables(input_dir, tmp_path):
+    output_dir = tmp_path / "clean"
+
+    results = clean_data(input_dir, output_dir, workers=2, chunk_rows=2)
+
+    assert [result["file"] for result in results] == ["hired_employees.csv", "jobs.csv"]
+    assert sorted(os.listdir(output_dir)) == ["hired_employees.csv", "jobs.csv"]
+    assert read_output(output_dir / "jobs.csv") == [["1", "Job 1"], ["3", "Job 3"]]
@@ -0,0 +1,35 @@
+"""
+One pooled engine per process, created on startup and disposed on shutdown.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import sqlalchemy
+import utils
+from fastapi.testclient import TestClient
+import main
+
+
+def test_engine_is_shared_while_running(client):
+    engine = utils.get_engine()
+    assert utils.init_engine() is engine
+    with ThreadPoolExecutor(4) as executor:
+        engines = list(executor.map(lambda _: utils.get_engine(), range(8)))
+    assert all(x is engine for x in engines)
+
+
+def test_engine_is_disposed_on_shutdown():
+    with TestClient(main.app):
+        engine = utils.get_engine()
+        with engine.connect() as connection:
+            assert connection.execute(sqlalchemy.text("SELECT 1")).scalar() == 1
+    assert utils._engine is None
+    with TestClient(main.app):
+        assert utils.get_engine() is not engine
+
+
+def test_get_engine_creates_the_engine_on_first_use():
+    utils.dispose_engine()
+    assert utils._engine is None
+    engine = utils.get_engine()
+    assert engine is utils.get_engine()
+    utils.dispose_engine()
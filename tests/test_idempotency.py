@@ -0,0 +1,112 @@
+"""
+Idempotency-Key headers on the batch endpoints, and the store behind them.
+"""
+
+import json, uuid
+import pytest
+from conftest import clear_tables, count_rows, employees
+from idempotency import IdempotencyStore, KeyInProgress, KeyMismatch
+
+
+def post_batch(client, key, data, **params):
+    return client.post(
+        "/batch-transactions/",
+        json={"table_name": "hired_employees", "data": data},
+        headers={"Idempotency-Key": key},
+        params=params,
+    )
+
+
+def post_stream(client, key, data):
+    return client.post(
+        "/batch-transactions/stream/hired_employees/",
+        content="\n".join(json.dumps(row) for row in data).encode(),
+        headers={"Idempotency-Key": key, "Content-Type": "application/x-ndjson"},
+    )
+
+
+@pytest.fixture
+def key():
+    # Keys are kept per process, for the whole test session
+    return str(uuid.uuid4())
+
+
+def test_batch_retry_is_replayed(seeded, key):
+    first = post_batch(seeded, key, employees(range(1, 6)))
+    retry = post_batch(seeded, key, employees(range(1, 6)))
+
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.json() == first.json()
+    assert retry.json()["inserted"] == 5
+    assert count_rows("hired_employees") == 5
+
+
+def test_batch_key_reused_for_another_body(seeded, key):
+    post_batch(seeded, key, employees(range(1, 6)))
+
+    assert post_batch(seeded, key, employees(range(1, 7))).status_code == 422
+    assert post_batch(seeded, key, employees(range(1, 6)), on_conflict="error").status_code == 422
+    assert count_rows("hired_employees") == 5
+
+
+def test_stream_retry_is_replayed(seeded, key):
+    first = post_stream(seeded, key, employees(range(1, 6)))
+    retry = post_stream(seeded, key, employees(range(1, 6)))
+
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert count_rows("hired_employees") == 5
+
+
+def test_stream_key_reused_for_another_body(seeded, key):
+    post_stream(seeded, key, employees(range(1, 6)))
+
+    response = post_stream(seeded, key, employees(range(6, 11)))
+
+    assert response.status_code == 422
+    assert count_rows("hired_employees") == 5
+
+
+def test_failed_requests_can_be_retried(seeded, key):
+    post_batch(seeded, str(uuid.uuid4()), employees([3]))
+
+    failed = post_batch(seeded, key, employees(range(1, 6)), on_conflict="error")
+    assert failed.status_code == 409
+
+    clear_tables("hired_employees", "hiring_summary")
+    retry = post_batch(seeded, key, employees(range(1, 6)), on_conflict="error")
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+    assert count_rows("hired_employees") == 5
+
+
+def test_store_claims_keys():
+    store = IdempotencyStore(maxsize=10, ttl=60)
+
+    assert store.begin("a", "x") is None
+    with pytest.raises(KeyInProgress):
+        store.begin("a", "x")
+    with pytest.raises(KeyMismatch):
+        store.begin("a", "y")
+    store.complete("a", "response")
+    assert store.begin("a", "x") == "response"
+
+    assert store.begin("b", "x") is None
+    store.abort("b")
+    assert store.begin("b", "x") is None
+
+
+def test_store_evicts_expired_and_least_recently_used_keys():
+    store = IdempotencyStore(maxsize=2, ttl=-1)
+    store.begin("a", "x")
+    store.complete("a", "response")
+    assert store.begin("a", "x") is None
+
+    store = IdempotencyStore(maxsize=2, ttl=60)
+    for key in "abc":
+        store.begin(key, "x")
+        store.complete(key, key)
+    assert store.begin("a", "x") is None
+    assert store.begin("c", "x") == "c"
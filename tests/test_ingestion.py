@@ -0,0 +1,246 @@
+"""
+/batch-transactions/ and /batch-transactions/stream/, with their conflict
+modes and the hiring_summary they keep up to date.
+"""
+
+import asyncio, json
+import pytest
+import sqlalchemy
+from conftest import count_rows, employees
+from utils import get_engine, insert_batch_data, iter_ndjson_lines, supports_copy
+
+
+def post_batch(client, table_name, data, **params):
+    return client.post(
+        "/batch-transactions/",
+        json={"table_name": table_name, "data": data},
+        params=params,
+    )
+
+
+def post_stream(client, table_name, rows, **params):
+    body = "\n".join(row if isinstance(row, str) else json.dumps(row) for row in rows)
+    return client.post(
+        f"/batch-transactions/stream/{table_name}/",
+        content=body.encode(),
+        headers={"Content-Type": "application/x-ndjson"},
+        params=params,
+    )
+
+
+def summary():
+    with get_engine().connect() as connection:
+        return {
+            tuple(row[:4]): row[4]
+            for row in connection.execute(
+                sqlalchemy.text(
+                    "SELECT year, quarter, department_id, job_id, hires FROM hiring_summary"
+                )
+            )
+        }
+
+
+def test_batch_inserts_valid_rows_and_rejects_the_others(seeded):
+    rows = employees(range(1, 11))
+    rows[2]["name"] = " "
+    rows[5]["department_id"] = 99
+    rows[7] = {"id": 8}
+
+    response = post_batch(seeded, "hired_employees", rows)
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result["inserted"] == 7
+    assert result["duplicates"] == 0
+    assert [rejection["index"] for rejection in result["rejected"]] == [2, 5, 7]
+    assert count_rows("hired_employees") == 7
+
+
+def test_batch_rejects_unknown_tables(client):
+    response = post_batch(client, "employees", [])
+    assert response.status_code == 400
+
+
+def test_batch_updates_hiring_summary(seeded):
+    post_batch(seeded, "hired_employees", employees(range(1, 25)))
+
+    hires = summary()
+    assert sum(hires.values()) == 24
+    # Employees 1 and 13 are hired in February by department and job 2
+    assert hires[(2021, 1, 2, 2)] == 2
+
+
+def test_stream_commits_every_chunk(seeded):
+    rows = employees(range(1, 11))
+    rows.insert(4, "not json")
+    rows.insert(7, "[1, 2]")
+
+    response = post_stream(seeded, "hired_employees", rows, chunk_size=4)
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result["accepted"] == 10
+    assert result["rejected"] == 2
+    assert result["inserted"] == 10
+    assert [chunk["accepted"] for chunk in result["chunks"]] == [4, 2, 4]
+    assert count_rows("hired_employees") == 10
+    assert sum(summary().values()) == 10
+
+
+def split_lines(chunks, **options):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return [line async for line in iter_ndjson_lines(stream(), **options)]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        [b'{"id": 1}\n{"id": 2}\n\n{"id": 3}'],
+        [b'{"id"', b": 1}\n", b'{"id": 2}\n\n{"i', b'd": 3}\n'],
+        [b"{", b'"id": 1', b"}\n{", b'"id": 2}', b"\n", b"\n", b'{"id": 3}'],
+    ],
+)
+def test_lines_are_split_across_chunks(chunks):
+    assert split_lines(chunks) == [b'{"id": 1}', b'{"id": 2}', b'{"id": 3}']
+
+
+@pytest.mark.parametrize(
+    "chunks", [[b"x" * 11], [b"x" * 6, b"x" * 6], [b"x" * 6, b"x" * 5 + b"\n"]]
+)
+def test_long_lines_are_rejected(chunks):
+    with pytest.raises(ValueError):
+        split_lines(chunks, max_line_bytes=10)
+
+
+def test_stream_rejects_long_lines(seeded, monkeypatch):
+    monkeypatch.setattr("main.STREAM_MAX_LINE_BYTES", 100)
+    rows = employees(range(1, 5)) + employees([5], name="x" * 100)
+
+    response = post_stream(seeded, "hired_employees", rows, chunk_size=2)
+
+    assert response.status_code == 400
+    assert count_rows("hired_employees") == 4
+
+
+@pytest.mark.parametrize("params", [{"chunk_size": 0}, {"on_conflict": "replace"}])
+def test_stream_rejects_invalid_options(seeded, params):
+    response = post_stream(seeded, "hired_employees", employees([1]), **params)
+    assert response.status_code == 400
+    assert count_rows("hired_employees") == 0
+
+
+def test_stream_rejects_unknown_tables(client):
+    assert post_stream(client, "employees", []).status_code == 400
+
+
+def test_skip_counts_duplicates(seeded):
+    post_batch(seeded, "hired_employees", employees(range(1, 6)))
+
+    response = post_batch(seeded, "hired_employees", employees(range(3, 9)), on_conflict="skip")
+
+    assert response.json()["inserted"] == 3
+    assert response.json()["duplicates"] == 3
+    assert count_rows("hired_employees") == 8
+    assert sum(summary().values()) == 8
+
+
+def test_error_rejects_the_whole_batch(seeded):
+    post_batch(seeded, "hired_employees", employees(range(1, 6)))
+
+    response = post_batch(seeded, "hired_employees", employees(range(3, 9)), on_conflict="error")
+
+    assert response.status_code == 409
+    assert count_rows("hired_employees") == 5
+    assert sum(summary().values()) == 5
+
+
+def test_error_keeps_the_chunks_streamed_before(seeded):
+    post_batch(seeded, "hired_employees", employees([5]))
+
+    response = post_stream(
+        seeded, "hired_employees", employees(range(1, 9)), chunk_size=4, on_conflict="error"
+    )
+
+    assert response.status_code == 409
+    assert response.json()["detail"].startswith("Chunk 1:")
+    assert count_rows("hired_employees") == 5
+
+
+def test_invalid_conflict_mode(seeded):
+    response = post_batch(seeded, "hired_employees", employees([1]), on_conflict="replace")
+    assert response.status_code == 400
+
+
+def test_update_moves_hires_to_the_new_quarter(seeded):
+    if get_engine().dialect.name != "postgresql":
+        pytest.skip("on_conflict=update needs Postgres")
+    post_batch(seeded, "hired_employees", employees(range(1, 3)))
+
+    moved = employees([1], datetime="2021-07-01T00:00:00")
+    response = post_batch(seeded, "hired_employees", moved, on_conflict="update")
+
+    assert response.json()["updated"] == 1
+    hires = summary()
+    assert (2021, 1, 2, 2) not in hires
+    assert hires[(2021, 3, 2, 2)] == 1
+    assert sum(hires.values()) == 2
+
+
+def test_error_rejects_ids_repeated_in_the_batch(seeded):
+    response = post_batch(seeded, "hired_employees", employees([1, 2, 1]), on_conflict="error")
+
+    assert response.status_code == 409
+    assert count_rows("hired_employees") == 0
+    assert summary() == {}
+
+
+@pytest.mark.parametrize("method", ["executemany", "copy"])
+def test_update_reports_updated_and_unchanged_rows(seeded, method):
+    if get_engine().dialect.name != "postgresql":
+        pytest.skip("on_conflict=update needs Postgres")
+    if method == "copy" and not supports_copy(get_engine()):
+        pytest.skip("COPY needs Postgres with pg8000 or psycopg2")
+    insert_batch_data("hired_employees", employees(range(1, 5)), method=method)
+    # 1 is unchanged, 2 changes twice (the last row wins) and 5 is new
+    batch = employees([1, 2]) + employees([2], name="Renamed", job_id=1) + employees([5])
+
+    counts = insert_batch_data("hired_employees", batch, method=method, on_conflict="update")
+
+    assert counts == {"inserted": 1, "updated": 1, "duplicates": 2}
+    with get_engine().connect() as connection:
+        row = connection.execute(
+            sqlalchemy.text("SELECT name, job_id FROM hired_employees WHERE id = 2")
+        ).one()
+    assert tuple(row) == ("Renamed", 1)
+    hires = summary()
+    assert (2021, 1, 3, 3) not in hires
+    assert hires[(2021, 1, 3, 1)] == 1
+    assert sum(hires.values()) == 5
+
+
+def test_stream_reports_updates(seeded):
+    if get_engine().dialect.name != "postgresql":
+        pytest.skip("on_conflict=update needs Postgres")
+    post_batch(seeded, "hired_employees", employees(range(1, 5)))
+
+    rows = employees([3], name="Renamed") + employees([5])
+    response = post_stream(seeded, "hired_employees", rows, on_conflict="update")
+
+    assert response.json()["inserted"] == 1
+    assert response.json()["updated"] == 1
+
+
+def test_departments_and_jobs_are_checked_again_after_a_batch(client):
+    response = post_batch(client, "hired_employees", employees([1]))
+    assert response.json()["inserted"] == 0
+
+    post_batch(client, "departments", [{"id": 2, "department": "Department 2"}])
+    post_batch(client, "jobs", [{"id": 2, "job": "Job 2"}])
+    response = post_batch(client, "hired_employees", employees([1]))
+    assert response.json()["inserted"] == 1
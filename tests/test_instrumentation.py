@@ -0,0 +1,106 @@
+"""
+Stage timings and counters on /metrics, and the per-request breakdown of
+the X-Profile header.
+"""
+
+import re
+import instrumentation
+import secret_provider
+from conftest import employees
+from instrumentation import PREFIX, observe, render
+from secret_provider import EnvBackend, SecretProvider
+
+
+def metric(text, name, **labels):
+    """The value of a sample of /metrics, 0 if it is missing."""
+    label_text = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    pattern = re.escape(PREFIX + name + (f"{{{label_text}}}" if labels else "")) + r" (\S+)"
+    match = re.search(f"^{pattern}$", text, re.MULTILINE)
+    return float(match.group(1)) if match else 0
+
+
+def post_batch(client, data, **headers):
+    return client.post(
+        "/batch-transactions/",
+        json={"table_name": "hired_employees", "data": data},
+        headers=headers,
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    before = render()
+    observe("test_stage", 0.003)
+    observe("test_stage", 0.3)
+    text = render()
+
+    assert metric(text, "stage_duration_seconds_count", stage="test_stage") == (
+        metric(before, "stage_duration_seconds_count", stage="test_stage") + 2
+    )
+    buckets = [
+        float(value)
+        for value in re.findall(
+            rf'^{PREFIX}stage_duration_seconds_bucket{{le="[^"]+",stage="test_stage"}} (\S+)$',
+            text,
+            re.MULTILINE,
+        )
+    ]
+    assert buckets == sorted(buckets)
+
+
+def test_batches_are_counted(seeded):
+    before = seeded.get("/metrics").text
+    rows = employees(range(1, 6))
+    rows[0]["name"] = " "
+
+    post_batch(seeded, rows)
+    post_batch(seeded, employees(range(2, 4)))
+
+    text = seeded.get("/metrics").text
+    assert seeded.get("/metrics").headers["content-type"].startswith("text/plain")
+    for name, added in [
+        ("rows_accepted_total", 6),
+        ("rows_rejected_total", 1),
+        ("rows_inserted_total", 4),
+        ("rows_duplicate_total", 2),
+    ]:
+        table = "hired_employees"
+        assert metric(text, name, table=table) - metric(before, name, table=table) == added
+    assert metric(text, "stage_duration_seconds_count", stage="validate") > metric(
+        before, "stage_duration_seconds_count", stage="validate"
+    )
+    assert f"# TYPE {PREFIX}limiter_borrowed gauge" in text
+
+
+def test_profile_header(seeded, monkeypatch):
+    monkeypatch.setattr(instrumentation, "REQUEST_PROFILING", True)
+
+    profiled = post_batch(seeded, employees([1]), **{"X-Profile": "1"})
+    plain = post_batch(seeded, employees([2]))
+
+    stages = dict(
+        timing.split(";dur=") for timing in profiled.headers["server-timing"].split(", ")
+    )
+    assert {"validate", "insert", "total"} <= set(stages)
+    assert "server-timing" not in plain.headers
+
+
+def test_profiling_can_be_switched_off(seeded, monkeypatch):
+    monkeypatch.setattr(instrumentation, "REQUEST_PROFILING", False)
+    response = post_batch(seeded, employees([1]), **{"X-Profile": "1"})
+    assert "server-timing" not in response.headers
+
+
+def test_secret_cache_counters(client, monkeypatch):
+    monkeypatch.setattr(secret_provider, "_provider", None)
+    assert f"{PREFIX}secrets" not in client.get("/metrics").text
+
+    monkeypatch.setenv("SECRET_DB_USER", "api")
+    monkeypatch.setattr(secret_provider, "_provider", SecretProvider(EnvBackend()))
+    secret_provider.retrieve_secret("db_user")
+    secret_provider.retrieve_secret("db_user")
+
+    text = client.get("/metrics").text
+    assert metric(text, "secrets", value="hits") == 1
+    assert metric(text, "secrets", value="misses") == 1
+    assert metric(text, "secrets", value="cached") == 1
+    assert f'{PREFIX}secrets{{value="refresh_errors"}} 0' in text
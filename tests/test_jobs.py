@@ -0,0 +1,167 @@
+"""
+Background jobs: the /jobs/ endpoints, coalescing and the job stores.
+"""
+
+import json, threading, time, uuid
+import backup
+from conftest import clear_tables, count_rows, employees, wait_for_job
+from jobs import JobQueue, MemoryJobStore, SQLiteJobStore
+
+
+def test_backup_and_restore_jobs(seeded):
+    seeded.post(
+        "/batch-transactions/",
+        json={"table_name": "hired_employees", "data": employees(range(1, 51))},
+    )
+
+    response = seeded.post("/jobs/backup/hired_employees/", params={"partitions": 2})
+    assert response.status_code == 202
+    job = wait_for_job(seeded, response.json()["job_id"])
+    assert job["status"] == "succeeded"
+    assert job["result"]["rows"] == 50
+    assert job["progress"]["rows"] == 50
+    assert job["params"]["partitions"] == 2
+
+    clear_tables("hired_employees", "hiring_summary")
+    response = seeded.post("/jobs/restore/hired_employees/", params={"chunk_size": 20})
+    job = wait_for_job(seeded, response.json()["job_id"])
+    assert job["status"] == "succeeded"
+    assert job["result"]["rows"] == 50
+    assert count_rows("hired_employees") == 50
+
+
+def test_batch_job(seeded):
+    data = employees(range(1, 11))
+    data[3]["job_id"] = 99
+
+    response = seeded.post(
+        "/jobs/batch-transactions/",
+        json={"table_name": "hired_employees", "data": data},
+        headers={"Idempotency-Key": str(uuid.uuid4())},
+    )
+    job = wait_for_job(seeded, response.json()["job_id"])
+
+    assert job["status"] == "succeeded"
+    assert job["result"]["accepted"] == 9
+    assert job["result"]["inserted"] == 9
+    assert [rejection["index"] for rejection in job["result"]["rejected"]] == [3]
+    assert "data" not in job["params"]
+    assert job["progress"] == {"rows": 10, "bytes": len(json.dumps(data))}
+    assert count_rows("hired_employees") == 9
+
+
+def test_batch_job_retry_returns_the_same_job(seeded):
+    key = str(uuid.uuid4())
+    body = {"table_name": "hired_employees", "data": employees(range(1, 4))}
+
+    first = seeded.post("/jobs/batch-transactions/", json=body, headers={"Idempotency-Key": key})
+    retry = seeded.post("/jobs/batch-transactions/", json=body, headers={"Idempotency-Key": key})
+
+    assert retry.status_code == 202
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json()["job_id"] == first.json()["job_id"]
+    wait_for_job(seeded, first.json()["job_id"])
+
+
+def test_backups_of_a_table_run_one_at_a_time(seeded):
+    results = []
+
+    def backup_jobs():
+        results.append(seeded.post("/backup/jobs/").status_code)
+
+    # Held like a backup job of the table would hold it
+    with backup._backup_locks["jobs"]:
+        thread = threading.Thread(target=backup_jobs)
+        thread.start()
+        thread.join(0.5)
+        assert not results
+        # Other tables are not held back
+        assert seeded.post("/backup/departments/").status_code == 200
+    thread.join(10)
+    assert results == [200]
+
+
+def test_failed_jobs_record_the_error(client):
+    response = client.post("/jobs/restore/departments/")
+    job = wait_for_job(client, response.json()["job_id"])
+
+    assert job["status"] == "failed"
+    assert job["error"]
+
+
+def test_invalid_jobs_are_not_queued(client):
+    assert client.post("/jobs/backup/employees/").status_code == 400
+    assert client.post("/jobs/backup/jobs/", params={"codec": "lz4"}).status_code == 400
+    assert client.post("/jobs/restore/employees/").status_code == 400
+    body = {"table_name": "hired_employees", "data": []}
+    response = client.post("/jobs/batch-transactions/", json=body, params={"on_conflict": "replace"})
+    assert response.status_code == 400
+    assert client.get("/jobs/missing").status_code == 404
+
+
+def test_jobs_with_the_same_key_are_coalesced():
+    queue = JobQueue(MemoryJobStore(), workers=2)
+    started, release = threading.Event(), threading.Event()
+
+    def work(progress):
+        started.set()
+        release.wait(10)
+        return "done"
+
+    first, coalesced = queue.submit("backup", work, coalesce_key="backup:jobs")
+    assert not coalesced
+    started.wait(10)
+    second, coalesced = queue.submit("backup", work, coalesce_key="backup:jobs")
+    assert coalesced
+    assert second["id"] == first["id"]
+    other, coalesced = queue.submit("backup", lambda progress: None, coalesce_key="backup:departments")
+    assert not coalesced
+
+    release.set()
+    queue.shutdown()
+    assert queue.get(first["id"])["result"] == "done"
+    # Once the job finished, the key can be used again
+    queue = JobQueue(queue.store)
+    third, coalesced = queue.submit("backup", work, coalesce_key="backup:jobs")
+    assert not coalesced
+    queue.shutdown()
+
+
+def job(job_id, status="queued"):
+    return {"id": job_id, "coalesce_key": None, "status": status, "finished_at": None}
+
+
+def test_memory_store_evicts_finished_jobs():
+    store = MemoryJobStore(ttl=60, max_finished=2)
+    for job_id in "abcd":
+        store.create(job(job_id))
+    for job_id in "abc":
+        store.update(job_id, status="succeeded")
+
+    assert store.get("a") is None
+    assert store.get("b") is not None
+    assert store.get("d")["status"] == "queued"
+
+    store = MemoryJobStore(ttl=0.01, max_finished=10)
+    store.create(job("a"))
+    store.update("a", status="failed")
+    time.sleep(0.02)
+    assert store.get("a") is None
+    # Updates of evicted jobs are ignored
+    store.update("a", progress={"rows": 1, "bytes": 0})
+
+
+def test_sqlite_store_survives_restarts(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    store = SQLiteJobStore(path, ttl=60)
+    store.create(job("a"))
+    store.create(job("b"))
+    store.update("b", status="succeeded", finished_at="2020-01-01T00:00:00+00:00")
+
+    store = SQLiteJobStore(path, ttl=60)
+    assert store.get("a")["status"] == "failed"
+    assert store.get("a")["error"] == "Interrupted by a restart"
+    # Jobs that finished more than ttl seconds ago are deleted
+    store.create(job("c"))
+    assert store.get("b") is None
+    assert store.get("a") is not None
@@ -0,0 +1,88 @@
+"""
+The legacy loader COPYs each file chunk by chunk and resumes a failed load
+from the last committed chunk.
+"""
+
+import os
+import pytest
+import sqlalchemy
+from conftest import count_rows
+from legacy_data_processing import load_historical_data
+from legacy_data_processing.load_historical_data import LoadState, copy_file, iter_chunks
+from utils import get_engine, supports_copy
+
+JOBS = "".join(f"{i},Job {i}\n" for i in range(1, 11))
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # Files are read from data/ in the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    with open("data/jobs.csv", "w") as f:
+        f.write(JOBS.replace("4,Job 4", "4, ").replace("7,Job 7", "x,Job 7"))
+    return tmp_path
+
+
+def test_iter_chunks_yields_the_offset_after_each_chunk(tmp_path):
+    path = tmp_path / "jobs.csv"
+    path.write_text(JOBS)
+    with open(path, "rb") as f:
+        chunks = list(iter_chunks(f, 4))
+
+    assert [chunk.count(b"\n") for chunk, _ in chunks] == [4, 4, 2]
+    assert chunks[0][1] == len(JOBS[:JOBS.index("5,")])
+    assert chunks[-1][1] == len(JOBS)
+
+
+def test_state_is_reset_when_the_file_changes(data_dir):
+    state = LoadState("state.json")
+    entry = state.get("jobs.csv", os.stat("data/jobs.csv"))
+    state.save("jobs.csv", dict(entry, offset=10))
+
+    assert LoadState("state.json").get("jobs.csv", os.stat("data/jobs.csv"))["offset"] == 10
+    restarted = LoadState("state.json", restart=True)
+    assert restarted.get("jobs.csv", os.stat("data/jobs.csv"))["offset"] == 0
+    with open("data/jobs.csv", "a") as f:
+        f.write("11,Job 11\n")
+    assert LoadState("state.json").get("jobs.csv", os.stat("data/jobs.csv"))["offset"] == 0
+
+
+def test_failed_loads_resume_after_the_last_committed_chunk(data_dir, monkeypatch):
+    copied = []
+    failures = [1]
+
+    def copy_into_table(connection, table_name, stream):
+        if copied and failures:
+            raise RuntimeError(f"Connection lost {failures.pop()}")
+        lines = stream.read().decode().splitlines()
+        copied.append(lines)
+        return {"copied": len(lines), "inserted": len(lines)}
+
+    monkeypatch.setattr(load_historical_data, "copy_into_table", copy_into_table)
+    with pytest.raises(RuntimeError):
+        copy_file("jobs.csv", LoadState("state.json"), chunk_rows=4)
+
+    result = copy_file("jobs.csv", LoadState("state.json"), chunk_rows=4)
+
+    # The invalid rows 4 and 7 are dropped, and no chunk is loaded twice
+    assert copied == [
+        ["1,Job 1", "2,Job 2", "3,Job 3"],
+        ["5,Job 5", "6,Job 6", "8,Job 8"],
+        ["9,Job 9", "10,Job 10"],
+    ]
+    assert (result["rows"], result["done"]) == (8, True)
+    assert sum(result["dropped"].values()) == 2
+    assert copy_file("jobs.csv", LoadState("state.json"))["skipped"]
+
+
+def test_copy_file_loads_the_table(client, data_dir):
+    if not supports_copy(get_engine()):
+        pytest.skip("COPY needs Postgres")
+
+    result = copy_file("jobs.csv", LoadState("state.json"), chunk_rows=4)
+
+    assert result["inserted"] == count_rows("jobs") == 8
+    with get_engine().connect() as connection:
+        job = connection.execute(sqlalchemy.text("SELECT job FROM jobs WHERE id = 10"))
+        assert job.scalar() == "Job 10"
@@ -0,0 +1,79 @@
+"""
+/employees_metrics/ and /department_metrics/ for one or several years;
+their SQL needs Postgres.
+"""
+
+import json
+import pytest
+import metrics
+from cache import get_result_cache
+from conftest import employees
+from metrics import metrics_years
+from utils import get_engine
+
+
+def post_metrics(client, endpoint, config):
+    response = client.post(f"/{endpoint}/", json=config, params={"format": "ndjson"})
+    assert response.status_code == 200, response.text
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+@pytest.fixture
+def hired(seeded):
+    if get_engine().dialect.name != "postgresql":
+        pytest.skip("The metrics SQL needs Postgres")
+    rows = employees(range(1, 25)) + employees(range(25, 31), datetime="2022-05-01T00:00:00")
+    seeded.post("/batch-transactions/", json={"table_name": "hired_employees", "data": rows})
+    return seeded
+
+
+@pytest.mark.parametrize(
+    "config, years",
+    [
+        ({"year": 2021}, [2021]),
+        ({"years": [2022, 2021, 2022]}, [2021, 2022]),
+        ({"year": 2021, "years": [2020]}, [2020]),
+    ],
+)
+def test_years(config, years):
+    assert metrics_years(config) == years
+
+
+@pytest.mark.parametrize(
+    "config", [{}, {"year": "2021"}, {"year": True}, {"years": 2021}, {"years": []}]
+)
+def test_invalid_years(client, config):
+    with pytest.raises(ValueError):
+        metrics_years(config)
+    assert client.post("/employees_metrics/", json=config).status_code == 400
+
+
+def test_employees_metrics_of_one_year(hired):
+    rows = post_metrics(hired, "employees_metrics", {"year": 2021})
+
+    assert "year" not in rows[0]
+    assert sum(row["Q1"] + row["Q2"] + row["Q3"] + row["Q4"] for row in rows) == 24
+    assert [(row["department"], row["job"]) for row in rows] == sorted(
+        (row["department"], row["job"]) for row in rows
+    )
+
+
+def test_department_metrics_of_several_years(hired):
+    rows = post_metrics(hired, "department_metrics", {"years": [2021, 2022]})
+
+    # Every department hires 6 employees in 2021, and 2 and 3 hire
+    # 2 of the 6 hired in 2022
+    assert sorted((row["year"], row["id"], row["total_employees"]) for row in rows) == [
+        (2022, 2, 2),
+        (2022, 3, 2),
+    ]
+
+
+@pytest.mark.parametrize("endpoint", ["employees_metrics", "department_metrics"])
+def test_summary_and_raw_sources_match(hired, monkeypatch, endpoint):
+    config = {"years": [2021, 2022]}
+    summary = post_metrics(hired, endpoint, config)
+    monkeypatch.setattr(metrics, "METRICS_SOURCE", "raw")
+    get_result_cache().clear()
+
+    assert post_metrics(hired, endpoint, config) == summary
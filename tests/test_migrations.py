@@ -0,0 +1,50 @@
+"""
+Migrations run in order and exactly once, also from concurrent processes;
+applying them needs Postgres.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import sqlalchemy
+from migrations import apply_migrations, migration_status, migrations
+from utils import get_engine
+
+
+@pytest.fixture
+def engine(client):
+    engine = get_engine()
+    if engine.dialect.name != "postgresql":
+        pytest.skip("Migrations need Postgres")
+    return engine
+
+
+def test_versions_are_unique_and_ordered():
+    versions = [version for version, _, _ in migrations]
+    assert versions == sorted(set(versions))
+
+
+def test_migrations_are_applied_once(engine):
+    apply_migrations(engine)
+
+    assert apply_migrations(engine) == []
+    assert all(done for _, _, done in migration_status(engine))
+
+
+def test_concurrent_upgrades_apply_each_migration_once(engine):
+    with engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.text("DELETE FROM schema_migrations WHERE version = :version"),
+            {"version": migrations[-1][0]},
+        )
+
+    with ThreadPoolExecutor(4) as executor:
+        applied = list(executor.map(lambda _: apply_migrations(engine), range(4)))
+
+    assert sorted(applied) == [[], [], [], [migrations[-1][0]]]
+
+
+def test_status_lists_every_migration(engine):
+    status = migration_status(engine)
+    assert [(version, description) for version, description, _ in status] == [
+        (version, description) for version, description, _ in migrations
+    ]
@@ -0,0 +1,75 @@
+"""
+Result formats are negotiated from ?format= or Accept, and every encoder
+streams the same rows batch by batch.
+"""
+
+import csv, io, json
+import pytest
+from result_formats import encode_rows, negotiate_format
+
+COLUMNS = [("id", "int"), ("department", "string")]
+BATCHES = [[(1, "Sales"), (2, "Staff, \"HR\"")], [], [(3, None)]]
+ROWS = [row for batch in BATCHES for row in batch]
+
+
+@pytest.mark.parametrize(
+    "requested, accept, expected",
+    [
+        (None, None, "csv"),
+        (None, "*/*", "csv"),
+        (None, "application/x-ndjson", "ndjson"),
+        (None, "text/html, application/vnd.apache.parquet;q=0.9", "parquet"),
+        (None, "application/x-ndjson;q=0.5, text/csv", "csv"),
+        (None, "text/csv;q=0.2, application/x-ndjson;q=0.8", "ndjson"),
+        (None, "application/x-ndjson;q=0, */*;q=0.1", "csv"),
+        (None, "*/*;q=0.5, application/x-ndjson", "ndjson"),
+        (None, "application/x-ndjson;q=high, text/csv;q=0.1", "csv"),
+        (None, "application/json, text/html", "csv"),
+        ("arrow", "text/csv", "arrow"),
+    ],
+)
+def test_negotiation(requested, accept, expected):
+    assert negotiate_format(requested, accept) == expected
+
+
+def test_unknown_formats_are_rejected():
+    with pytest.raises(ValueError):
+        negotiate_format("xlsx")
+
+
+def encoded(format_name):
+    chunks = list(encode_rows(format_name, COLUMNS, iter(BATCHES)))
+    assert all(chunks)
+    return b"".join(chunks)
+
+
+def test_csv():
+    rows = list(csv.reader(io.StringIO(encoded("csv").decode())))
+    assert rows == [["id", "department"], ["1", "Sales"], ["2", 'Staff, "HR"'], ["3", ""]]
+
+
+def test_ndjson():
+    lines = encoded("ndjson").decode().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"id": id, "department": department} for id, department in ROWS
+    ]
+
+
+def test_arrow():
+    pa = pytest.importorskip("pyarrow")
+    table = pa.ipc.open_stream(encoded("arrow")).read_all()
+    assert table.column_names == ["id", "department"]
+    assert list(zip(*(table.column(name).to_pylist() for name in table.column_names))) == ROWS
+
+
+def test_parquet():
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(io.BytesIO(encoded("parquet")))
+    assert list(zip(*(table.column(name).to_pylist() for name in table.column_names))) == ROWS
+
+
+def test_metrics_formats_are_negotiated_before_the_query(client):
+    response = client.post("/employees_metrics/", json={"year": 2021}, params={"format": "xlsx"})
+    assert response.status_code == 400
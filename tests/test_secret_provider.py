@@ -0,0 +1,91 @@
+"""
+SecretProvider serves secrets from its TTL cache and refreshes them before
+they expire, keeping the old value when a refresh fails.
+"""
+
+import json
+import pytest
+from secret_provider import EnvBackend, FileBackend, SecretProvider
+
+
+class CountingBackend:
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    def fetch(self, secret_id, version_id="latest"):
+        if self.fail:
+            raise RuntimeError("Secret Manager is unavailable")
+        self.calls += 1
+        return f"{secret_id}-{self.calls}"
+
+
+def test_values_are_cached_until_they_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("secret_provider.time.monotonic", lambda: now[0])
+    backend = CountingBackend()
+    provider = SecretProvider(backend, ttl=60)
+
+    assert provider.get("db_user") == "db_user-1"
+    assert provider.get("db_user") == "db_user-1"
+    now[0] += 61
+    assert provider.get("db_user") == "db_user-2"
+
+    assert backend.calls == 2
+    assert provider.stats()["hits"] == 1
+    assert provider.stats()["misses"] == 2
+
+
+def test_expiring_values_are_refreshed(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("secret_provider.time.monotonic", lambda: now[0])
+    backend = CountingBackend()
+    provider = SecretProvider(backend, ttl=60, refresh_margin=10)
+    provider.get("db_user")
+
+    provider.refresh_expiring()
+    assert backend.calls == 1
+
+    now[0] += 55
+    provider.refresh_expiring()
+    assert backend.calls == 2
+    assert provider.get("db_user") == "db_user-2"
+    assert provider.stats()["refreshes"] == 1
+
+
+def test_failed_refreshes_keep_the_old_value(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("secret_provider.time.monotonic", lambda: now[0])
+    backend = CountingBackend()
+    provider = SecretProvider(backend, ttl=60, refresh_margin=10)
+    provider.get("db_user")
+
+    backend.fail = True
+    now[0] += 55
+    provider.refresh_expiring()
+
+    assert provider.get("db_user") == "db_user-1"
+    assert provider.stats()["refresh_errors"] == 1
+
+
+def test_background_refresh_thread_stops():
+    provider = SecretProvider(CountingBackend(), ttl=60)
+    provider.start()
+    provider.start()
+    provider.stop()
+    assert provider._thread is None
+
+
+def test_env_backend(monkeypatch):
+    monkeypatch.setenv("SECRET_DB_USER", "api")
+    assert EnvBackend().fetch("db_user") == "api"
+    with pytest.raises(KeyError):
+        EnvBackend().fetch("db_pass")
+
+
+def test_file_backend(tmp_path):
+    path = tmp_path / "secrets.json"
+    path.write_text(json.dumps({"db_user": "api"}))
+    assert FileBackend(str(path)).fetch("db_user") == "api"
+    with pytest.raises(KeyError):
+        FileBackend(str(path)).fetch("db_pass")
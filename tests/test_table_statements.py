@@ -0,0 +1,64 @@
+"""
+The statement registry builds the statements of every table once, and
+their compiled forms are kept in its own compiled cache.
+"""
+
+import pytest
+import table_statements
+from conftest import employees
+from config import tables
+from table_statements import compile_statements, execute_statement, get_table_statements
+from utils import get_engine, insert_batch_data
+
+
+def test_every_table_has_its_statements():
+    assert set(table_statements.registry) == set(tables)
+    statements = get_table_statements("hired_employees")
+    assert statements is get_table_statements("hired_employees")
+    assert statements.columns == ["id", "name", "datetime", "department_id", "job_id"]
+    assert statements.has_summary
+    assert not get_table_statements("jobs").has_summary
+
+
+def test_unknown_tables():
+    with pytest.raises(ValueError):
+        get_table_statements("employees")
+
+
+def test_statements_compile_for_the_engine(client):
+    compiled = compile_statements(get_engine())
+    assert set(compiled) == {
+        (table_name, name)
+        for table_name in tables
+        for name in ("select", "insert", "insert_strict", "upsert", "select_existing")
+    }
+    assert "ON CONFLICT" in compiled[("jobs", "insert")]
+
+
+def test_selects_are_compiled_once(seeded):
+    insert_batch_data("hired_employees", employees(range(1, 10)))
+    select = get_table_statements("hired_employees").select
+    table_statements.compiled_cache.clear()
+
+    for _ in range(3):
+        with get_engine().connect() as connection:
+            rows = execute_statement(connection, select).all()
+
+    assert [row.id for row in rows] == list(range(1, 10))
+    assert len(table_statements.compiled_cache) == 1
+
+
+def test_only_the_selects_can_be_cached():
+    # SQLAlchemy's postgresql.Insert opts out of the compiled cache
+    for statements in table_statements.registry.values():
+        cacheable = {
+            name for name, statement in statements.statements().items()
+            if statement._generate_cache_key() is not None
+        }
+        assert cacheable == {"select", "select_existing"}
+
+
+def test_staged_rows_are_locked_in_id_order():
+    statements = get_table_statements("hired_employees")
+    assert statements.lock_staged.endswith("ORDER BY id FOR UPDATE")
+    assert "FOR UPDATE" not in statements.move["update"]
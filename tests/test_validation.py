@@ -0,0 +1,146 @@
+"""
+validate_batch must accept and reject exactly the rows the Pydantic models
+in config.py do.
+"""
+
+import random
+import pandas as pd
+import pytest
+import validation
+from config import transactions
+from reference_index import ReferenceIndex
+from validation import validate_batch
+
+VALUES = [
+    1, 7, 0, -3, 2**40, 1.0, 2.5, float("nan"), True, False, None,
+    "12", "0", "-1", "", " ", "  x ", "name", "\t",
+    "2021-07-27T16:02:08", "2021-02-29T00:00:00", "2020-02-29T00:00:00",
+    "2021-7-27T16:02:08", "2021-07-27t16:02:08", "2021-07-27T16:02:08Z",
+    "2021-13-01T00:00:00", "2021-07-27 16:02:08", "0000-01-01T00:00:00",
+    [], {},
+]
+
+FIELDS = {
+    "hired_employees": ["id", "name", "datetime", "department_id", "job_id"],
+    "departments": ["id", "department"],
+    "jobs": ["id", "job"],
+}
+
+
+def model_accepts(table_name, row):
+    try:
+        transactions[table_name](**row)
+        return True
+    except Exception:
+        return False
+
+
+def random_row(rng, table_name):
+    if rng.random() < 0.02:
+        return rng.choice([None, 5, "row", []])
+    row = {}
+    for field in FIELDS[table_name]:
+        if rng.random() < 0.05:
+            continue
+        row[field] = rng.choice(VALUES)
+    return row
+
+
+def random_batch(rng, table_name):
+    # Some batches keep a column uniform, e.g. only ints or only None
+    rows = [random_row(rng, table_name) for _ in range(rng.randint(1, 12))]
+    if rng.random() < 0.3:
+        field = rng.choice(FIELDS[table_name])
+        value = rng.choice(VALUES)
+        for row in rows:
+            if isinstance(row, dict):
+                row[field] = value
+    return rows
+
+
+@pytest.fixture(autouse=True)
+def unloaded_references(monkeypatch):
+    # References are checked by the reference index tests, not the models
+    index = ReferenceIndex()
+    monkeypatch.setattr(validation, "get_reference_index", lambda: index)
+
+
+@pytest.mark.parametrize("table_name", list(FIELDS))
+def test_matches_models(table_name):
+    rng = random.Random(table_name)
+    for _ in range(1000):
+        batch = random_batch(rng, table_name)
+        accepted, rejected = validate_batch(table_name, batch)
+        expected = [i for i, row in enumerate(batch) if model_accepts(table_name, row)]
+        rejected_indexes = {x["index"] for x in rejected}
+        assert [i for i in range(len(batch)) if i not in rejected_indexes] == expected, batch
+        assert accepted == [batch[i] for i in expected]
+
+
+@pytest.mark.parametrize(
+    "batch",
+    [
+        [{"id": 1, "job": 5}],
+        [{"id": 1, "job": None}, {"id": 2, "job": None}],
+        [{"id": 1, "job": 5}, {"id": 2, "job": "Engineer"}],
+    ],
+)
+def test_non_string_names_are_rejected(batch):
+    accepted, rejected = validate_batch("jobs", batch)
+    assert [x["index"] for x in rejected] == [
+        i for i, row in enumerate(batch) if not isinstance(row["job"], str)
+    ]
+    assert all(x["errors"][0]["field"] == "job" for x in rejected)
+
+
+def test_reports_every_failed_field():
+    accepted, rejected = validate_batch(
+        "hired_employees",
+        [{"id": -1, "name": " ", "datetime": "2021-07-27T16:02:08", "department_id": 1, "job_id": 1}],
+    )
+    assert accepted == []
+    assert {x["field"] for x in rejected[0]["errors"]} == {"id", "name"}
+
+
+def test_rules_are_built_once():
+    assert validation.get_rules("jobs") is validation.get_rules("jobs")
+    with pytest.raises(ValueError):
+        validation.get_rules("jobs", profile="strict")
+
+
+@pytest.mark.parametrize("profile", ["api", "legacy"])
+def test_filter_frame_applies_the_rules_of_the_batch_endpoint(profile):
+    rows = [
+        {"id": 1, "name": "Ann", "datetime": "2021-07-27T16:02:08", "department_id": 1, "job_id": 1},
+        {"id": 2, "name": "Bob", "datetime": "2021-07-27T16:02:08Z", "department_id": 1, "job_id": 1},
+        {"id": 3, "name": " ", "datetime": "2021-07-27T16:02:08", "department_id": 1, "job_id": 1},
+        {"id": 0, "name": "Cid", "datetime": "2021-07-27T16:02:08", "department_id": 1, "job_id": 1},
+        {"id": 5, "name": "Dee", "datetime": "2021-02-29T00:00:00", "department_id": 1, "job_id": 1},
+        {"id": 6, "name": "Eve", "datetime": "2021-07-27T16:02:08", "department_id": -1, "job_id": 1},
+    ]
+
+    kept, dropped = validation.filter_frame("hired_employees", pd.DataFrame(rows), profile)
+
+    accepted, _ = validate_batch("hired_employees", rows)
+    expected = [row["id"] for row in accepted]
+    if profile == "legacy":
+        # The legacy CSVs end their datetimes in a "Z"
+        expected = sorted(expected + [2])
+    assert kept["id"].tolist() == expected
+    assert sum(dropped.values()) == len(rows) - len(expected)
+
+
+@pytest.mark.parametrize("value", [2**63, str(2**64), 2**70])
+def test_references_above_the_int64_range_are_rejected(value):
+    batch = [
+        {"id": 1, "name": "Ann", "datetime": "2021-07-27T16:02:08", "department_id": 1, "job_id": 1},
+        {"id": 2, "name": "Bob", "datetime": "2021-07-27T16:02:08", "department_id": value, "job_id": 1},
+    ]
+
+    accepted, rejected = validate_batch("hired_employees", batch)
+
+    assert accepted == batch[:1]
+    assert rejected[0]["index"] == 1
+    assert rejected[0]["errors"] == [
+        {"field": "department_id", "message": "Department ID is out of range"}
+    ]
@@ -1,34 +1,14 @@
-from avro import schema, io, datafile
-from avro.datafile import DataFileWriter
-from avro.io import DatumReader, DatumWriter
-from google.cloud import storage, secretmanager
 from google.cloud.sql.connector import Connector, IPTypes
-import subprocess, pg8000, sqlalchemy, os
-from sqlalchemy.sql.expression import bindparam
-from sqlalchemy.dialects.postgresql import insert
+import pg8000, sqlalchemy, os, threading, csv, json
+from contextlib import nullcontext
+from io import StringIO, TextIOBase
 from config import *
-
-
-def retrieve_secret(secret_id, version_id="latest"):
-    """
-    Retrieves a secret from Google Secret Manager.
-
-    Parameters:
-    - secret_id (str): The ID of the secret to retrieve.
-    - version_id (str, optional): The version of the secret to retrieve. 
-        Defaults to "latest".
-
-    Returns:
-    - str: The secret payload data decodded as UTF-8.
-    """
-    client = secretmanager.SecretManagerServiceClient()
-    secret_version_name = (
-        f"projects/globant-api/secrets/{secret_id}/versions/{version_id}"
-    )
-    # Access the secret version
-    response = client.access_secret_version(name=secret_version_name)
-    # Return the secret payload
-    return response.payload.data.decode("UTF-8")
+from secret_provider import retrieve_secret
+from cache import bump_table_version, get_result_cache, table_versions
+from aggregates import DELETE_EMPTY_SUMMARY, apply_summary_deltas, summary_deltas
+from reference_index import get_reference_index, referenced_tables
+from table_statements import conflict_modes, execute_statement, get_table_statements
+from instrumentation import inc, span, timed
 
 
 def connect_with_connector() -> sqlalchemy.engine.base.Engine:
@@ -37,7 +17,36 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
 
     Uses the Cloud SQL Python Connector package to connect to the database,
     and the Secrets Manager to retrieve the database credentials.
+
+    If the DATABASE_URL environment variable is set, the pool is created
+    against that URL instead (e.g. a local Postgres or SQLite stand-in),
+    without touching Secret Manager or the Cloud SQL Connector. An
+    in-memory SQLite database (sqlite://, as in the tests) lives in a
+    single connection, which every thread shares.
+
+    The pool is bounded by DB_POOL_SIZE and DB_MAX_OVERFLOW, plus the
+    DB_BACKGROUND_CONNECTIONS of the workers that run outside the "db"
+    limiter (see concurrency.py); connections are pinged on checkout and
+    recycled after DB_POOL_RECYCLE seconds. The time
+    spent checking out connections is recorded as the db_checkout stage.
     """
+    global _connector
+
+    if DATABASE_URL:
+        pool_options = {"pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE}
+        if DATABASE_URL in ("sqlite://", "sqlite:///:memory:"):
+            pool_options = {
+                "poolclass": sqlalchemy.pool.StaticPool,
+                "connect_args": {"check_same_thread": False},
+            }
+        elif not DATABASE_URL.startswith("sqlite"):
+            pool_options.update(
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW + DB_BACKGROUND_CONNECTIONS,
+                pool_timeout=DB_POOL_TIMEOUT,
+            )
+        engine = sqlalchemy.create_engine(DATABASE_URL, **pool_options)
+        return time_checkouts(use_utc_sessions(engine))
 
     instance_connection_name = retrieve_secret("instance_connection_name")
     db_user = retrieve_secret("db_user")
@@ -48,16 +57,18 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
 
     # initialize Cloud SQL Python Connector object
     connector = Connector()
+    _connector = connector
 
     def getconn() -> pg8000.dbapi.Connection:
-        conn: pg8000.dbapi.Connection = connector.connect(
-            instance_connection_name,
-            "pg8000",
-            user=db_user,
-            password=db_pass,
-            db=db_name,
-            ip_type=ip_type,
-        )
+        with span("db_connect"):
+            conn: pg8000.dbapi.Connection = connector.connect(
+                instance_connection_name,
+                "pg8000",
+                user=db_user,
+                password=db_pass,
+                db=db_name,
+                ip_type=ip_type,
+            )
         return conn
 
     # The Cloud SQL Python Connector can be used with SQLAlchemy
@@ -65,11 +76,99 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
     pool = sqlalchemy.create_engine(
         "postgresql+pg8000://",
         creator=getconn,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW + DB_BACKGROUND_CONNECTIONS,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
     )
-    return pool
+    return time_checkouts(use_utc_sessions(pool))
+
+
+def use_utc_sessions(engine):
+    """
+    Sets the time zone of every new Postgres connection of the engine to UTC,
+    so timestamps without a zone are stored as UTC and TIMESTAMPTZ values
+    are returned in UTC.
+    """
+    if engine.dialect.name != "postgresql":
+        return engine
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_time_zone(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET TIME ZONE 'UTC'")
+        cursor.close()
+        # Commit so the pool's rollback on checkin does not undo the SET
+        dbapi_connection.commit()
+
+    return engine
 
 
-def insert_batch_data(table_name, batch_data):
+def time_checkouts(engine):
+    """
+    Records the time every checkout from the engine's pool takes (waiting
+    for a free connection, opening and pinging it) as the db_checkout stage.
+    """
+    engine.pool.connect = timed("db_checkout")(engine.pool.connect)
+    return engine
+
+
+# Process-wide engine, created once at startup and shared by every request
+_engine = None
+_connector = None
+_engine_lock = threading.Lock()
+
+
+def init_engine() -> sqlalchemy.engine.base.Engine:
+    """
+    Creates the process-wide engine if it does not exist yet.
+
+    Returns:
+    - sqlalchemy.engine.base.Engine: The shared engine.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = connect_with_connector()
+    return _engine
+
+
+def get_engine() -> sqlalchemy.engine.base.Engine:
+    """
+    Returns the process-wide engine, creating it on first use.
+    """
+    if _engine is None:
+        return init_engine()
+    return _engine
+
+
+def dispose_engine():
+    """
+    Closes every pooled connection and the Cloud SQL Connector, if any.
+    Called on application shutdown.
+    """
+    global _engine, _connector
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+        if _connector is not None:
+            _connector.close()
+            _connector = None
+
+
+class ConflictError(Exception):
+    """
+    Raised in the "error" conflict mode when a row's id already exists
+    or repeats in the batch. Nothing of the batch is written.
+    """
+
+
+@timed("insert")
+def insert_batch_data(
+    table_name, batch_data, method=None, on_conflict=None, connection=None
+):
     """
     Inserts batch data into the specified table.
 
@@ -78,97 +177,492 @@ def insert_batch_data(table_name, batch_data):
       Options are 'hired_employees', 'departments', or 'jobs'.
     - batch_data (list): A list of dictionaries.
       Each dictionary should contain the necessary fields for the specified table.
+    - method (str, optional): 'copy' to bulk load through a staging table,
+      'executemany' for row-by-row inserts, or 'auto' to use COPY when the
+      driver supports it and the batch has at least COPY_MIN_ROWS rows.
+      Defaults to BULK_LOAD_METHOD.
+    - on_conflict (str, optional): What to do with rows whose id already
+      exists: 'skip' them, 'update' them (if a value differs; the last
+      row of an id repeated in the batch wins) or raise an 'error'.
+      Defaults to ON_CONFLICT.
+    - connection (sqlalchemy.engine.Connection, optional): Write the rows in
+      the transaction of this connection, which the caller commits and then
+      calls record_commit. By default they are committed before returning.
 
     Returns:
-    - None
+    - dict: The number of rows "inserted", "updated" and the
+      "duplicates" that were skipped or left unchanged.
+
+    Raises:
+    - ValueError: If the table, method or conflict mode are invalid.
+    - ConflictError: If on_conflict is 'error' and an id already exists.
     """
     if table_name not in tables.keys():
         raise ValueError(f"Table {table_name} does not exist")
-    conn = connect_with_connector().connect()
-    table = tables[table_name]
-    columns = [x.name for x in table.columns]
-    parameter_dict = {}
-    for column in columns:
-        parameter_dict[column] = bindparam(column)
-    statement = insert(table).values(parameter_dict)
-    statement = statement.on_conflict_do_nothing(index_elements=["id"])
-    conn.execute(statement, batch_data)
-    conn.commit()
-    conn.close()
+    on_conflict = on_conflict or ON_CONFLICT
+    if on_conflict not in conflict_modes:
+        raise ValueError(
+            f"Invalid conflict mode {on_conflict}. Please use 'skip', 'update' or 'error'"
+        )
+    if not batch_data:
+        return {"inserted": 0, "updated": 0, "duplicates": 0}
+    method = method or BULK_LOAD_METHOD
+    if method == "auto":
+        use_copy = supports_copy(get_engine()) and len(batch_data) >= COPY_MIN_ROWS
+        method = "copy" if use_copy else "executemany"
+    if method not in ("copy", "executemany"):
+        raise ValueError(
+            f"Invalid bulk load method {method}. Please use 'auto', 'copy' or 'executemany'"
+        )
+    try:
+        if method == "copy":
+            counts = copy_batch_data(table_name, batch_data, on_conflict, connection)
+        else:
+            counts = executemany_batch_data(table_name, batch_data, on_conflict, connection)
+    except sqlalchemy.exc.IntegrityError as e:
+        if on_conflict != "error":
+            raise
+        raise ConflictError(f"Rows of the batch conflict with existing ones: {e.orig}") from e
+    inc("rows_inserted_total", counts["inserted"], table=table_name)
+    inc("rows_updated_total", counts["updated"], table=table_name)
+    inc("rows_duplicate_total", counts["duplicates"], table=table_name)
+    if connection is None:
+        record_commit(table_name, counts, batch_data)
+    return counts
+
+
+def record_commit(table_name, counts, batch_data):
+    """
+    Invalidates the cached results computed from a table once rows of it
+    were committed, and adds their ids to the reference index.
+
+    Parameters:
+    - table_name (str): The table written.
+    - counts (dict): The rows "inserted" and "updated", as returned by
+      insert_batch_data (added up for several batches).
+    - batch_data (list): The rows written, inserted or not.
+    """
+    if counts["inserted"] or counts["updated"]:
+        bump_table_version(table_name)
+    if table_name in referenced_tables:
+        # Every id of the batch exists now, inserted or not
+        get_reference_index().add(table_name, [row["id"] for row in batch_data])
+
+
+def _transaction(connection=None):
+    """A new transaction, or the one of the caller's connection."""
+    return get_engine().begin() if connection is None else nullcontext(connection)
 
 
-def query_table(table_name: str):
+def executemany_batch_data(table_name, batch_data, on_conflict="skip", connection=None):
     """
-    Query data from the specified table.
+    Inserts batch data with an executemany of INSERT ... RETURNING,
+    updating hiring_summary with the hired_employees rows that were
+    inserted or updated.
+
+    Returns:
+    - dict: The rows inserted, updated and the duplicates.
+    """
+    statements = get_table_statements(table_name)
+    rows = batch_data
+    if on_conflict == "update":
+        # ON CONFLICT DO UPDATE cannot change a row twice in a statement
+        rows = list({row["id"]: row for row in batch_data}.values())
+    statement = {
+        "skip": statements.insert,
+        "update": statements.upsert,
+        "error": statements.insert_strict,
+    }[on_conflict]
+    with _transaction(connection) as conn:
+        old = []
+        if on_conflict == "update" and statements.has_summary:
+            # The values the updated rows had, to move their summary counts
+            old = execute_statement(
+                conn, statements.select_existing, {"ids": [row["id"] for row in rows]}
+            ).all()
+        written = execute_statement(conn, statement, rows).all()
+        if on_conflict == "update":
+            updated = {row.id for row in written if not row.inserted}
+        else:
+            updated = set()
+        if statements.has_summary:
+            deltas = summary_deltas(row[1:4] for row in written)
+            deltas.subtract(summary_deltas(row[1:] for row in old if row.id in updated))
+            apply_summary_deltas(conn, deltas)
+    return {
+        "inserted": len(written) - len(updated),
+        "updated": len(updated),
+        "duplicates": len(batch_data) - len(written),
+    }
+
+
+def supports_copy(engine) -> bool:
+    """
+    Whether COPY FROM STDIN can be used with the engine's driver.
+    """
+    return engine.dialect.name == "postgresql" and engine.dialect.driver in (
+        "pg8000",
+        "psycopg2",
+    )
+
+
+class RowStream(TextIOBase):
+    """
+    Read-only text stream that renders rows as CSV lazily,
+    so COPY FROM STDIN never needs the whole batch as one string.
+
+    None is written as \\N (the COPY NULL marker), and values of integer
+    columns are converted with int() like the database would on insert.
+    """
+
+    def __init__(self, rows, table, rows_per_chunk=1000):
+        self.columns = [x.name for x in data_columns(table)]
+        self.integer_columns = {
+            x.name for x in data_columns(table) if isinstance(x.type, sqlalchemy.Integer)
+        }
+        self.rows = iter(rows)
+        self.rows_per_chunk = rows_per_chunk
+        self.rows_written = 0
+        self._buffer = ""
+
+    def readable(self):
+        return True
+
+    def _render_chunk(self):
+        out = StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        count = 0
+        for row in self.rows:
+            values = []
+            for column in self.columns:
+                value = row.get(column)
+                if value is None:
+                    value = "\\N"
+                elif column in self.integer_columns:
+                    value = int(value)
+                values.append(value)
+            writer.writerow(values)
+            count += 1
+            if count == self.rows_per_chunk:
+                break
+        self.rows_written += count
+        return out.getvalue()
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            chunk = self._render_chunk()
+            if not chunk:
+                break
+            self._buffer += chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def copy_from_stream(connection, statement, stream):
+    """
+    Runs a COPY ... FROM STDIN statement on the connection's DBAPI cursor.
 
     Parameters:
-    - table_name (str): The name of the table to query data from.
+    - connection (sqlalchemy.engine.Connection): An open connection.
+    - statement (str): The COPY statement.
+    - stream: A readable file-like object with the data to copy.
 
     Returns:
-    - list: A list of tuples representing the queried data.
+    - int: The number of rows copied.
+    """
+    cursor = connection.connection.cursor()
+    try:
+        if hasattr(cursor, "copy_expert"):
+            # psycopg2
+            cursor.copy_expert(statement, stream)
+        else:
+            # pg8000
+            cursor.execute(statement, stream=stream)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def copy_into_table(connection, table_name, stream, null="\\N", on_conflict="skip"):
+    """
+    COPYs CSV rows from a stream into a temporary staging table, then moves
+    them with a single INSERT ... SELECT ... (which also updates
+    hiring_summary for hired_employees).
 
-    Raises:
-    - ValueError: If the specified table does not exist.
+    Parameters:
+    - connection (sqlalchemy.engine.Connection): An open connection,
+      in the transaction the rows are committed with.
+    - table_name (str): The table to load.
+    - stream: A readable file-like object with headerless CSV rows
+      in the order of the table's columns.
+    - null (str): The string that represents NULL in the CSV.
+    - on_conflict (str): 'skip', 'update' or 'error', see insert_batch_data.
 
+    Returns:
+    - dict: The rows "copied", and the rows "inserted", "updated" and the
+      "duplicates" that were skipped or left unchanged.
     """
-    # Use SQLAlchemy to query data from the specified table
-    if table_name not in tables.keys():
-        raise ValueError(f"Table {table_name} does not exist")
-    engine = connect_with_connector()
-    with engine.connect() as connection:
-        metadata = MetaData()
-        table = Table(table_name, metadata, autoload_with=connection)
-        result = connection.execute(table.select())
-        return result.fetchall()
+    statements = get_table_statements(table_name)
+    connection.execute(sqlalchemy.text(statements.create_staging))
+    copied = copy_from_stream(connection, statements.copy(null), stream)
+    if on_conflict == "update" and statements.has_summary:
+        # So no other writer changes the rows between the values the move
+        # reads and the ones it updates, like select_existing does
+        connection.execute(sqlalchemy.text(statements.lock_staged))
+    inserted, updated = connection.execute(
+        sqlalchemy.text(statements.move[on_conflict])
+    ).one()
+    if updated and statements.has_summary:
+        connection.execute(sqlalchemy.text(DELETE_EMPTY_SUMMARY))
+    connection.execute(sqlalchemy.text(statements.drop_staging))
+    return {
+        "copied": copied,
+        "inserted": inserted,
+        "updated": updated,
+        "duplicates": copied - inserted - updated,
+    }
+
+
+def copy_batch_data(table_name, batch_data, on_conflict="skip", connection=None):
+    """
+    Bulk loads batch data with COPY FROM STDIN through a staging table
+    (see copy_into_table).
+
+    Returns:
+    - dict: The rows inserted, updated and the duplicates.
+    """
+    with _transaction(connection) as conn:
+        counts = copy_into_table(
+            conn, table_name, RowStream(batch_data, tables[table_name]), on_conflict=on_conflict
+        )
+    del counts["copied"]
+    return counts
 
 
-def serialize_to_avro(data, avro_schema, file_name):
+async def iter_ndjson_lines(stream, max_line_bytes=STREAM_MAX_LINE_BYTES):
     """
-    Serialize data into AVRO format and write it to a file.
+    Splits an async byte stream into non-empty NDJSON lines as it arrives.
+
+    Only the chunk just received is split, and only the unterminated end
+    of the last line is kept, so every byte is scanned once.
 
     Parameters:
-    - data: The data to be serialized. It should be an iterable of records.
-    - avro_schema: The AVRO schema to be used for serialization.
-    - file_name: The name of the file to write the serialized data to.
+    - stream: An async iterator of bytes, e.g. request.stream().
+    - max_line_bytes (int): The longest line accepted.
+
+    Yields:
+    - bytes: One line at a time, without the trailing newline.
+
+    Raises:
+    - ValueError: If a line is longer than max_line_bytes.
+    """
+    # The pieces of the line that is not terminated yet
+    partial = []
+    partial_bytes = 0
+
+    def check(size):
+        if size > max_line_bytes:
+            raise ValueError(f"NDJSON lines must be at most {max_line_bytes} bytes")
+
+    async for chunk in stream:
+        *lines, rest = chunk.split(b"\n")
+        if lines:
+            if partial:
+                check(partial_bytes + len(lines[0]))
+                lines[0] = b"".join(partial) + lines[0]
+                partial, partial_bytes = [], 0
+            for line in lines:
+                check(len(line))
+                if line.strip():
+                    yield line
+        if rest:
+            partial_bytes += len(rest)
+            check(partial_bytes)
+            partial.append(rest)
+    line = b"".join(partial)
+    if line.strip():
+        yield line
+
+
+def parse_ndjson_lines(lines):
+    """
+    Parses NDJSON lines into transactions.
 
     Returns:
-    None
+    - tuple: (data, malformed) where data is the list of parsed objects and
+      malformed the number of lines that are not valid JSON objects.
+    """
+    data = []
+    malformed = 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            malformed += 1
+            continue
+        if isinstance(record, dict):
+            data.append(record)
+        else:
+            malformed += 1
+    return data, malformed
+
+
+def iter_table_batches(
+    table_name: str, batch_size: int = BACKUP_BATCH_SIZE, where=None
+):
+    """
+    Reads a table through a server-side cursor, batch by batch.
+
+    Parameters:
+    - table_name (str): The name of the table to read.
+    - batch_size (int): Number of rows fetched per round-trip.
+    - where (optional): A SQLAlchemy condition restricting the rows read.
 
-    Example Usage:
-    serialize_to_avro(data, avro_schema, file_name)
+    Yields:
+    - list: A list of dictionaries with at most batch_size rows.
+
+    Raises:
+    - ValueError: If the specified table does not exist.
     """
-    writer = DataFileWriter(open(file_name, "wb"), DatumWriter(), avro_schema)
-    for record in data:
-        writer.append(record)
-    writer.close()
+    statement = get_table_statements(table_name).select
+    if where is not None:
+        statement = statement.where(where)
+    with get_engine().connect() as connection:
+        result = connection.execution_options(
+            stream_results=True, yield_per=batch_size
+        ).execute(statement)
+        for partition in result.mappings().partitions():
+            yield [dict(row) for row in partition]
+
+
+class PreparedStatement:
+    """
+    A SQL statement that is prepared (parsed and planned) once per database
+    connection with PREPARE, and then run with EXECUTE on every call.
+
+    Parameters:
+    - name (str): The name of the prepared statement.
+    - sql (str): The statement, with $1, $2... placeholders.
+    - argument_types (list): The SQL types of the placeholders.
+    """
+
+    def __init__(self, name, sql, argument_types):
+        self.name = name
+        self.sql = sql
+        self.argument_types = argument_types
+
+    def prepare(self, connection):
+        """
+        Prepares the statement on the connection, unless it already was.
+        Prepared statements live as long as the pooled DBAPI connection.
+        """
+        prepared = connection.connection.info.setdefault("prepared_statements", set())
+        if self.name not in prepared:
+            connection.execute(
+                sqlalchemy.text(
+                    f"PREPARE {self.name} ({', '.join(self.argument_types)}) AS {self.sql}"
+                )
+            )
+            prepared.add(self.name)
+
+    def execute(self, connection, *arguments):
+        """
+        Runs the statement on an open connection.
+
+        Returns:
+        - sqlalchemy.engine.CursorResult: The result of the statement.
+        """
+        self.prepare(connection)
+        placeholders = ", ".join(f":arg{i}" for i in range(len(arguments)))
+        return connection.execute(
+            sqlalchemy.text(f"EXECUTE {self.name} ({placeholders})"),
+            {f"arg{i}": argument for i, argument in enumerate(arguments)},
+        )
 
-def upload_to_gcs(file_name):
+
+def iter_query_batches(query, arguments=(), batch_size=METRICS_BATCH_SIZE):
     """
-    Uploads a file to Google Cloud Storage.
+    Runs a query and yields its rows batch by batch. A PreparedStatement is
+    executed as prepared, so it is only planned once per connection.
+
+    Metrics results have at most one row per year, department and job, so
+    they are fetched at once rather than through a server-side cursor
+    (Postgres cannot DECLARE a cursor over EXECUTE), and the connection
+    is back in the pool before the first batch is yielded: a consumer
+    never keeps it checked out between batches.
 
-    Args:
-        file_name (str): The name of the file to be uploaded.
+    Parameters:
+    - query (sqlalchemy.text or PreparedStatement): The SQL query to be executed.
+    - arguments (tuple): The arguments of a PreparedStatement.
+    - batch_size (int): Number of rows per batch.
 
+    Yields:
+    - list: A list of tuples with at most batch_size rows.
     """
-    client_storage = storage.Client()
-    bucket_name = "globant-data"
-    bucket = client_storage.bucket(bucket_name)
-    blob = bucket.blob(file_name)
-    blob.upload_from_filename(file_name)
+    with get_engine().connect() as connection:
+        rows = _execute(connection, query, arguments).fetchall()
+    for start in range(0, len(rows), batch_size):
+        yield [tuple(row) for row in rows[start:start + batch_size]]
+
+
+def iter_cached_query_batches(
+    query,
+    cache_key,
+    depends_on,
+    arguments=(),
+    batch_size=METRICS_BATCH_SIZE,
+    max_rows=METRICS_CACHE_MAX_ROWS,
+):
+    """
+    Like iter_query_batches, but serves the batches from the result cache
+    when possible. A result is only cached if it has at most max_rows rows,
+    so large results are streamed without ever being held in memory.
 
+    Parameters:
+    - cache_key (tuple): Identifies the query and its parameters.
+    - depends_on (tuple): The tables the query reads. Writes to any of
+      them invalidate the cached result.
 
-def execute_query(query):
+    Yields:
+    - list: A list of tuples with at most batch_size rows.
+    """
+    key = (cache_key, table_versions(*depends_on))
+    cache = get_result_cache()
+    result = cache.get(key)
+    if result is not None:
+        for start in range(0, len(result), batch_size):
+            yield result[start:start + batch_size]
+        return
+    kept = []
+    for batch in iter_query_batches(query, arguments, batch_size):
+        if kept is not None:
+            kept.extend(batch)
+            if len(kept) > max_rows:
+                kept = None
+        yield batch
+    if kept is not None:
+        cache.set(key, kept)
+
+
+def _execute(connection, query, arguments=()):
+    if isinstance(query, PreparedStatement):
+        return query.execute(connection, *arguments)
+    return connection.execute(query)
+
+
+def execute_query(query, arguments=()):
     """
     Execute the specified query and return the result.
 
     Parameters:
-    - query (sqlalchemy.text): The SQL query to be executed.
+    - query (sqlalchemy.text or PreparedStatement): The SQL query to be executed.
+    - arguments (tuple): The arguments of a PreparedStatement.
 
     Returns:
     - result (list): A list of tuples representing the result of the query.
     """
     # Execute the specified query
-    engine = connect_with_connector()
-    with engine.connect() as connection:
-        result = connection.execute(query)
-    return result.fetchall()
+    with get_engine().connect() as connection:
+        return _execute(connection, query, arguments).fetchall()
@@ -0,0 +1,359 @@
+"""
+Columnar validation of batch transactions.
+
+Validating one Pydantic model per row is the bottleneck for large batches.
+This module checks every column of a batch at once with NumPy/pandas and
+only falls back to the Pydantic models in config.py for the rows the
+columnar checks cannot decide on (e.g. "12", None, a missing key or a
+datetime that is not zero-padded).
+The accept/reject outcome is therefore identical to the models, except
+that hired_employees rows are also rejected when their department or job
+does not exist (see reference_index.py).
+
+Rejected rows are reported as:
+    {"index": 3, "row": {...}, "errors": [{"field": "id", "message": "..."}]}
+
+The rules of each table are built once, as a RuleSet per profile:
+- "api": the batch endpoints, identical to the Pydantic models.
+- "legacy": the historical CSVs (legacy_data_processing), whose datetimes
+  end in a "Z". filter_frame applies it to chunks of a file, dropping the
+  rows it cannot decide on instead of falling back to the models.
+"""
+
+from collections import Counter
+import numpy as np
+import pandas as pd
+from config import transactions
+from reference_index import get_reference_index, references
+from instrumentation import inc, timed
+
+# Canonical form checked in bulk: YYYY-MM-DDTHH:MM:SS, zero-padded.
+# datetime.strptime also accepts e.g. non-padded fields or a lowercase "t",
+# so strings that fail the fast check are re-checked by the model.
+_DIGIT_POSITIONS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_SEPARATORS = {4: "-", 7: "-", 10: "T", 13: ":", 16: ":"}
+_DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def _is_type(column, kind):
+    """Boolean array of the values in column whose type is exactly kind."""
+    inferred = pd.api.types.infer_dtype(column, skipna=False)
+    if (kind is str and inferred == "string") or (kind is int and inferred == "integer"):
+        return np.ones(len(column), dtype=bool)
+    return np.fromiter((type(v) is kind for v in column), bool, len(column))
+
+
+class PositiveInt:
+    """The value is an int greater than zero."""
+
+    def __init__(self, field, message):
+        self.field = field
+        self.message = message
+
+    def check(self, column):
+        """
+        Returns two boolean arrays: the rows this rule could decide on,
+        and the rows that passed it.
+        """
+        if column.dtype.kind in "iu":
+            return np.ones(len(column), dtype=bool), (column > 0).to_numpy()
+        if column.dtype.kind == "f":
+            # ints mixed with missing values; NaN and fractions go to the model
+            values = column.to_numpy()
+            decided = np.isfinite(values) & (np.floor(values) == values)
+            return decided, decided & (values > 0)
+        decided = _is_type(column, int)
+        valid = np.fromiter(
+            (type(v) is int and v > 0 for v in column), bool, len(column)
+        )
+        return decided, valid
+
+
+class NonBlankString:
+    """The value is a string with at least one non-whitespace character."""
+
+    def __init__(self, field, message):
+        self.field = field
+        self.message = message
+
+    def check(self, column):
+        decided = _is_type(column, str)
+        # Only the strings are stripped, .str fails on columns without any
+        strings = column.where(decided, "")
+        valid = strings.str.strip().str.len().gt(0).to_numpy(dtype=bool, na_value=False)
+        return decided, decided & valid
+
+
+class IsoDatetime:
+    """
+    The value is a string in the YYYY-MM-DDTHH:MM:SS format,
+    or YYYY-MM-DDTHH:MM:SSZ if utc_suffix is True.
+    """
+
+    def __init__(self, field, message, utc_suffix=False):
+        self.field = field
+        self.message = message
+        self.utc_suffix = utc_suffix
+        self._separator_positions = np.array(list(_SEPARATORS))
+        self._separator_codes = np.array([ord(x) for x in _SEPARATORS.values()])
+
+    def check(self, column):
+        n = len(column)
+        is_str = _is_type(column, str)
+        strings = column.where(is_str, "").tolist()
+        lengths = np.fromiter(map(len, strings), int, n)
+        codes = np.array(strings, dtype="U20").view(np.uint32).reshape(n, 20)
+
+        length_ok = lengths == 19
+        if self.utc_suffix:
+            length_ok |= (lengths == 20) & (codes[:, 19] == ord("Z"))
+        valid = is_str & length_ok
+        valid &= (codes[:, self._separator_positions] == self._separator_codes).all(axis=1)
+        digits = codes[:, _DIGIT_POSITIONS].astype(np.int64) - ord("0")
+        valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+
+        year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+        month = digits[:, 4] * 10 + digits[:, 5]
+        day = digits[:, 6] * 10 + digits[:, 7]
+        hour = digits[:, 8] * 10 + digits[:, 9]
+        minute = digits[:, 10] * 10 + digits[:, 11]
+        second = digits[:, 12] * 10 + digits[:, 13]
+        valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1)
+        valid &= (hour < 24) & (minute < 60) & (second < 60)
+        month_index = np.clip(month, 1, 12) - 1
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        valid &= day <= _DAYS_IN_MONTH[month_index] + ((month == 2) & leap)
+        return valid, valid
+
+
+class RuleSet:
+    """
+    The rules of a table, checked against the columns of a DataFrame.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+    def check(self, frame):
+        """
+        Returns:
+        - tuple: (decided, failures) where decided is a boolean array of
+          the rows every rule could decide on, and failures a list of
+          (rule, boolean array of the decided rows that failed it).
+        """
+        decided = np.ones(len(frame), dtype=bool)
+        failures = []
+        for rule in self.rules:
+            if rule.field not in frame:
+                # Missing everywhere, the model reports it
+                decided[:] = False
+                continue
+            rule_decided, rule_valid = rule.check(frame[rule.field])
+            decided &= rule_decided
+            failures.append((rule, rule_decided & ~rule_valid))
+        return decided, failures
+
+
+def _table_rules(utc_suffix):
+    return {
+        "hired_employees": RuleSet([
+            PositiveInt("id", "ID must be a positive integer"),
+            NonBlankString("name", "Name cannot be empty or whitespace"),
+            IsoDatetime(
+                "datetime",
+                "Invalid ISO datetime format. Please use the format: YYYY-MM-DDTHH:MM:SS",
+                utc_suffix=utc_suffix,
+            ),
+            PositiveInt("department_id", "Department ID must be a positive integer"),
+            PositiveInt("job_id", "Job ID must be a positive integer"),
+        ]),
+        "departments": RuleSet([
+            PositiveInt("id", "Job ID must be a positive integer"),
+            NonBlankString("department", "Name cannot be empty or whitespace"),
+        ]),
+        "jobs": RuleSet([
+            PositiveInt("id", "Job ID must be a positive integer"),
+            NonBlankString("job", "Name cannot be empty or whitespace"),
+        ]),
+    }
+
+
+profiles = {"api": _table_rules(utc_suffix=False), "legacy": _table_rules(utc_suffix=True)}
+
+
+def get_rules(table_name, profile="api"):
+    """
+    Returns the RuleSet of a table.
+
+    Raises:
+    - ValueError: If the table or the profile do not exist.
+    """
+    if profile not in profiles:
+        raise ValueError(f"Invalid validation profile {profile}")
+    if table_name not in profiles[profile]:
+        raise ValueError(f"Table {table_name} does not exist")
+    return profiles[profile][table_name]
+
+
+def _model_errors(table_name, row):
+    """
+    Validates a single row with its Pydantic model.
+
+    Returns:
+    - list: The structured errors, empty if the row is valid.
+    """
+    try:
+        transactions[table_name](**row)
+        return []
+    except Exception as e:
+        if not hasattr(e, "errors"):
+            return [{"field": None, "message": str(e)}]
+        errors = []
+        for error in e.errors():
+            message = error["msg"]
+            if error["type"] == "value_error":
+                message = str(error["ctx"]["error"])
+            field = ".".join(str(x) for x in error["loc"]) or None
+            errors.append({"field": field, "message": message})
+        return errors
+
+
+reference_messages = {
+    "department_id": "Department ID does not exist",
+    "job_id": "Job ID does not exist",
+}
+
+# Ids above it cannot be looked up in the index (or stored)
+_MAX_ID = np.iinfo(np.int64).max
+
+range_messages = {
+    "department_id": "Department ID is out of range",
+    "job_id": "Job ID is out of range",
+}
+
+
+def _reference_errors(table_name, data, frame, errors_by_index):
+    """
+    Adds an error for every otherwise valid row that references a
+    department or job missing from the reference index, or one whose id
+    does not fit in 64 bits.
+    """
+    candidates = np.array(
+        [index for index in range(len(data)) if index not in errors_by_index], dtype=int
+    )
+    if not len(candidates):
+        return
+    index = get_reference_index()
+    for field, referenced in references[table_name].items():
+        column = frame[field]
+        if column.dtype.kind in "iu":
+            # uint64 if some ids are above the int64 range
+            values = column.to_numpy()[candidates]
+            in_range = values <= _MAX_ID
+        else:
+            # Rows validated by the model, whose ids may be e.g. "12"
+            values = np.array([int(data[i][field]) for i in candidates], dtype=object)
+            in_range = (values <= _MAX_ID).astype(bool)
+        for i in candidates[~in_range]:
+            errors_by_index.setdefault(i, []).append(
+                {"field": field, "message": range_messages[field]}
+            )
+        checked = candidates[in_range]
+        values = values[in_range].astype(np.int64)
+        for i in checked[~index.contains(referenced, values)]:
+            errors_by_index.setdefault(i, []).append(
+                {"field": field, "message": reference_messages[field]}
+            )
+
+
+@timed("validate")
+def validate_batch(table_name, data):
+    """
+    Validates a batch of transactions column by column.
+
+    Parameters:
+    - table_name (str): The table the transactions belong to.
+    - data (list): A list of dictionaries representing individual transactions.
+
+    Returns:
+    - tuple: (accepted, rejected) where accepted is the list of valid
+      transactions and rejected a list of structured rejections.
+    """
+    rule_set = get_rules(table_name)
+    n = len(data)
+    if n == 0:
+        return [], []
+
+    if all(type(row) is dict for row in data):
+        frame = pd.DataFrame(data)
+        decided = np.ones(n, dtype=bool)
+    else:
+        frame = pd.DataFrame([row if type(row) is dict else {} for row in data])
+        decided = np.fromiter((type(row) is dict for row in data), bool, n)
+
+    rule_decided, failures = rule_set.check(frame)
+    decided &= rule_decided
+
+    invalid = np.zeros(n, dtype=bool)
+    for _, failed in failures:
+        invalid |= failed
+
+    # Rows the columnar checks could not decide on are validated by the model
+    errors_by_index = {}
+    for index in np.flatnonzero(decided & invalid):
+        errors_by_index[index] = [
+            {"field": rule.field, "message": rule.message}
+            for rule, failed in failures
+            if failed[index]
+        ]
+    for index in np.flatnonzero(~decided):
+        errors = _model_errors(table_name, data[index])
+        if errors:
+            errors_by_index[index] = errors
+
+    if table_name in references:
+        _reference_errors(table_name, data, frame, errors_by_index)
+
+    inc("rows_accepted_total", n - len(errors_by_index), table=table_name)
+    inc("rows_rejected_total", len(errors_by_index), table=table_name)
+    if not errors_by_index:
+        return list(data), []
+    accepted = [row for index, row in enumerate(data) if index not in errors_by_index]
+    rejected = [
+        {"index": int(index), "row": data[index], "errors": errors}
+        for index, errors in sorted(errors_by_index.items())
+    ]
+    return accepted, rejected
+
+
+def filter_frame(table_name, frame, profile="legacy"):
+    """
+    Keeps the rows of a DataFrame that pass every rule of the table.
+
+    Unlike validate_batch, rows the columnar checks cannot decide on are
+    dropped, not validated by the models, so id columns should already
+    be numeric (e.g. read with pd.to_numeric).
+
+    Parameters:
+    - table_name (str): The table the rows belong to.
+    - frame (DataFrame): The rows, with a column per field.
+    - profile (str): The rules to apply, "legacy" by default.
+
+    Returns:
+    - tuple: (kept, dropped) where kept is the DataFrame of valid rows and
+      dropped a Counter of the rows dropped by the first rule they failed,
+      as "invalid <field>".
+
+    Raises:
+    - ValueError: If a column of the table is missing.
+    """
+    keep = np.ones(len(frame), dtype=bool)
+    dropped = Counter()
+    for rule in get_rules(table_name, profile).rules:
+        if rule.field not in frame:
+            raise ValueError(f"Column {rule.field} is missing")
+        decided, valid = rule.check(frame[rule.field])
+        failed = keep & ~(decided & valid)
+        dropped[f"invalid {rule.field}"] += int(failed.sum())
+        keep &= ~failed
+    return frame[keep], dropped